@@ -0,0 +1,68 @@
+"""
+Preview size and encode time per raster format and encoder preset
+
+Rasterizes every sample in svg_corpus/ (plus the example SVG from PROMPT)
+once at the preview width, then encodes it with encode_raster in each
+supported format and preset, reporting bytes and the best encode time.
+Totals show how much each choice saves against today's balanced JPEG.
+Results are saved under results/ and compared with the previous run.
+
+Usage: python benchmarks/bench_formats.py [--width W] [--repeat N] [--baseline FILE]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import main  # noqa: E402
+from bench_results import compare, previous_result, save_results  # noqa: E402
+from bench_sanitizer import load_corpus  # noqa: E402
+
+PRESETS = ("fast", "balanced", "small")
+
+def encode_time(png_data: bytes, fmt: str, preset: str, repeat: int) -> float:
+    timer = timeit.Timer(lambda: main.encode_raster(png_data, fmt, main.PREVIEW_QUALITY, preset))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=main.PREVIEW_WIDTH)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", help="results file to compare with (default: previous run)")
+    parser.add_argument("--threshold", type=float, default=0.15)
+    args = parser.parse_args()
+
+    variants = [(fmt, preset) for fmt in main.supported_preview_formats() for preset in PRESETS]
+    results = {}
+    totals = {variant: [0, 0.0] for variant in variants}
+    for name, text in load_corpus().items():
+        clean = main.validate_and_clean_svg(text)
+        png_data = main.rasterize_svg(clean, args.width)
+        sample = {}
+        for fmt, preset in variants:
+            size = len(main.encode_raster(png_data, fmt, main.PREVIEW_QUALITY, preset))
+            seconds = encode_time(png_data, fmt, preset, args.repeat)
+            sample[f"{fmt}_{preset}"] = {"bytes": size, "encode_ms": round(seconds * 1e3, 3)}
+            totals[(fmt, preset)][0] += size
+            totals[(fmt, preset)][1] += seconds
+        results[name] = sample
+        print(f"{name}: " + ", ".join(f"{key} {value['bytes']}" for key, value in sample.items()))
+
+    reference = totals[("jpg", "balanced")][0]
+    print(f"\n{'format':8} {'preset':9} {'bytes':>9} {'vs jpg':>7} {'encode ms':>10}")
+    for (fmt, preset), (size, seconds) in totals.items():
+        print(f"{fmt:8} {preset:9} {size:>9} {size / reference:>7.2f} {seconds * 1e3:>10.2f}")
+
+    path = save_results("formats", results, {"width": args.width, "repeat": args.repeat})
+    print(f"\nSaved {path}")
+    baseline = args.baseline or previous_result("formats", path)
+    if baseline:
+        compare(results, baseline, args.threshold)
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,255 @@
+"""
+End-to-end load test against the fake LLM backend
+
+Drives /generate-svg and /generate-analysis at each concurrency level with a
+corpus of synthetic uploads (12MP phone photos, an EXIF-rotated portrait, a
+PNG screenshot, a transparent PNG) while the fake backend answers with the
+SVGs in svg_corpus/, malformed ones included. The app runs in-process over
+ASGI, or under uvicorn on a local port with --uvicorn.
+
+Reports throughput and client latency per endpoint, and p50/p95/p99 for each
+server stage (upload read, model image prep, LLM, SVG clean/optimize,
+rasterize), timed by wrapping those pipeline functions. Every request uses a
+distinct text so it misses the result cache, unless --repeat-inputs is given.
+--slow-rate and --error-rate inject upstream jitter and failures into the fake
+backend, to see how deadlines, hedging and retries hold the tail.
+Results are saved under results/ and compared with the previous run.
+
+Usage: python benchmarks/bench_load.py [--requests N] [--concurrency 1,8,32]
+       [--latency S] [--slow-rate F] [--error-rate F] [--uvicorn]
+       [--repeat-inputs] [--baseline FILE]
+"""
+import argparse
+import asyncio
+import functools
+import inspect
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from bench_results import compare, previous_result, save_results, summarize_ms  # noqa: E402
+
+ENDPOINTS = ("/generate-svg", "/generate-analysis")
+# Pipeline functions timed as stages; each is looked up on the main module
+# at call time, so wrapping the module attribute is enough
+STAGES = {
+    "upload_read": "read_upload",
+    "model_image": "prepare_model_image",
+    "llm": "call_llm",
+    "svg_clean": "clean_and_optimize_svg",
+    "rasterize": "rasterize",
+}
+
+def configure_environment(args):
+    """
+    Point the app at the fake backend before main is imported
+    """
+    os.environ["LLM_BACKEND"] = "fake"
+    os.environ["FAKE_LLM_LATENCY"] = str(args.latency)
+    os.environ["FAKE_LLM_SLOW_RATE"] = str(args.slow_rate)
+    os.environ["FAKE_LLM_SLOW_LATENCY"] = str(args.latency * 20)
+    os.environ["FAKE_LLM_ERROR_RATE"] = str(args.error_rate)
+    os.environ.setdefault("FAKE_LLM_SVG_DIR", os.path.join(BENCH_DIR, "svg_corpus"))
+    os.environ["JOB_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench-jobs-"), "jobs.db")
+    os.environ["JOB_WORKERS"] = "0"
+
+def make_uploads():
+    """
+    Deterministic synthetic uploads resembling what the app receives
+    """
+    from PIL import Image, ImageDraw
+
+    def photo(size, seed):
+        noise = Image.effect_noise(size, 40 + seed).convert("RGB")
+        gradient = Image.linear_gradient("L").resize(size).convert("RGB")
+        image = Image.blend(noise, gradient, 0.6)
+        draw = ImageDraw.Draw(image)
+        for i in range(12):
+            y = size[1] // 14 * (i + 1)
+            draw.line([(size[0] // 10, y), (size[0] * 9 // 10, y)], fill=(20, 20, 60), width=max(size[0] // 400, 2))
+        return image
+
+    uploads = []
+    buffer = BytesIO()
+    photo((4032, 3024), 0).save(buffer, "JPEG", quality=92)
+    uploads.append(("photo_12mp.jpg", buffer.getvalue(), "image/jpeg"))
+
+    buffer = BytesIO()
+    portrait = photo((4032, 3024), 1)
+    exif = portrait.getexif()
+    exif[0x0112] = 6
+    portrait.save(buffer, "JPEG", quality=90, exif=exif)
+    uploads.append(("portrait_exif_rotated.jpg", buffer.getvalue(), "image/jpeg"))
+
+    screenshot = Image.new("RGB", (1170, 2532), (250, 250, 250))
+    draw = ImageDraw.Draw(screenshot)
+    for i in range(30):
+        draw.rectangle([60, 120 + i * 78, 1110, 170 + i * 78], fill=(225, 235, 245), outline=(120, 140, 200))
+    buffer = BytesIO()
+    screenshot.save(buffer, "PNG")
+    uploads.append(("screenshot.png", buffer.getvalue(), "image/png"))
+
+    buffer = BytesIO()
+    transparent = Image.new("RGBA", (800, 800), (0, 0, 0, 0))
+    ImageDraw.Draw(transparent).ellipse([100, 100, 700, 700], fill=(200, 40, 40, 180))
+    transparent.save(buffer, "PNG")
+    uploads.append(("transparent.png", buffer.getvalue(), "image/png"))
+
+    buffer = BytesIO()
+    photo((1600, 1200), 2).save(buffer, "JPEG", quality=85)
+    uploads.append(("whiteboard.jpg", buffer.getvalue(), "image/jpeg"))
+    return uploads
+
+def instrument(main, samples):
+    """
+    Wrap the stage functions on main so each call records its duration
+    """
+    for stage, attr in STAGES.items():
+        func = getattr(main, attr)
+        if inspect.iscoroutinefunction(func):
+            async def timed(*args, _func=func, _stage=stage, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await _func(*args, **kwargs)
+                finally:
+                    samples[_stage].append(time.perf_counter() - start)
+        else:
+            def timed(*args, _func=func, _stage=stage, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return _func(*args, **kwargs)
+                finally:
+                    samples[_stage].append(time.perf_counter() - start)
+        setattr(main, attr, functools.wraps(func)(timed))
+
+async def drive(client, endpoint, uploads, total, concurrency, repeat_inputs, run_id):
+    """
+    Send total requests with at most concurrency in flight; returns the
+    per-request latencies, error count and wall time
+    """
+    latencies, errors = [], 0
+    counter = iter(range(total))
+
+    async def user():
+        nonlocal errors
+        for i in counter:
+            filename, data, content_type = uploads[i % len(uploads)]
+            text = "Worksheet" if repeat_inputs else f"Worksheet {run_id}-{i}"
+            start = time.perf_counter()
+            try:
+                response = await client.post(
+                    endpoint, data={"text": text}, files={"image": (filename, data, content_type)}
+                )
+                if response.status_code != 200 or not response.json().get("success"):
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - start
+
+async def run_levels(client, main, uploads, samples, args):
+    results = {}
+    for endpoint in ENDPOINTS:
+        for concurrency in args.concurrency:
+            for stage_samples in samples.values():
+                stage_samples.clear()
+            run_id = f"{endpoint}-{concurrency}-{time.time_ns()}"
+            latencies, errors, wall = await drive(
+                client, endpoint, uploads, args.requests, concurrency, args.repeat_inputs, run_id
+            )
+            level = {
+                "requests": len(latencies),
+                "errors": errors,
+                "throughput_rps": round(len(latencies) / wall, 3),
+                "latency": summarize_ms(latencies),
+                "stages": {stage: summarize_ms(values) for stage, values in samples.items() if values},
+            }
+            results.setdefault(endpoint, {})[f"c{concurrency}"] = level
+            print_level(endpoint, concurrency, level)
+    return results
+
+def print_level(endpoint, concurrency, level):
+    latency = level["latency"]
+    print(f"\n{endpoint} concurrency={concurrency}: {level['requests']} requests, {level['errors']} errors, "
+          f"{level['throughput_rps']:.2f} req/s")
+    print(f"  {'stage':14} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    print(f"  {'request':14} {latency['count']:>6} {latency['p50_ms']:>9.1f} {latency['p95_ms']:>9.1f} {latency['p99_ms']:>9.1f}")
+    for stage, summary in level["stages"].items():
+        print(f"  {stage:14} {summary['count']:>6} {summary['p50_ms']:>9.1f} {summary['p95_ms']:>9.1f} {summary['p99_ms']:>9.1f}")
+
+async def run_in_process(main, uploads, samples, args):
+    import httpx
+
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+            return await run_levels(client, main, uploads, samples, args)
+
+async def run_uvicorn(main, uploads, samples, args):
+    import httpx
+    import uvicorn
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        await asyncio.sleep(0.05)
+    try:
+        limits = httpx.Limits(max_connections=max(args.concurrency))
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=120, limits=limits) as client:
+            return await run_levels(client, main, uploads, samples, args)
+    finally:
+        server.should_exit = True
+        thread.join()
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=40, help="requests per endpoint and concurrency level")
+    parser.add_argument("--concurrency", type=lambda s: [int(c) for c in s.split(",")], default=[1, 8, 32])
+    parser.add_argument("--latency", type=float, default=1.0, help="fake LLM latency in seconds")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of LLM calls 20x slower than --latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of LLM calls that fail")
+    parser.add_argument("--uvicorn", action="store_true", help="serve over HTTP instead of in-process ASGI")
+    parser.add_argument("--repeat-inputs", action="store_true", help="reuse request texts so the result cache is hit")
+    parser.add_argument("--baseline", help="results file to compare with (default: previous run)")
+    parser.add_argument("--threshold", type=float, default=0.15)
+    args = parser.parse_args()
+
+    configure_environment(args)
+    import main
+
+    uploads = make_uploads()
+    print("Uploads: " + ", ".join(f"{name} ({len(data) / 1024:.0f} KB)" for name, data, _ in uploads))
+    samples = {stage: [] for stage in STAGES}
+    instrument(main, samples)
+    runner = run_uvicorn if args.uvicorn else run_in_process
+    results = asyncio.run(runner(main, uploads, samples, args))
+
+    config = {
+        "requests": args.requests, "concurrency": args.concurrency, "latency": args.latency,
+        "slow_rate": args.slow_rate, "error_rate": args.error_rate,
+        "mode": "uvicorn" if args.uvicorn else "asgi", "repeat_inputs": args.repeat_inputs,
+        "render_processes": main.RENDER_PROCESSES,
+    }
+    path = save_results("load", results, config)
+    print(f"\nSaved {path}")
+    baseline = args.baseline or previous_result("load", path)
+    if baseline:
+        compare(results, baseline, args.threshold)
+
+if __name__ == "__main__":
+    main_cli()
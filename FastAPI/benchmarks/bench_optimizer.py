@@ -0,0 +1,77 @@
+"""
+Size and rendering-equivalence check for the SVG optimizer
+
+Runs every sample in svg_corpus/ (plus the example SVG from PROMPT) through
+validate_and_clean_svg and then optimize_svg, reports the bytes saved and the
+optimizer's time, and rasterizes both versions to compare them pixel by
+pixel. A sample fails when more than --tolerance of its pixels differ by more
+than --threshold in any channel, which allows for anti-aliasing noise from
+rounded coordinates but not for a changed colour, font or missing shape.
+
+Usage: python benchmarks/bench_optimizer.py [--width W] [--threshold T] [--tolerance F]
+"""
+import argparse
+import os
+import sys
+import timeit
+from io import BytesIO
+
+from PIL import Image, ImageChops
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from bench_sanitizer import is_well_formed, load_corpus  # noqa: E402
+
+def render(svg: str, width: int) -> Image.Image:
+    return Image.open(BytesIO(main.rasterize_svg(svg, width))).convert('RGBA')
+
+def pixel_diff(before: Image.Image, after: Image.Image, threshold: int) -> float:
+    """
+    Fraction of pixels where any channel differs by more than threshold
+    """
+    if before.size != after.size:
+        return 1.0
+    diff = ImageChops.difference(before, after)
+    channels = [band.point(lambda v: 255 if v > threshold else 0) for band in diff.split()]
+    mask = channels[0]
+    for band in channels[1:]:
+        mask = ImageChops.lighter(mask, band)
+    changed = mask.histogram()[255]
+    return changed / (before.size[0] * before.size[1])
+
+def optimize_time(svg: str) -> float:
+    timer = timeit.Timer(lambda: main.optimize_svg(svg))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=800)
+    parser.add_argument("--threshold", type=int, default=64)
+    parser.add_argument("--tolerance", type=float, default=0.001)
+    args = parser.parse_args()
+
+    failures = 0
+    total_before = total_after = 0
+    print(f"{'sample':36} {'bytes':>7} {'optimized':>9} {'saved':>6} {'opt µs':>8} {'diff %':>7} {'ok':>5}")
+    for name, text in load_corpus().items():
+        clean = main.validate_and_clean_svg(text)
+        optimized = main.optimize_svg(clean)
+        before, after = len(clean.encode('utf-8')), len(optimized.encode('utf-8'))
+        total_before += before
+        total_after += after
+        diff = pixel_diff(render(clean, args.width), render(optimized, args.width), args.threshold)
+        ok = is_well_formed(optimized) and diff <= args.tolerance
+        failures += not ok
+        print(f"{name:36} {before:>7} {after:>9} {1 - after / before:>6.1%} "
+              f"{optimize_time(clean) * 1e6:>8.1f} {diff * 100:>7.3f} {str(ok):>5}")
+
+    print(f"\n{'total':36} {total_before:>7} {total_after:>9} {1 - total_after / total_before:>6.1%}")
+    if failures:
+        print(f"\n{failures} sample(s) not rendering-equivalent")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,58 @@
+"""
+Microbenchmarks for the synchronous pipeline stages
+
+Times validate_and_clean_svg, optimize_svg and create_mobile_optimized_images
+on every sample in svg_corpus/ (plus the example SVG from PROMPT), saves the
+results under results/ and compares them with the previous run so
+regressions show up between versions.
+
+Usage: python benchmarks/bench_pipeline.py [--repeat N] [--baseline FILE] [--threshold F]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import main  # noqa: E402
+from bench_results import compare, previous_result, save_results  # noqa: E402
+from bench_sanitizer import load_corpus  # noqa: E402
+
+def best_time(func, arg, repeat: int) -> float:
+    timer = timeit.Timer(lambda: func(arg))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", help="results file to compare with (default: previous run)")
+    parser.add_argument("--threshold", type=float, default=0.15)
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'sample':36} {'clean µs':>9} {'optimize µs':>11} {'images ms':>10}")
+    for name, text in load_corpus().items():
+        clean = main.validate_and_clean_svg(text)
+        sample = {
+            "validate_and_clean_svg_us": round(best_time(main.validate_and_clean_svg, text, args.repeat) * 1e6, 2),
+            "optimize_svg_us": round(best_time(main.optimize_svg, clean, args.repeat) * 1e6, 2),
+            "create_mobile_optimized_images_ms": round(
+                best_time(main.create_mobile_optimized_images, text, args.repeat) * 1e3, 3),
+        }
+        results[name] = sample
+        print(f"{name:36} {sample['validate_and_clean_svg_us']:>9.1f} {sample['optimize_svg_us']:>11.1f} "
+              f"{sample['create_mobile_optimized_images_ms']:>10.2f}")
+
+    path = save_results("pipeline", results, {"repeat": args.repeat})
+    print(f"\nSaved {path}")
+    baseline = args.baseline or previous_result("pipeline", path)
+    if baseline and compare(results, baseline, args.threshold) and args.fail_on_regression:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,191 @@
+"""
+Speed, memory and output comparison of the rasterizer backends
+
+Cleans and optimizes every sample in svg_corpus/ (plus the example SVG from
+PROMPT) the way the pipeline does, then renders it with each backend at
+--width. Reports the best render time, the peak memory one render adds (read
+from /proc in a forked child, so Linux only) and, against the reference
+backend, the fraction of pixels where any channel differs by more than
+--threshold. A backend that fails on a sample is listed with its error; those
+are the documents RASTERIZERS fallback exists for. Differences in text mostly
+come down to which fonts each backend resolves.
+Finally every sample goes through rasterize_svg with a backend that always
+fails placed first, to check the fallback reaches the next one.
+Results are saved under results/ and compared with the previous run.
+
+Usage: python benchmarks/bench_rasterizers.py [--backends cairosvg,resvg]
+       [--reference NAME] [--width W] [--threshold T] [--baseline FILE]
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import timeit
+from io import BytesIO
+
+from PIL import Image
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import main  # noqa: E402
+from bench_optimizer import pixel_diff  # noqa: E402
+from bench_results import compare, previous_result, save_results  # noqa: E402
+from bench_sanitizer import load_corpus  # noqa: E402
+
+def _proc_status_kb(field: str):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return None
+
+def _measure_child(conn, rasterizer, svg, width, height):
+    try:
+        # Reset the peak RSS so it measures this render only
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        before = _proc_status_kb("VmRSS")
+        rasterizer.render(svg, width, height)
+        conn.send(_proc_status_kb("VmHWM") - before)
+    except Exception:
+        conn.send(None)
+
+def peak_memory_kb(rasterizer, svg: str, width: int, height: int):
+    """
+    Peak RSS growth of one render, in a forked copy of this process
+    """
+    if not os.path.exists("/proc/self/clear_refs"):
+        return None
+    ctx = multiprocessing.get_context("fork")
+    parent_conn, child_conn = ctx.Pipe()
+    proc = ctx.Process(target=_measure_child, args=(child_conn, rasterizer, svg, width, height))
+    proc.start()
+    result = parent_conn.recv() if parent_conn.poll(60) else None
+    proc.join(timeout=5)
+    return result
+
+class BrokenRasterizer(main.Rasterizer):
+    name = "broken"
+
+    def import_module(self):
+        return object()
+
+    def render(self, clean_svg: str, width: int, height: int) -> bytes:
+        raise RuntimeError("forced failure")
+
+def check_fallback(samples: dict, backends: list, width: int) -> int:
+    """
+    Render every sample through rasterize_svg behind a failing backend and
+    return how many came back as a PNG of the expected size
+    """
+    broken = BrokenRasterizer()
+    saved, main.rasterizers = main.rasterizers, [broken, *backends]
+    level = main.logger.level
+    # Every sample logs the forced failure; only the outcome matters here
+    main.logger.setLevel("ERROR")
+    passed = 0
+    try:
+        for sample, svg in samples.items():
+            height = max(1, round(width * main.svg_aspect_ratio(svg)))
+            try:
+                image = Image.open(BytesIO(main.rasterize_svg(svg, width)))
+            except Exception as e:
+                print(f"{sample:36} fallback FAILED {type(e).__name__}: {e}"[:100])
+                continue
+            if image.size == (width, height):
+                passed += 1
+            else:
+                print(f"{sample:36} fallback rendered {image.size}, expected {(width, height)}")
+    finally:
+        main.rasterizers = saved
+        main.logger.setLevel(level)
+    if broken.stats["failures"] != len(samples):
+        print(f"broken backend counted {broken.stats['failures']} failures for {len(samples)} samples")
+    return passed
+
+def render_time(rasterizer, svg: str, width: int, height: int, repeat: int) -> float:
+    timer = timeit.Timer(lambda: rasterizer.render(svg, width, height))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", type=lambda s: s.split(","), default=list(main.RASTERIZER_BACKENDS))
+    parser.add_argument("--reference", help="backend to diff against (default: first available)")
+    parser.add_argument("--width", type=int, default=800)
+    parser.add_argument("--threshold", type=int, default=64)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", help="results file to compare with (default: previous run)")
+    parser.add_argument("--regression-threshold", type=float, default=0.15)
+    args = parser.parse_args()
+
+    try:
+        candidates = main.create_rasterizers(args.backends)
+    except ValueError as e:
+        parser.error(str(e))
+    backends = {}
+    for rasterizer in candidates:
+        if rasterizer.module() is None:
+            print(f"{rasterizer.name}: unavailable ({rasterizer.error})")
+            continue
+        backends[rasterizer.name] = rasterizer
+    if not backends:
+        sys.exit("No rasterizer backend available")
+    reference = args.reference or next(iter(backends))
+
+    results = {}
+    totals = {name: {"ms": 0.0, "failures": 0, "diffs": [], "peaks": []} for name in backends}
+    print(f"\n{'sample':36} {'backend':9} {'render ms':>10} {'peak MB':>8} {'diff %':>7}")
+    samples = {}
+    for sample, text in load_corpus().items():
+        svg = main._EXTERNAL_HREF_RE.sub('', main.optimize_svg(main.validate_and_clean_svg(text)))
+        samples[sample] = svg
+        height = max(1, round(args.width * main.svg_aspect_ratio(svg)))
+        images, rows = {}, {}
+        for name, rasterizer in backends.items():
+            try:
+                images[name] = Image.open(BytesIO(rasterizer.render(svg, args.width, height))).convert('RGBA')
+                seconds = render_time(rasterizer, svg, args.width, height, args.repeat)
+            except Exception as e:
+                totals[name]["failures"] += 1
+                rows[name] = {"error": f"{type(e).__name__}: {e}"}
+                continue
+            peak = peak_memory_kb(rasterizer, svg, args.width, height)
+            rows[name] = {"render_ms": round(seconds * 1e3, 3), "peak_rss_kb": peak}
+            totals[name]["ms"] += seconds * 1e3
+            if peak is not None:
+                totals[name]["peaks"].append(peak)
+        for name, row in rows.items():
+            if "error" not in row and reference in images and name != reference:
+                row["diff_pct"] = round(pixel_diff(images[reference], images[name], args.threshold) * 100, 3)
+                totals[name]["diffs"].append(row["diff_pct"])
+            if "error" in row:
+                print(f"{sample:36} {name:9} FAILED {row['error'][:60]}")
+                continue
+            peak = f"{row['peak_rss_kb'] / 1024:.1f}" if row["peak_rss_kb"] is not None else "-"
+            diff = f"{row['diff_pct']:.3f}" if "diff_pct" in row else "-"
+            print(f"{sample:36} {name:9} {row['render_ms']:>10.2f} {peak:>8} {diff:>7}")
+        results[sample] = rows
+
+    print(f"\n{'backend':9} {'total ms':>10} {'failures':>9} {'max peak MB':>12} {'mean diff %':>12} {'max diff %':>11}")
+    for name, total in totals.items():
+        peak = f"{max(total['peaks']) / 1024:.1f}" if total["peaks"] else "-"
+        mean_diff = f"{sum(total['diffs']) / len(total['diffs']):.3f}" if total["diffs"] else "-"
+        max_diff = f"{max(total['diffs']):.3f}" if total["diffs"] else "-"
+        print(f"{name:9} {total['ms']:>10.2f} {total['failures']:>9} {peak:>12} {mean_diff:>12} {max_diff:>11}")
+    print(f"(diffs against {reference}, threshold {args.threshold})")
+
+    passed = check_fallback(samples, list(backends.values()), args.width)
+    print(f"\nFallback: {passed}/{len(samples)} samples rendered after a failing first backend")
+
+    config = {"backends": list(backends), "reference": reference, "width": args.width, "repeat": args.repeat}
+    path = save_results("rasterizers", results, config)
+    print(f"\nSaved {path}")
+    baseline = args.baseline or previous_result("rasterizers", path)
+    if baseline:
+        compare(results, baseline, args.regression_threshold)
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,110 @@
+"""
+Storing benchmark results and comparing them between versions
+
+Each run is written to results/<suite>-<version>.json, where version is the
+`git describe` of the checkout. A run is compared with the newest earlier
+result of the same suite (or an explicit --baseline file): timings that grew
+and throughputs that fell by more than the threshold are reported as
+regressions.
+"""
+import glob
+import json
+import math
+import os
+import platform
+import subprocess
+import time
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+def percentile(values, pct: float) -> float:
+    """
+    Nearest-rank percentile of a list of numbers
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, min(len(ordered), math.ceil(pct / 100 * len(ordered))))
+    return ordered[rank - 1]
+
+def summarize_ms(seconds) -> dict:
+    """
+    Count and p50/p95/p99/max of a list of durations in seconds, in ms
+    """
+    return {
+        "count": len(seconds),
+        "p50_ms": round(percentile(seconds, 50) * 1e3, 3),
+        "p95_ms": round(percentile(seconds, 95) * 1e3, 3),
+        "p99_ms": round(percentile(seconds, 99) * 1e3, 3),
+        "max_ms": round(max(seconds) * 1e3, 3) if seconds else 0.0,
+    }
+
+def version_label() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except Exception:
+        return "unversioned"
+
+def save_results(suite: str, results: dict, config: dict) -> str:
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    version = version_label()
+    path = os.path.join(RESULTS_DIR, f"{suite}-{version}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({
+            "suite": suite,
+            "version": version,
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "machine": f"{platform.machine()} x{os.cpu_count()}",
+            "config": config,
+            "results": results,
+        }, f, indent=2, sort_keys=True)
+    return path
+
+def previous_result(suite: str, exclude: str):
+    paths = [p for p in glob.glob(os.path.join(RESULTS_DIR, f"{suite}-*.json")) if os.path.abspath(p) != os.path.abspath(exclude)]
+    return max(paths, key=os.path.getmtime) if paths else None
+
+def _flatten(data, prefix=""):
+    flat = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+def compare(results: dict, baseline_path: str, threshold: float) -> int:
+    """
+    Print metrics that moved by more than threshold against a baseline file
+    and return the number of regressions
+    """
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\nCompared with {baseline['version']} ({os.path.basename(baseline_path)}), threshold {threshold:.0%}")
+    current, previous = _flatten(results), _flatten(baseline["results"])
+    regressions = 0
+    for name in sorted(current.keys() & previous.keys()):
+        if name.endswith(("_ms", "_us")):
+            worse_when_higher = True
+        elif name.endswith("rps"):
+            worse_when_higher = False
+        else:
+            continue
+        old, new = previous[name], current[name]
+        if old <= 0:
+            continue
+        change = (new - old) / old
+        if abs(change) <= threshold:
+            continue
+        regressed = change > 0 if worse_when_higher else change < 0
+        regressions += regressed
+        print(f"  {'REGRESSION' if regressed else 'improved':10} {name:60} {old:>12.3f} -> {new:>12.3f} ({change:+.1%})")
+    if not regressions:
+        print("  no regressions")
+    return regressions
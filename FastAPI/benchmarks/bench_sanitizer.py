@@ -0,0 +1,142 @@
+"""
+Benchmark and corpus check for the SVG sanitizer
+
+Runs every sample in svg_corpus/ (plus the example SVG from PROMPT) through
+validate_and_clean_svg and the previous regex + ElementTree implementation,
+checks that the new output is well-formed XML and identical when the input is
+streamed in small chunks, and compares timings. A scaling run at the end shows
+how both implementations grow with document size.
+
+Usage: python benchmarks/bench_sanitizer.py [--repeat N]
+"""
+import argparse
+import os
+import re
+import sys
+import timeit
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "svg_corpus")
+STREAM_CHUNK_SIZES = (1, 7, 64, 1024)
+
+def legacy_validate_and_clean_svg(svg_content: str) -> str:
+    """
+    The previous implementation, kept here as the benchmark baseline
+    """
+    try:
+        clean_svg = svg_content.strip()
+        clean_svg = re.sub(r'^```(svg|xml)?\s*', '', clean_svg)
+        clean_svg = re.sub(r'\s*```$', '', clean_svg)
+        clean_svg = clean_svg.strip()
+
+        if not clean_svg.startswith('<svg'):
+            svg_start = clean_svg.find('<svg')
+            if svg_start != -1:
+                clean_svg = clean_svg[svg_start:]
+            else:
+                clean_svg = f'<svg width="100%" height="auto" viewBox="0 0 1200 800" xmlns="http://www.w3.org/2000/svg">{clean_svg}</svg>'
+
+        try:
+            root = ET.fromstring(clean_svg)
+            root.set('width', '100%')
+            root.set('height', 'auto')
+            root.set('preserveAspectRatio', 'xMidYMid meet')
+            if 'xmlns' not in root.attrib:
+                root.set('xmlns', 'http://www.w3.org/2000/svg')
+            clean_svg = ET.tostring(root, encoding='unicode')
+        except ET.ParseError:
+            svg_start = clean_svg.find('<svg')
+            svg_end = clean_svg.find('>', svg_start)
+            if svg_end != -1:
+                svg_tag = clean_svg[svg_start:svg_end + 1]
+                if 'width=' not in svg_tag:
+                    svg_tag = svg_tag.replace('<svg', '<svg width="100%"')
+                if 'height=' not in svg_tag:
+                    svg_tag = svg_tag.replace('<svg', '<svg height="auto"')
+                if 'viewBox=' not in svg_tag:
+                    svg_tag = svg_tag.replace('<svg', '<svg viewBox="0 0 1200 800"')
+                if 'preserveAspectRatio=' not in svg_tag:
+                    svg_tag = svg_tag.replace('<svg', '<svg preserveAspectRatio="xMidYMid meet"')
+                if 'xmlns=' not in svg_tag and 'xmlns:' not in svg_tag:
+                    svg_tag = svg_tag.replace('<svg', '<svg xmlns="http://www.w3.org/2000/svg"')
+                clean_svg = clean_svg[:svg_start] + svg_tag + clean_svg[svg_end + 1:]
+
+        clean_svg = re.sub(r'<([a-zA-Z]+)([^>]*[^/])>', r'<\1\2></\1>', clean_svg)
+        clean_svg = re.sub(r'&(?!(amp|lt|gt|quot|apos);)', '&amp;', clean_svg)
+        return clean_svg
+    except Exception:
+        return main.ERROR_SVG
+
+def load_corpus():
+    samples = {}
+    for name in sorted(os.listdir(CORPUS_DIR)):
+        with open(os.path.join(CORPUS_DIR, name), encoding="utf-8") as f:
+            samples[os.path.splitext(name)[0]] = f.read()
+    prompt_svg = main.PROMPT[main.PROMPT.index('<svg'):main.PROMPT.index('</svg>') + len('</svg>')]
+    samples["prompt_example"] = prompt_svg
+    return samples
+
+def is_well_formed(svg: str) -> bool:
+    try:
+        return ET.fromstring(svg).tag == f"{{{main.SVG_NAMESPACE}}}svg"
+    except ET.ParseError:
+        return False
+
+def sanitize_streamed(text: str, chunk_size: int) -> str:
+    sanitizer = main.SVGSanitizer()
+    parts = [sanitizer.feed(text[i:i + chunk_size]) for i in range(0, len(text), chunk_size)]
+    parts.append(sanitizer.close())
+    return ''.join(parts)
+
+def best_time(func, text: str, repeat: int) -> float:
+    timer = timeit.Timer(lambda: func(text))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+def run_corpus(samples, repeat: int) -> int:
+    failures = 0
+    print(f"{'sample':36} {'legacy ok':>9} {'new ok':>6} {'stream':>6} {'legacy µs':>10} {'new µs':>8}")
+    for name, text in samples.items():
+        clean = main.validate_and_clean_svg(text)
+        ok = is_well_formed(clean)
+        streamed = all(sanitize_streamed(text, size) == clean for size in STREAM_CHUNK_SIZES)
+        legacy_ok = is_well_formed(legacy_validate_and_clean_svg(text))
+        legacy_us = best_time(legacy_validate_and_clean_svg, text, repeat) * 1e6
+        new_us = best_time(main.validate_and_clean_svg, text, repeat) * 1e6
+        failures += (not ok) + (not streamed)
+        print(f"{name:36} {str(legacy_ok):>9} {str(ok):>6} {str(streamed):>6} {legacy_us:>10.1f} {new_us:>8.1f}")
+    return failures
+
+def run_scaling(samples, repeat: int):
+    body = samples["prompt_example"]
+    inner = body[body.index('>') + 1:body.rindex('</svg>')]
+    root = '<svg viewBox="0 0 1400 750" xmlns="http://www.w3.org/2000/svg">'
+    # A response truncated inside a run of unterminated tags has no ">" left for
+    # the old "<tag ...>" repair regex to stop at, which makes it quadratic
+    unterminated = '<text x="1" y="2" ' * 50
+    print(f"\n{'scaling':36} {'size KB':>9} {'legacy ms':>10} {'new ms':>8}")
+    for factor in (1, 4, 16):
+        for label, text in (("prompt example", root + inner * factor + '</svg>'),
+                            ("truncated unterminated tags", root + unterminated * factor)):
+            legacy_ms = best_time(legacy_validate_and_clean_svg, text, repeat) * 1e3
+            new_ms = best_time(main.validate_and_clean_svg, text, repeat) * 1e3
+            print(f"{label + ' x' + str(factor):36} {len(text) / 1024:>9.1f} {legacy_ms:>10.2f} {new_ms:>8.2f}")
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    samples = load_corpus()
+    failures = run_corpus(samples, args.repeat)
+    run_scaling(samples, args.repeat)
+    if failures:
+        print(f"\n{failures} corpus check(s) failed")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,23 +1,517 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from typing import Optional, Dict
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from starlette.datastructures import MutableHeaders
+from typing import Optional, Dict, List, AsyncIterator
+from contextlib import aclosing, asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+import asyncio
+import hashlib
+import heapq
+import http.client
+import ipaddress
+import json
+import math
+import multiprocessing
+import os
+import queue
+import random
+import socket
+import sqlite3
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
 import uvicorn
 from io import BytesIO
-from PIL import Image
-import cairosvg
 import base64
+import colorsys
+import gzip
 import re
-import xml.etree.ElementTree as ET
-from google import genai
 import logging
+import xml.etree.ElementTree as ET
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Business Analyzer API", version="1.0.0")
+# Concurrency limits per pipeline stage. LLM calls are I/O bound and can be
+# kept in flight by the dozen; rendering is CPU bound and runs on its own pool.
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "32"))
+RENDER_CONCURRENCY = int(os.getenv("RENDER_CONCURRENCY", str(os.cpu_count() or 4)))
+
+llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+render_semaphore = asyncio.Semaphore(RENDER_CONCURRENCY)
+render_executor = ThreadPoolExecutor(max_workers=RENDER_CONCURRENCY, thread_name_prefix="render")
+
+# Rasterization runs in a pool of warm worker processes so it scales across
+# cores. RENDER_PROCESSES=0 keeps it on the render thread pool instead. The
+# queue defaults to the admission limit (ADMISSION_MAX_IN_FLIGHT), so every
+# admitted request can wait for its render rather than be turned away after
+# its model call has been paid for.
+RENDER_PROCESSES = int(os.getenv("RENDER_PROCESSES", str(os.cpu_count() or 2)))
+RENDER_QUEUE_SIZE = int(os.getenv("RENDER_QUEUE_SIZE", os.getenv("ADMISSION_MAX_IN_FLIGHT", str(LLM_CONCURRENCY))))
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", "20"))
+
+# Metrics. Each pipeline stage is timed into a Prometheus histogram and into
+# the current request's Server-Timing header. prometheus_client is optional:
+# without it metrics are not kept, Server-Timing still works and /metrics
+# answers 503.
+class NullMetric:
+    """
+    Stands in for a Prometheus metric and records nothing
+    """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def labels(self, *values):
+        return self
+
+    def inc(self, amount: float = 1):
+        pass
+
+    def dec(self, amount: float = 1):
+        pass
+
+    def set(self, value: float):
+        pass
+
+    def observe(self, value: float):
+        pass
+
+if prometheus_client is not None:
+    Counter, Gauge, Histogram = prometheus_client.Counter, prometheus_client.Gauge, prometheus_client.Histogram
+else:
+    logger.warning("prometheus_client not installed; metrics are disabled")
+    Counter = Gauge = Histogram = NullMetric
+
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(8))
+
+STAGE_SECONDS = Histogram("svg_agent_stage_seconds", "Time spent in each pipeline stage", ["stage"], buckets=STAGE_BUCKETS)
+STAGE_IN_FLIGHT = Gauge("svg_agent_stage_in_flight", "Calls currently inside each pipeline stage", ["stage"])
+STAGE_ERRORS = Counter("svg_agent_stage_errors_total", "Pipeline stage failures", ["stage"])
+REQUEST_SECONDS = Histogram("svg_agent_request_seconds", "HTTP request duration", ["endpoint", "status"], buckets=STAGE_BUCKETS)
+REQUESTS_IN_FLIGHT = Gauge("svg_agent_requests_in_flight", "HTTP requests being served")
+RESPONSE_BYTES = Histogram("svg_agent_response_bytes", "HTTP response body size", ["endpoint"], buckets=SIZE_BUCKETS)
+SVG_BYTES = Histogram("svg_agent_svg_bytes", "SVG size before and after optimizing", ["kind"], buckets=SIZE_BUCKETS)
+LLM_ATTEMPTS = Counter("svg_agent_llm_attempts_total", "Model call attempts by outcome", ["outcome"])
+LLM_RETRIED = Counter("svg_agent_llm_retries_total", "Model calls retried after a transient failure")
+LLM_HEDGES = Counter("svg_agent_llm_hedges_total", "Hedged duplicate model requests sent, and those that won", ["outcome"])
+LLM_DEADLINE_EXCEEDED = Counter("svg_agent_llm_deadline_exceeded_total", "Model calls that ran out of time")
+LLM_CIRCUIT_STATE = Gauge("svg_agent_llm_circuit_state", "Model circuit breaker state (0 closed, 1 half-open, 2 open)")
+ADMISSION_IN_FLIGHT = Gauge("svg_agent_admission_in_flight", "Admitted generation requests being served", ["lane"])
+ADMISSION_QUEUED = Gauge("svg_agent_admission_queued", "Generation requests waiting for admission", ["lane"])
+ADMISSION_WAIT_SECONDS = Histogram("svg_agent_admission_wait_seconds", "Time spent waiting for admission", ["lane"], buckets=STAGE_BUCKETS)
+ADMISSION_REJECTED = Counter("svg_agent_admission_rejected_total", "Generation requests turned away", ["lane", "reason"])
+LLM_CIRCUIT_REJECTIONS = Counter("svg_agent_llm_circuit_rejections_total", "Model calls failed fast by the open circuit")
+
+request_timings: ContextVar[Optional[list]] = ContextVar("request_timings", default=None)
+
+def record_stage(name: str, seconds: float):
+    STAGE_SECONDS.labels(name).observe(seconds)
+    timings = request_timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a block as a pipeline stage, counting it in flight and on failure
+    """
+    STAGE_IN_FLIGHT.labels(name).inc()
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(name).inc()
+        raise
+    finally:
+        STAGE_IN_FLIGHT.labels(name).dec()
+        record_stage(name, time.perf_counter() - start)
+
+def server_timing(timings: list, total: float) -> str:
+    durations = {}
+    for name, seconds in timings:
+        durations[name] = durations.get(name, 0.0) + seconds
+    durations["total"] = total
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in durations.items())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Starting render workers, cairo and the model connection is left to a
+    # background warm-up so the server answers /health straight away;
+    # /ready passes once it is done
+    llm_start = asyncio.create_task(llm_backend.start())
+    startup = asyncio.create_task(warm_up(llm_start))
+    job_workers = []
+    try:
+        await asyncio.to_thread(job_queue.open)
+        job_workers = [asyncio.create_task(job_heartbeat())]
+        job_workers += [asyncio.create_task(job_worker()) for _ in range(JOB_WORKERS)]
+    except Exception as e:
+        logger.error(f"Job queue unavailable: {str(e)}")
+    yield
+    for task in job_workers:
+        task.cancel()
+    await asyncio.gather(*job_workers, return_exceptions=True)
+    startup.cancel()
+    llm_start.cancel()
+    await asyncio.gather(startup, llm_start, return_exceptions=True)
+    await llm_backend.close()
+    render_pool.shutdown()
+    render_executor.shutdown(wait=False, cancel_futures=True)
+    result_cache.close()
+    job_queue.close()
+
+app = FastAPI(title="Business Analyzer API", version="1.0.0", lifespan=lifespan)
+
+class MetricsMiddleware:
+    """
+    Times every HTTP request by route and adds a Server-Timing header listing
+    the pipeline stages that finished before the response started
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        timings = []
+        token = request_timings.set(timings)
+        start = time.perf_counter()
+        response = {"status": 500, "bytes": 0}
+        
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", server_timing(timings, time.perf_counter() - start))
+            elif message["type"] == "http.response.body":
+                response["bytes"] += len(message.get("body", b""))
+            await send(message)
+        
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            route = scope.get("route")
+            endpoint = getattr(route, "path", "unmatched")
+            REQUEST_SECONDS.labels(endpoint, str(response["status"])).observe(time.perf_counter() - start)
+            RESPONSE_BYTES.labels(endpoint).observe(response["bytes"])
+            request_timings.reset(token)
+
+# Admission control for the generation endpoints. At most
+# ADMISSION_MAX_IN_FLIGHT requests are served at once, bulk traffic (analysis
+# and batches) only up to ADMISSION_BULK_SHARE of that, and up to
+# ADMISSION_QUEUE_SIZE more wait in priority order for ADMISSION_QUEUE_TIMEOUT
+# at most. Anything beyond that is turned away with 503 and Retry-After, as
+# is every new request while the render queue is full. Job workers take slots
+# in a job lane below bulk that shares its cap, and wait rather than fail
+# when turned away, since their jobs are already queued.
+# RATE_LIMIT_PER_MINUTE > 0 adds a token bucket per client, keyed by
+# RATE_LIMIT_CLIENT_HEADER (e.g. X-Client-Id) or else the peer address.
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", str(LLM_CONCURRENCY)))
+ADMISSION_BULK_SHARE = float(os.getenv("ADMISSION_BULK_SHARE", "0.5"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "15"))
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "0"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "10"))
+RATE_LIMIT_CLIENT_HEADER = os.getenv("RATE_LIMIT_CLIENT_HEADER", "").lower()
+
+# POST routes under admission control and their lane; interactive requests
+# are admitted ahead of bulk ones
+ADMISSION_LANES = {
+    "/generate-svg": "interactive",
+    "/generate-svg/stream": "interactive",
+    "/generate-analysis": "bulk",
+    "/generate-svg/batch": "bulk",
+}
+
+class Overloaded(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """
+    Bounded in-flight slots with a bounded priority wait queue. When the
+    queue is full, an interactive arrival displaces the newest queued bulk
+    request rather than being turned away itself.
+    """
+    PRIORITIES = {"interactive": 0, "bulk": 1, "job": 2}
+
+    def __init__(self, max_in_flight: int, bulk_share: float, queue_size: int, queue_timeout: float,
+                 saturated=lambda: False):
+        self.max_in_flight = max(1, max_in_flight)
+        self.bulk_max_in_flight = max(1, int(self.max_in_flight * bulk_share))
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        # Whether a downstream stage is full, in which case new requests are
+        # shed before they cost a model call
+        self.saturated = saturated
+        self.in_flight = {lane: 0 for lane in self.PRIORITIES}
+        self._waiters = []
+        self._seq = 0
+        # Smoothed time an admitted request holds its slot, for Retry-After
+        self.service_time = 1.0
+        self.stats = {"admitted": 0, "queued": 0, "queue_full": 0, "timeout": 0, "displaced": 0, "render_busy": 0}
+
+    def _can_run(self, lane: str) -> bool:
+        if sum(self.in_flight.values()) >= self.max_in_flight:
+            return False
+        return lane == "interactive" or self.in_flight["bulk"] + self.in_flight["job"] < self.bulk_max_in_flight
+
+    def _take(self, lane: str):
+        self.in_flight[lane] += 1
+        self.stats["admitted"] += 1
+        ADMISSION_IN_FLIGHT.labels(lane).inc()
+
+    def _dequeue(self, entry):
+        self._waiters.remove(entry)
+        heapq.heapify(self._waiters)
+        ADMISSION_QUEUED.labels(entry[3]).dec()
+
+    def retry_after(self) -> int:
+        estimate = self.service_time * (len(self._waiters) + 1) / self.max_in_flight
+        return max(1, min(60, math.ceil(estimate)))
+
+    def _reject(self, lane: str, reason: str) -> Overloaded:
+        self.stats[reason] += 1
+        ADMISSION_REJECTED.labels(lane, reason).inc()
+        return Overloaded(reason, self.retry_after())
+
+    async def acquire(self, lane: str):
+        """
+        Wait for a slot in the given lane, raising Overloaded if there is no
+        room to wait or the wait runs out
+        """
+        if self.saturated():
+            raise self._reject(lane, "render_busy")
+        priority = self.PRIORITIES[lane]
+        if self._can_run(lane) and not any(entry[0] <= priority for entry in self._waiters):
+            self._take(lane)
+            return
+        if len(self._waiters) >= self.queue_size:
+            worst = max(self._waiters, default=None)
+            if worst is None or worst[0] <= priority:
+                raise self._reject(lane, "queue_full")
+            self._dequeue(worst)
+            worst[2].set_exception(self._reject(worst[3], "displaced"))
+        
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, self._seq, future, lane)
+        self._seq += 1
+        heapq.heappush(self._waiters, entry)
+        self.stats["queued"] += 1
+        ADMISSION_QUEUED.labels(lane).inc()
+        try:
+            done, _ = await asyncio.wait({future}, timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.release(lane, 0.0)
+            elif entry in self._waiters:
+                self._dequeue(entry)
+            raise
+        if not done:
+            self._dequeue(entry)
+            raise self._reject(lane, "timeout")
+        future.result()
+
+    def release(self, lane: str, seconds: float):
+        self.in_flight[lane] -= 1
+        ADMISSION_IN_FLIGHT.labels(lane).dec()
+        if seconds > 0:
+            self.service_time += 0.1 * (seconds - self.service_time)
+        # Waiters are ordered by lane then arrival; a bulk waiter at the head
+        # blocked by the bulk cap means everyone behind it is blocked too
+        while self._waiters and self._can_run(self._waiters[0][3]):
+            _, _, future, waiter_lane = heapq.heappop(self._waiters)
+            ADMISSION_QUEUED.labels(waiter_lane).dec()
+            self._take(waiter_lane)
+            future.set_result(True)
+
+    def snapshot(self) -> Dict:
+        return {
+            "in_flight": dict(self.in_flight),
+            "waiting": {lane: sum(entry[3] == lane for entry in self._waiters) for lane in self.PRIORITIES},
+            "max_in_flight": self.max_in_flight,
+            "bulk_max_in_flight": self.bulk_max_in_flight,
+            "service_time": round(self.service_time, 3),
+            **self.stats,
+        }
+
+class RateLimiter:
+    """
+    Token bucket per client: `burst` requests at once, refilled at
+    `per_minute`. The least recently seen clients are forgotten first.
+    """
+
+    def __init__(self, per_minute: float, burst: int, max_clients: int = 10000):
+        self.rate = per_minute / 60
+        self.burst = max(1, burst)
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self.stats = {"limited": 0, "clients": 0}
+
+    def check(self, client: str) -> float:
+        """
+        Take a token for the client; returns 0 if allowed, otherwise the
+        seconds until a token is available
+        """
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(client, (float(self.burst), now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+            self.stats["limited"] += 1
+        self._buckets[client] = (tokens, now)
+        if len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        self.stats["clients"] = len(self._buckets)
+        return wait
 
+admission = AdmissionController(
+    ADMISSION_MAX_IN_FLIGHT, ADMISSION_BULK_SHARE, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT,
+    saturated=lambda: render_pool.saturated(),
+)
+rate_limiter = RateLimiter(RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST) if RATE_LIMIT_PER_MINUTE > 0 else None
+
+def client_key(scope) -> str:
+    if RATE_LIMIT_CLIENT_HEADER:
+        for name, value in scope["headers"]:
+            if name.decode('latin-1') == RATE_LIMIT_CLIENT_HEADER:
+                return value.decode('latin-1')
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+class AdmissionMiddleware:
+    """
+    Applies rate limits and admission control to the generation endpoints
+    before the upload is read, so turning a request away costs next to
+    nothing. The slot is held until the response, streamed or not, is done.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        lane = None
+        if scope["type"] == "http" and scope["method"] == "POST":
+            lane = ADMISSION_LANES.get(scope["path"])
+            if lane is None and scope["path"].startswith("/sessions/") and scope["path"].endswith("/refine"):
+                lane = "interactive"
+        if lane is None:
+            await self.app(scope, receive, send)
+            return
+        
+        if rate_limiter is not None:
+            wait = rate_limiter.check(client_key(scope))
+            if wait > 0:
+                ADMISSION_REJECTED.labels(lane, "rate_limited").inc()
+                response = JSONResponse(
+                    {"detail": "Rate limit exceeded"}, status_code=429,
+                    headers={"Retry-After": str(math.ceil(wait))}
+                )
+                await response(scope, receive, send)
+                return
+        
+        start = time.perf_counter()
+        try:
+            await admission.acquire(lane)
+        except Overloaded as e:
+            logger.warning(f"🚦 Shed {lane} request to {scope['path']} ({e.reason})")
+            response = JSONResponse(
+                {"detail": "Server busy, please retry"}, status_code=503,
+                headers={"Retry-After": str(e.retry_after)}
+            )
+            await response(scope, receive, send)
+            return
+        waited = time.perf_counter() - start
+        ADMISSION_WAIT_SECONDS.labels(lane).observe(waited)
+        record_stage("admission", waited)
+        
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission.release(lane, time.perf_counter() - start)
+
+# Request body limits. Starlette spools the whole multipart body before the
+# endpoint runs, so oversized requests are turned away here instead: at once
+# when Content-Length is over the limit, otherwise as soon as the bytes
+# received pass it. Form fields and multipart framing get FORM_OVERHEAD_BYTES
+# on top of the upload limit.
+FORM_OVERHEAD_BYTES = 64 * 1024
+
+def request_body_limit(path: str) -> int:
+    if path == "/generate-svg/batch":
+        return BATCH_MAX_BYTES + FORM_OVERHEAD_BYTES
+    return MAX_UPLOAD_SIZE + FORM_OVERHEAD_BYTES
+
+class BodyLimitMiddleware:
+    """
+    Rejects POST bodies larger than the route allows with 413 before the form
+    parser has buffered them
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+        
+        limit = request_body_limit(scope["path"])
+        detail = f"Request too large (max {limit // (1024 * 1024)}MB)"
+        length = dict(scope["headers"]).get(b"content-length", b"")
+        if length.isdigit() and int(length) > limit:
+            response = JSONResponse({"detail": detail}, status_code=413)
+            await response(scope, receive, send)
+            return
+        
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # Raised inside form parsing, which FastAPI passes on as is
+                    raise HTTPException(413, detail=detail)
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+# Admission innermost so shed requests still get CORS headers and metrics;
+# body limits outside it so oversized requests never take a slot
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(BodyLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -25,10 +519,11 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
 # Gemini client - unchanged
 GEMINI_API_KEY = "enter your gemini api key"
-client = genai.Client(api_key=GEMINI_API_KEY)
+GEMINI_MODEL = "gemini-2.5-flash-image"
 
 # PROMPT - unchanged
 PROMPT = """
@@ -299,190 +794,3596 @@ You are a AI Agent. You must strictly follow all the above instructions.
 
 """
 
-def validate_and_clean_svg(svg_content: str) -> str:
+# Bump whenever PROMPT changes so cached results from the old prompt are not reused
+PROMPT_VERSION = "1"
+
+# Layout mode. Instead of hand-writing every coordinate, the model returns a
+# compact JSON spec (the transcribed question with its highlighted values,
+# the step cards and which values feed which step) and render_layout turns it
+# into SVG locally: far fewer output tokens, and the SVG is always valid.
+GENERATION_MODES = ("svg", "layout")
+GENERATION_MODE = os.getenv("GENERATION_MODE", "svg")
+LAYOUT_PROMPT_VERSION = "1"
+
+LAYOUT_EXAMPLE = {
+    "question": [
+        {"heading": "Bank Reconciliation"},
+        {"text": ["Bank statement balance ", {"value": "6,365.61", "id": "bank", "color": "blue"}]},
+        {"text": ["Deposits not recorded ", {"value": "750.75", "id": "deposits", "color": "blue"}]},
+        {"text": ["Checkbook balance ", {"value": "6,700.59", "id": "book", "color": "green"}]},
+        {"text": ["Interest credit ", {"value": "24.41", "id": "interest", "color": "green"},
+                  ", bank charges ", {"value": "95.98", "id": "charges", "color": "green"}]},
+        {"text": "What is the amount of the outstanding checks?", "goal": True},
+        {"table": [["Check", "Amount"], ["1012", "310.00"], ["1015", {"value": "?", "id": "outstanding", "color": "red"}]]},
+        {"options": ["A) $177.34", "B) $487.34", "C) $584.32"], "correct": 1},
+    ],
+    "steps": [
+        {"title": "Step 1: Adjusted Book Balance", "color": "green", "from": ["book", "interest", "charges"],
+         "lines": ["Book + Interest - Charges", {"math": "6,700.59 + 24.41 - 95.98"}],
+         "result": "Adjusted Balance = $6,629.02"},
+        {"title": "Step 2: Bank Subtotal", "color": "blue", "from": ["bank", "deposits"],
+         "lines": ["Statement + Deposits in transit", {"math": "6,365.61 + 750.75"}],
+         "result": "Bank Subtotal = $7,116.36"},
+        {"title": "Step 3: Solve Outstanding", "color": "red", "from": ["goal"], "to": ["outstanding"],
+         "lines": ["Bank Subtotal - X = Adjusted Balance", {"math": "X = 7,116.36 - 6,629.02"}],
+         "result": "Outstanding Checks = $487.34"},
+    ],
+}
+
+LAYOUT_PROMPT = """Analyze the attached question image and describe an explanation diagram as JSON. Do not write SVG; the layout is drawn for you.
+
+- "question": the question transcribed exactly, top to bottom, as a list of blocks:
+  {"heading": "..."} for titles; {"text": "..."} for a line or paragraph; {"table": [["cell", ...], ...]} with the header row first;
+  {"options": ["A) ...", ...], "correct": <index of the right option>} for multiple-choice answers.
+  Mark the question being asked with "goal": true on its text block.
+- Wherever a value used in the calculation appears, make it a span {"value": "SAR 35", "id": "short_id", "color": "..."} inside the
+  text (a list of strings and spans) or as the table cell. Unknowns the steps solve for are spans too.
+- "steps": the solution as cards, each {"title", "color", "from": [ids it uses], "to": [ids it fills in], "lines": [...], "result"}.
+  Lines are plain strings or {"math": "..."} for formulas (x^2 and x_1 for super/subscripts). "goal" refers to the goal block.
+- Colors: "red" for the goal / core equation, "blue" for condition A (e.g. input costs), "green" for condition B
+  (e.g. selling price), "orange" for the final calculation. A value's color matches the step that uses it.
+- Final answers must match the multiple-choice options.
+
+Return only the JSON object. Example:
+""" + json.dumps(LAYOUT_EXAMPLE)
+
+# Follow-up edits to an SVG the model already produced; sent instead of
+# PROMPT, together with the current SVG and the earlier instructions
+REFINE_PROMPT = """You are editing an SVG diagram you produced earlier from the attached image.
+Apply ONLY the requested change. Keep everything else (text, layout, coordinates, colors, fonts) exactly as it is.
+Return the complete updated SVG in a single ```svg code block and nothing else."""
+
+# LLM backends. PROMPT is a large static prefix; backends get only the
+# per-request text and image and decide how the prefix reaches the model.
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
+PROMPT_CACHE_TTL = int(os.getenv("PROMPT_CACHE_TTL", "3600"))
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "2.0"))
+FAKE_LLM_CHUNK_SIZE = int(os.getenv("FAKE_LLM_CHUNK_SIZE", "512"))
+FAKE_LLM_SVG_DIR = os.getenv("FAKE_LLM_SVG_DIR", "")
+# Injected upstream trouble for exercising the call policy: the share of
+# calls that take FAKE_LLM_SLOW_LATENCY instead, and the share that fail
+FAKE_LLM_SLOW_RATE = float(os.getenv("FAKE_LLM_SLOW_RATE", "0"))
+FAKE_LLM_SLOW_LATENCY = float(os.getenv("FAKE_LLM_SLOW_LATENCY", "30"))
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+
+def full_prompt(request_text: str) -> str:
     """
-    Clean and validate SVG to ensure it's mobile-compatible and well-formed
+    PROMPT followed by the per-request text, as one message
     """
-    try:
-        # Remove any markdown or code block wrappers
-        clean_svg = svg_content.strip()
-        
-        # Remove markdown code blocks
-        clean_svg = re.sub(r'^```(svg|xml)?\s*', '', clean_svg)
-        clean_svg = re.sub(r'\s*```$', '', clean_svg)
-        clean_svg = clean_svg.strip()
-        
-        # Ensure it starts with <svg
-        if not clean_svg.startswith('<svg'):
-            svg_start = clean_svg.find('<svg')
-            if svg_start != -1:
-                clean_svg = clean_svg[svg_start:]
-            else:
-                clean_svg = f'<svg width="100%" height="auto" viewBox="0 0 1200 800" xmlns="http://www.w3.org/2000/svg">{clean_svg}</svg>'
-        
-        # Parse and optimize SVG for mobile
-        try:
-            root = ET.fromstring(clean_svg)
-            
-            root.set('width', '100%')
-            root.set('height', 'auto')
-            root.set('preserveAspectRatio', 'xMidYMid meet')
-            
-            if 'xmlns' not in root.attrib:
-                root.set('xmlns', 'http://www.w3.org/2000/svg')
-            
-            clean_svg = ET.tostring(root, encoding='unicode')
-            
-        except ET.ParseError:
-            svg_start = clean_svg.find('<svg')
-            svg_end = clean_svg.find('>', svg_start)
-            if svg_end != -1:
-                svg_tag = clean_svg[svg_start:svg_end + 1]
-                
-                if 'width=' not in svg_tag:
-                    svg_tag = svg_tag.replace('<svg', '<svg width="100%"')
-                if 'height=' not in svg_tag:
-                    svg_tag = svg_tag.replace('<svg', '<svg height="auto"')
-                if 'viewBox=' not in svg_tag:
-                    svg_tag = svg_tag.replace('<svg', '<svg viewBox="0 0 1200 800"')
-                if 'preserveAspectRatio=' not in svg_tag:
-                    svg_tag = svg_tag.replace('<svg', '<svg preserveAspectRatio="xMidYMid meet"')
-                if 'xmlns=' not in svg_tag and 'xmlns:' not in svg_tag:
-                    svg_tag = svg_tag.replace('<svg', '<svg xmlns="http://www.w3.org/2000/svg"')
-                
-                clean_svg = clean_svg[:svg_start] + svg_tag + clean_svg[svg_end + 1:]
-        
-        # Fix common XML issues
-        clean_svg = re.sub(r'<([a-zA-Z]+)([^>]*[^/])>', r'<\1\2></\1>', clean_svg)
-        clean_svg = re.sub(r'&(?!(amp|lt|gt|quot|apos);)', '&amp;', clean_svg)
-        
-        return clean_svg
-        
-    except Exception as e:
-        logger.error(f"Error cleaning SVG: {str(e)}")
-        return '<svg width="100%" height="auto" viewBox="0 0 1200 800" xmlns="http://www.w3.org/2000/svg"><text x="100" y="100" font-size="16" fill="#000">SVG Generation Error</text></svg>'
+    if request_text:
+        return f"{PROMPT}\n\n{request_text}"
+    return PROMPT
 
-def create_mobile_optimized_images(svg_content: str) -> Dict:
+class LLMBackend:
     """
-    Create mobile-optimized images from SVG for React Native
+    Interface to the model that writes the SVG. `model` is part of result
+    cache keys, so backends that produce different output must differ in it.
     """
-    try:
-        clean_svg = validate_and_clean_svg(svg_content)
-        
-        images = {}
-        
-        # Preview size for React Native chat (400x300)
+    name = "LLM"
+    model = ""
+
+    async def start(self):
+        pass
+
+    async def generate(self, request_text: str, image: bytes, mode: str = "svg") -> str:
+        """
+        The model's response to PROMPT, or to LAYOUT_PROMPT in layout mode
+        """
+        raise NotImplementedError
+
+    async def stream(self, request_text: str, image: bytes) -> AsyncIterator[str]:
+        raise NotImplementedError
+        yield
+
+    async def refine(self, prompt_text: str, image: Optional[bytes]) -> str:
+        """
+        Send prompt_text as is, without PROMPT, plus the image if given
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    def retryable(self, error: Exception) -> bool:
+        """
+        Whether a failed call is transient: worth retrying, and a sign of
+        an unhealthy backend for the circuit breaker
+        """
+        return isinstance(error, (asyncio.TimeoutError, ConnectionError))
+
+    def snapshot(self) -> Dict:
+        return {"backend": self.name, "model": self.model}
+
+class GeminiBackend(LLMBackend):
+    """
+    Gemini through one long-lived client, so its connection pool is reused
+    across requests. PROMPT is uploaded once as cached content and requests
+    send only their own text and image; if the model or prompt does not
+    qualify for explicit caching the prefix is sent inline instead.
+    """
+    name = "Gemini"
+
+    def __init__(self, api_key: str, model: str, cache_ttl: int):
+        self.api_key = api_key
+        self._client = None
+        self.model = model
+        self.cache_ttl = cache_ttl
+        self._cache_name = None
+        self._cache_expires = 0.0
+        self._cache_retry_at = 0.0
+        self._cache_lock = asyncio.Lock()
+        self.stats = {"cached_calls": 0, "inline_calls": 0, "layout_calls": 0, "refine_calls": 0,
+                      "cache_creates": 0, "cache_errors": 0}
+
+    @property
+    def client(self):
+        """
+        The genai client, built on first use. Importing google.genai and
+        building the client take most of this module's import time, so
+        both are deferred until the backend is warmed up or first called.
+        """
+        if self._client is None:
+            from google import genai
+            self._client = genai.Client(api_key=self.api_key)
+        return self._client
+
+    async def start(self):
+        await asyncio.to_thread(lambda: self.client)
+        if self.cache_ttl > 0:
+            await self._prompt_cache()
+        else:
+            # No cache to create; a metadata call opens the connection instead
+            await self.client.aio.models.get(model=self.model)
+
+    async def _prompt_cache(self) -> Optional[str]:
+        """
+        Name of a live cached-content entry holding PROMPT, creating or
+        renewing it as needed; None means send the prefix inline
+        """
+        if self.cache_ttl <= 0:
+            return None
+        now = time.time()
+        if self._cache_name is not None and now < self._cache_expires - 60:
+            return self._cache_name
+        if now < self._cache_retry_at:
+            return None
+        async with self._cache_lock:
+            if self._cache_name is not None and time.time() < self._cache_expires - 60:
+                return self._cache_name
+            from google.genai import types
+            try:
+                cache = await self.client.aio.caches.create(
+                    model=self.model,
+                    config=types.CreateCachedContentConfig(
+                        contents=[types.Content(role='user', parts=[types.Part(text=PROMPT)])],
+                        ttl=f"{self.cache_ttl}s",
+                        display_name=f"svg-prompt-v{PROMPT_VERSION}",
+                    ),
+                )
+                self._cache_name = cache.name
+                self._cache_expires = time.time() + self.cache_ttl
+                self.stats["cache_creates"] += 1
+                logger.info(f"🗂️ Cached PROMPT as {cache.name}")
+            except Exception as e:
+                self._cache_name = None
+                self._cache_retry_at = time.time() + 300
+                self.stats["cache_errors"] += 1
+                logger.warning(f"Prompt caching unavailable, sending PROMPT inline: {str(e)}")
+        return self._cache_name
+
+    def _request(self, request_text: str, image: bytes, cache_name: Optional[str]) -> Dict:
+        from google.genai import types
+        image_part = types.Part.from_bytes(data=image, mime_type='image/jpeg')
+        if cache_name is None:
+            self.stats["inline_calls"] += 1
+            return {"model": self.model, "contents": [full_prompt(request_text), image_part]}
+        self.stats["cached_calls"] += 1
+        return {
+            "model": self.model,
+            "contents": [request_text, image_part] if request_text else [image_part],
+            "config": types.GenerateContentConfig(cached_content=cache_name),
+        }
+
+    def _cache_gone(self, error: Exception, cache_name: Optional[str]) -> bool:
+        """
+        Whether a failed call used a cache entry that has since expired or
+        been deleted, in which case the call is retried inline once
+        """
+        from google.genai import errors as genai_errors
+        if cache_name is None or not isinstance(error, genai_errors.ClientError):
+            return False
+        # The call names only the model and the cache entry; a cache that has
+        # expired or been deleted is reported as one of these
+        if error.status not in ('NOT_FOUND', 'FAILED_PRECONDITION') and error.code != 404:
+            return False
+        self._cache_name = None
+        return True
+
+    async def generate(self, request_text: str, image: bytes, mode: str = "svg") -> str:
+        if mode == "layout":
+            return await self._generate_layout(request_text, image)
+        cache_name = await self._prompt_cache()
         try:
-            png_data = cairosvg.svg2png(
-                bytestring=clean_svg.encode('utf-8'),
-                output_width=400,
-                output_height=300,
-                scale=1.0,
-                unsafe=True
-            )
-            
-            # Convert PNG to JPG for React Native
-            png_image = Image.open(BytesIO(png_data))
-            
-            if png_image.mode in ('RGBA', 'LA', 'P'):
-                white_bg = Image.new('RGB', png_image.size, (255, 255, 255))
-                if png_image.mode == 'P':
-                    png_image = png_image.convert('RGBA')
-                white_bg.paste(png_image, mask=png_image.split()[-1] if png_image.mode == 'RGBA' else None)
-                jpg_image = white_bg
-            else:
-                jpg_image = png_image.convert('RGB')
-            
-            jpg_buffer = BytesIO()
-            jpg_image.save(jpg_buffer, format='JPEG', quality=85, optimize=True)
-            jpg_data = jpg_buffer.getvalue()
-            
-            # Store as base64 for React Native
-            images['jpg'] = base64.b64encode(jpg_data).decode('utf-8')
-            images['png'] = base64.b64encode(png_data).decode('utf-8')
-            
+            response = await self.client.aio.models.generate_content(**self._request(request_text, image, cache_name))
         except Exception as e:
-            logger.error(f"Error creating preview image: {str(e)}")
-            # Create simple fallback image
-            fallback_img = Image.new('RGB', (400, 300), (240, 240, 240))
-            fallback_buffer = BytesIO()
-            fallback_img.save(fallback_buffer, format='JPEG', quality=75)
-            fallback_data = fallback_buffer.getvalue()
-            images['jpg'] = base64.b64encode(fallback_data).decode('utf-8')
-            images['png'] = base64.b64encode(fallback_data).decode('utf-8')
-        
-        # Store SVG
-        images['svg'] = clean_svg
-        
-        return images
-        
-    except Exception as e:
-        logger.error(f"Error in create_mobile_optimized_images: {str(e)}")
+            if not self._cache_gone(e, cache_name):
+                raise
+            response = await self.client.aio.models.generate_content(**self._request(request_text, image, None))
+        return response.text
+
+    async def stream(self, request_text: str, image: bytes) -> AsyncIterator[str]:
+        cache_name = await self._prompt_cache()
+        try:
+            stream = await self.client.aio.models.generate_content_stream(**self._request(request_text, image, cache_name))
+        except Exception as e:
+            if not self._cache_gone(e, cache_name):
+                raise
+            stream = await self.client.aio.models.generate_content_stream(**self._request(request_text, image, None))
+        async for chunk in stream:
+            if chunk.text:
+                yield chunk.text
+
+    async def _generate_layout(self, request_text: str, image: bytes) -> str:
+        # LAYOUT_PROMPT is too short for explicit caching; ask for JSON output
+        from google.genai import types
+        self.stats["layout_calls"] += 1
+        response = await self.client.aio.models.generate_content(
+            model=self.model,
+            contents=[f"{LAYOUT_PROMPT}\n\n{request_text}" if request_text else LAYOUT_PROMPT,
+                      types.Part.from_bytes(data=image, mime_type='image/jpeg')],
+            config=types.GenerateContentConfig(response_mime_type='application/json'),
+        )
+        return response.text
+
+    async def refine(self, prompt_text: str, image: Optional[bytes]) -> str:
+        from google.genai import types
+        contents = [prompt_text]
+        if image is not None:
+            contents.append(types.Part.from_bytes(data=image, mime_type='image/jpeg'))
+        self.stats["refine_calls"] += 1
+        response = await self.client.aio.models.generate_content(model=self.model, contents=contents)
+        return response.text
+
+    async def close(self):
+        if self._client is None:
+            return
+        if self._cache_name is not None:
+            try:
+                await self.client.aio.caches.delete(name=self._cache_name)
+            except Exception as e:
+                logger.warning(f"Could not delete prompt cache: {str(e)}")
+            self._cache_name = None
+        await self.client.aio.aclose()
+
+    def retryable(self, error: Exception) -> bool:
+        import httpx
+        from google.genai import errors as genai_errors
+        if isinstance(error, genai_errors.ServerError):
+            return True
+        if isinstance(error, genai_errors.ClientError):
+            return error.code in (408, 429)
+        return isinstance(error, httpx.TransportError) or super().retryable(error)
+
+    def snapshot(self) -> Dict:
+        return {**super().snapshot(), **self.stats, "prompt_cache": self._cache_name}
+
+class FakeBackend(LLMBackend):
+    """
+    Deterministic offline stand-in for load and throughput tests. Returns one
+    of a set of canned SVGs, picked by hashing the request, after a fixed
+    latency, or LAYOUT_EXAMPLE in layout mode; streaming spreads that latency
+    evenly over the chunks. Slow and failing calls can be injected at random.
+    """
+    name = "fake LLM"
+    model = "fake"
+
+    def __init__(self, latency: float, chunk_size: int, svg_dir: str = "",
+                 slow_rate: float = 0.0, slow_latency: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate
+        self.chunk_size = max(chunk_size, 1)
+        self.svgs = []
+        if svg_dir:
+            for filename in sorted(os.listdir(svg_dir)):
+                if filename.endswith(('.svg', '.txt')):
+                    with open(os.path.join(svg_dir, filename), encoding='utf-8') as f:
+                        self.svgs.append(f.read())
+        if not self.svgs:
+            self.svgs.append(PROMPT[PROMPT.index('<svg'):PROMPT.index('</svg>') + len('</svg>')])
+        self.stats = {"calls": 0, "refines": 0, "slow": 0, "errors": 0}
+
+    async def _upstream_latency(self) -> float:
+        """
+        Latency of this call, failing it instead at error_rate
+        """
+        if random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            await asyncio.sleep(self.latency / 10)
+            raise ConnectionError("Fake upstream error")
+        if random.random() < self.slow_rate:
+            self.stats["slow"] += 1
+            return self.slow_latency
+        return self.latency
+
+    def _pick(self, request_text: str, image: bytes) -> str:
+        digest = hashlib.sha256(image + request_text.encode('utf-8')).digest()
+        self.stats["calls"] += 1
+        return self.svgs[int.from_bytes(digest[:4], 'big') % len(self.svgs)]
+
+    async def generate(self, request_text: str, image: bytes, mode: str = "svg") -> str:
+        svg = self._pick(request_text, image)
+        if mode == "layout":
+            svg = json.dumps(LAYOUT_EXAMPLE)
+        await asyncio.sleep(await self._upstream_latency())
+        return svg
+
+    async def stream(self, request_text: str, image: bytes) -> AsyncIterator[str]:
+        svg = self._pick(request_text, image)
+        chunks = [svg[i:i + self.chunk_size] for i in range(0, len(svg), self.chunk_size)]
+        latency = await self._upstream_latency()
+        for chunk in chunks:
+            await asyncio.sleep(latency / len(chunks))
+            yield chunk
+
+    async def refine(self, prompt_text: str, image: Optional[bytes]) -> str:
+        # Hands back the SVG it was given, unchanged
+        self.stats["refines"] += 1
+        await asyncio.sleep(await self._upstream_latency())
+        match = re.search(r'<svg\b.*?</svg>', prompt_text, re.DOTALL)
+        return f"```svg\n{match.group(0) if match else self.svgs[0]}\n```"
+
+    def snapshot(self) -> Dict:
+        return {**super().snapshot(), **self.stats, "latency": self.latency, "canned_svgs": len(self.svgs)}
+
+def create_llm_backend(kind: str) -> LLMBackend:
+    if kind == "gemini":
+        return GeminiBackend(GEMINI_API_KEY, GEMINI_MODEL, PROMPT_CACHE_TTL)
+    if kind == "fake":
+        return FakeBackend(
+            FAKE_LLM_LATENCY, FAKE_LLM_CHUNK_SIZE, FAKE_LLM_SVG_DIR,
+            FAKE_LLM_SLOW_RATE, FAKE_LLM_SLOW_LATENCY, FAKE_LLM_ERROR_RATE,
+        )
+    raise ValueError(f"Unknown LLM_BACKEND: {kind}")
+
+llm_backend = create_llm_backend(LLM_BACKEND)
+
+# Tail-latency control for model calls. Each attempt has LLM_ATTEMPT_TIMEOUT
+# (for streams: between chunks) and the whole call LLM_DEADLINE, including
+# retries. An attempt still running at the LLM_HEDGE_PERCENTILE latency of
+# recent calls gets a hedged duplicate (0 disables hedging).
+LLM_ATTEMPT_TIMEOUT = float(os.getenv("LLM_ATTEMPT_TIMEOUT", "60"))
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "120"))
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "2"))
+LLM_RETRY_BACKOFF = float(os.getenv("LLM_RETRY_BACKOFF", "0.5"))
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_CIRCUIT_FAILURES = int(os.getenv("LLM_CIRCUIT_FAILURES", "5"))
+LLM_CIRCUIT_COOLDOWN = float(os.getenv("LLM_CIRCUIT_COOLDOWN", "30"))
+
+class CircuitOpen(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Circuit open, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+class DeadlineExceeded(Exception):
+    pass
+
+class CircuitBreaker:
+    """
+    Fails calls fast after `threshold` consecutive transient failures. Once
+    `cooldown` has passed a single trial call is let through; its outcome
+    closes the circuit or opens it again.
+    """
+    STATES = ("closed", "half_open", "open")
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial = False
+        self.stats = {"opened": 0, "rejected": 0}
+        LLM_CIRCUIT_STATE.set(0)
+
+    def _set(self, state: str):
+        if state != self.state:
+            logger.warning(f"⚡ Model circuit {self.state} -> {state}")
+        self.state = state
+        LLM_CIRCUIT_STATE.set(self.STATES.index(state))
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+            self._set("half_open")
+        if self.state == "closed":
+            return True
+        if self.state == "half_open" and not self._trial:
+            self._trial = True
+            return True
+        self.stats["rejected"] += 1
+        LLM_CIRCUIT_REJECTIONS.inc()
+        return False
+
+    def record(self, ok: bool):
+        self._trial = False
+        if ok:
+            self.failures = 0
+            self._set("closed")
+            return
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+            self.stats["opened"] += 1
+            self._set("open")
+
+    def abandon(self):
+        """
+        An allowed call ended without saying anything about backend health
+        (cancelled, or failed for its own reasons)
+        """
+        self._trial = False
+
+    def snapshot(self) -> Dict:
+        return {"state": self.state, "consecutive_failures": self.failures, **self.stats}
+
+class LLMCallPolicy:
+    """
+    Deadlines, hedged requests, jittered retries and a circuit breaker around
+    calls to an LLM backend. Only transient failures (timeouts, upstream 5xx,
+    rate limits, connection errors) are retried or count against the circuit.
+    """
+
+    def __init__(self, backend: LLMBackend, breaker: CircuitBreaker, attempt_timeout: float, deadline: float,
+                 retries: int, backoff: float, hedge_percentile: float, hedge_min_samples: int):
+        self.backend = backend
+        self.breaker = breaker
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies = deque(maxlen=200)
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "deadline_exceeded": 0}
+
+    def hedge_delay(self) -> Optional[float]:
+        """
+        How long an attempt runs before it is hedged, or None if not hedging
+        """
+        if self.hedge_percentile <= 0 or len(self.latencies) < self.hedge_min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[max(1, math.ceil(self.hedge_percentile / 100 * len(ordered))) - 1]
+
+    def _admit(self, deadline: float) -> float:
+        """
+        Check the circuit before an attempt; returns the attempt's timeout
+        """
+        if not self.breaker.allow():
+            raise CircuitOpen(self.breaker.retry_after())
+        timeout = min(self.attempt_timeout, deadline - asyncio.get_running_loop().time())
+        if timeout <= 0:
+            self.breaker.abandon()
+            self.stats["deadline_exceeded"] += 1
+            LLM_DEADLINE_EXCEEDED.inc()
+            raise DeadlineExceeded("Model call deadline exceeded")
+        return timeout
+
+    def _after_failure(self, error: Exception, attempt: int, deadline: float) -> float:
+        """
+        Account for a failed attempt and return the backoff before retrying;
+        re-raises when the error is permanent or retries or time ran out
+        """
+        timed_out = isinstance(error, asyncio.TimeoutError)
+        LLM_ATTEMPTS.labels("timeout" if timed_out else "error").inc()
+        if not timed_out and not self.backend.retryable(error):
+            self.breaker.abandon()
+            raise error
+        self.breaker.record(False)
+        # Full jitter keeps clients that failed together from retrying together
+        delay = random.uniform(0, self.backoff * 2 ** attempt)
+        if attempt >= self.retries or asyncio.get_running_loop().time() + delay >= deadline:
+            if timed_out:
+                self.stats["deadline_exceeded"] += 1
+                LLM_DEADLINE_EXCEEDED.inc()
+                raise DeadlineExceeded("Model call timed out") from error
+            raise error
+        self.stats["retries"] += 1
+        LLM_RETRIED.inc()
+        logger.warning(f"🔁 Model call failed ({type(error).__name__}), retry {attempt + 1} in {delay:.2f}s")
+        return delay
+
+    def _succeeded(self, seconds: float):
+        self.breaker.record(True)
+        self.latencies.append(seconds)
+        LLM_ATTEMPTS.labels("ok").inc()
+
+    async def call(self, make_call):
+        """
+        Run make_call(), a coroutine factory, under the policy
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        self.stats["calls"] += 1
+        for attempt in range(self.retries + 1):
+            timeout = self._admit(deadline)
+            start = loop.time()
+            try:
+                result = await self._hedged(make_call, timeout)
+            except asyncio.CancelledError:
+                self.breaker.abandon()
+                raise
+            except Exception as e:
+                await asyncio.sleep(self._after_failure(e, attempt, deadline))
+                continue
+            self._succeeded(loop.time() - start)
+            return result
+
+    async def _hedged(self, make_call, timeout: float):
+        """
+        One attempt: the first request, plus a duplicate once it has run for
+        the hedge delay. The first success wins and the other is cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        end = loop.time() + timeout
+        delay = self.hedge_delay()
+        hedge_at = loop.time() + delay if delay is not None and delay < timeout else None
+        primary = asyncio.ensure_future(make_call())
+        tasks, pending = [primary], {primary}
+        error = None
+        try:
+            while True:
+                wait_until = hedge_at if hedge_at is not None else end
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(0.0, wait_until - loop.time()), return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.stats["hedge_wins"] += 1
+                            LLM_HEDGES.labels("won").inc()
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    raise error
+                if hedge_at is not None and loop.time() >= hedge_at:
+                    hedge_at = None
+                    self.stats["hedges"] += 1
+                    LLM_HEDGES.labels("sent").inc()
+                    hedge = asyncio.ensure_future(make_call())
+                    tasks.append(hedge)
+                    pending.add(hedge)
+                elif loop.time() >= end:
+                    raise asyncio.TimeoutError()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def stream(self, open_stream, is_complete=lambda: False) -> AsyncIterator[str]:
+        """
+        Relay open_stream(), an async iterator factory, under the policy.
+        Streams are not hedged, and are only retried before the first chunk.
+        A consumer that closes the stream early once is_complete() is true,
+        having read all it needs, counts as a success.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        self.stats["calls"] += 1
+        for attempt in range(self.retries + 1):
+            timeout = self._admit(deadline)
+            start = loop.time()
+            started = False
+            chunks = open_stream()
+            try:
+                while True:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError()
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), min(timeout, remaining))
+                    except StopAsyncIteration:
+                        break
+                    started = True
+                    yield chunk
+            except GeneratorExit:
+                if started and is_complete():
+                    self._succeeded(loop.time() - start)
+                else:
+                    self.breaker.abandon()
+                raise
+            except asyncio.CancelledError:
+                self.breaker.abandon()
+                raise
+            except Exception as e:
+                delay = self._after_failure(e, self.retries if started else attempt, deadline)
+                await asyncio.sleep(delay)
+                continue
+            finally:
+                await chunks.aclose()
+            self._succeeded(loop.time() - start)
+            return
+
+    def snapshot(self) -> Dict:
+        delay = self.hedge_delay()
         return {
-            'svg': validate_and_clean_svg(''),
-            'jpg': '',
-            'png': ''
+            **self.stats,
+            "hedge_delay": round(delay, 3) if delay is not None else None,
+            "circuit": self.breaker.snapshot(),
         }
 
-@app.post("/generate-svg")
-async def generate_svg(
-    text: str = Form(""),
-    image: UploadFile = File(...)
-):
+llm_policy = LLMCallPolicy(
+    llm_backend, CircuitBreaker(LLM_CIRCUIT_FAILURES, LLM_CIRCUIT_COOLDOWN),
+    LLM_ATTEMPT_TIMEOUT, LLM_DEADLINE, LLM_RETRIES, LLM_RETRY_BACKOFF,
+    LLM_HEDGE_PERCENTILE, LLM_HEDGE_MIN_SAMPLES,
+)
+
+# SVG sanitizing. Model output is cleaned in a single forward pass that can be
+# fed the whole response at once or chunk by chunk as it streams in.
+SVG_NAMESPACE = "http://www.w3.org/2000/svg"
+XLINK_NAMESPACE = "http://www.w3.org/1999/xlink"
+DEFAULT_VIEWBOX = "0 0 1200 800"
+ERROR_SVG = '<svg width="100%" height="auto" viewBox="0 0 1200 800" xmlns="http://www.w3.org/2000/svg"><text x="100" y="100" font-size="16" fill="#000">SVG Generation Error</text></svg>'
+
+# Elements that only ever contain animation or metadata children. When the
+# model leaves one of these open it is closed in place instead of swallowing
+# its siblings.
+SVG_LEAF_ELEMENTS = frozenset({
+    'path', 'rect', 'circle', 'ellipse', 'line', 'polyline', 'polygon', 'image', 'use', 'stop',
+    'feBlend', 'feColorMatrix', 'feComposite', 'feDropShadow', 'feFlood', 'feFuncA', 'feFuncB',
+    'feFuncG', 'feFuncR', 'feGaussianBlur', 'feImage', 'feMergeNode', 'feMorphology', 'feOffset',
+    'feTile', 'feTurbulence',
+})
+SVG_LEAF_CHILDREN = frozenset({'title', 'desc', 'animate', 'animateMotion', 'animateTransform', 'set', 'mpath'})
+
+_SVG_ROOT_RE = re.compile(r'<svg[\s>/]')
+_FENCE_START_RE = re.compile(r'^```(svg|xml)?\s*')
+_FENCE_END_RE = re.compile(r'\s*```$')
+_BARE_AMP_RE = re.compile(r'&(?!(?:amp|lt|gt|quot|apos|#[0-9]+|#x[0-9a-fA-F]+);)')
+_CONTROL_CHARS_RE = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+_TAG_BODY_RE = re.compile(r'(?:[^<>"\']+|"[^"<]*"|\'[^\'<]*\')*')
+_TAG_STOP_RE = re.compile(r'[<>]')
+_NAME_RE = re.compile(r'[A-Za-z_][\w.:-]*')
+_ATTR_RE = re.compile(r'([^\s=/<>"\']+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'<>]+)))?')
+_LENGTH_RE = re.compile(r'^\s*([0-9.]+)\s*(px)?\s*$')
+# Start tags whose attributes are already well-formed are copied through as-is
+_CLEAN_START_TAG_RE = re.compile(r'<([A-Za-z_][\w.-]*)((?:\s+[A-Za-z_][\w.-]*\s*=\s*"[^"<&\x00-\x08\x0b\x0c\x0e-\x1f]*")*)\s*(/?)>')
+_END_TAG_RE = re.compile(r'</([A-Za-z_][\w.:-]*)\s*>')
+_CLEAN_ATTR_NAME_RE = re.compile(r'([\w.-]+)\s*=')
+_TEXT_NEEDS_ESCAPE_RE = re.compile(r'[&<\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def _escape_text(text: str) -> str:
+    if _TEXT_NEEDS_ESCAPE_RE.search(text) is None:
+        return text
+    return _BARE_AMP_RE.sub('&amp;', _CONTROL_CHARS_RE.sub('', text)).replace('<', '&lt;')
+
+def _escape_attr(value: str) -> str:
+    return _escape_text(value).replace('"', '&quot;')
+
+class SVGSanitizer:
     """
-    Main endpoint for React Native app
-    Returns JSON exactly as React Native expects
+    Incremental, single-pass SVG repair. Strips markdown fences and any text
+    around the root element, rewrites root attributes for mobile, escapes bare
+    entities and balances tags. feed() returns the sanitized text produced so
+    far and close() flushes the rest; `complete` turns True once the root
+    element has been closed.
     """
-    try:
-        logger.info(f"📱 React Native request received")
-        logger.info(f"📝 Text: {text[:100] if text else 'None'}")
-        logger.info(f"🖼️ Image: {image.filename}")
-        
-        # Validate image
-        if not image.content_type or not image.content_type.startswith('image/'):
-            raise HTTPException(400, detail="File must be an image")
-        
-        # Read image
-        image_bytes = await image.read()
-        
-        # Validate size (10MB max)
-        MAX_SIZE = 10 * 1024 * 1024
-        if len(image_bytes) > MAX_SIZE:
-            raise HTTPException(400, detail="Image too large (max 10MB)")
-        
-        pil_image = Image.open(BytesIO(image_bytes))
-        if pil_image.mode in ('RGBA', 'LA', 'P'):
-            pil_image = pil_image.convert('RGB')
-        
-        # Prepare prompt
-        full_prompt = PROMPT
-        if text and text.strip():
-            full_prompt = f"{PROMPT}\n\nAdditional context: {text}"
+
+    def __init__(self):
+        self.started = False
+        self.complete = False
+        self._buf = ""
+        self._preamble = []
+        self._stack = []
+        self._out = []
+        self._held = None
+        self._held_ws = []
+        self._prefixes = {'xml', 'xmlns'}
+
+    def feed(self, chunk: str) -> str:
+        if self.complete:
+            return ""
+        mark = len(self._out)
+        self._buf += chunk
+        self._process(final=False)
+        return ''.join(self._out[mark:])
+
+    def close(self) -> str:
+        if not self.started:
+            # No <svg> at all: wrap whatever the model said in a default root
+            text = (''.join(self._preamble) + self._buf).strip()
+            text = _FENCE_END_RE.sub('', _FENCE_START_RE.sub('', text)).strip()
+            self.__init__()
+            self._buf = f'<svg width="100%" height="auto" viewBox="{DEFAULT_VIEWBOX}" xmlns="{SVG_NAMESPACE}">{text}</svg>'
+        mark = len(self._out)
+        if not self.complete:
+            self._process(final=True)
+            self._release_held(as_container=False)
+            while self._stack:
+                self._out.append(f'</{self._stack.pop()}>')
+            self.complete = True
+        self._buf = ""
+        return ''.join(self._out[mark:])
+
+    def _process(self, final: bool):
+        buf = self._buf
+        pos = 0
+        if not self.started:
+            match = _SVG_ROOT_RE.search(buf)
+            if match is None:
+                # Keep a short tail in case "<svg" is split across chunks
+                cut = len(buf) if final else max(len(buf) - 4, 0)
+                self._preamble.append(buf[:cut])
+                self._buf = buf[cut:]
+                return
+            self._preamble.append(buf[:match.start()])
+            pos = match.start()
+            self.started = True
         
-        logger.info("🤖 Calling Gemini...")
+        length = len(buf)
+        while pos < length and not self.complete:
+            lt = buf.find('<', pos)
+            if lt == -1:
+                if final:
+                    self._text(buf[pos:])
+                    pos = length
+                break
+            if lt > pos:
+                self._text(buf[pos:lt])
+                pos = lt
+            if lt + 1 >= length:
+                if final:
+                    pos = length
+                break
+            
+            nxt = buf[lt + 1]
+            if nxt == '!' or nxt == '?':
+                end = self._markup_declaration(buf, lt, final)
+            elif nxt == '/' or nxt.isalpha() or nxt == '_':
+                end = self._tag(buf, lt, final)
+            else:
+                # A literal "<" in text such as "x < 5"
+                self._text('<')
+                end = lt + 1
+            if end == -1:
+                break
+            pos = end
         
-        # Call Gemini - unchanged model
-        response = client.models.generate_content(
-            model="gemini-2.5-flash-image",
-            contents=[full_prompt, pil_image],
-        )
+        self._buf = buf[pos:] if not self.complete else ""
+
+    def _markup_declaration(self, buf: str, lt: int, final: bool) -> int:
+        if buf.startswith('<!--', lt):
+            close = buf.find('-->', lt + 4)
+            if close == -1:
+                if not final:
+                    return -1
+                close = len(buf)
+            body = buf[lt + 4:close].replace('--', '- -').rstrip('-')
+            self._emit(f'<!--{body}-->')
+            return min(close + 3, len(buf))
+        if buf.startswith('<![CDATA[', lt):
+            close = buf.find(']]>', lt + 9)
+            if close == -1:
+                if not final:
+                    return -1
+                close = len(buf)
+            self._emit(f'<![CDATA[{buf[lt + 9:close]}]]>')
+            return min(close + 3, len(buf))
+        if not final and len(buf) - lt < 9 and ('<![CDATA['.startswith(buf[lt:]) or '<!--'.startswith(buf[lt:])):
+            return -1
+        # DOCTYPE, processing instructions and other declarations are dropped
+        close = buf.find('>', lt)
+        if close == -1:
+            return -1 if not final else len(buf)
+        return close + 1
+
+    def _tag(self, buf: str, lt: int, final: bool) -> int:
+        if buf[lt + 1] == '/':
+            end_tag = _END_TAG_RE.match(buf, lt)
+            if end_tag is not None:
+                self._end_tag(end_tag.group(1))
+                return end_tag.end()
+        elif self._out:
+            clean = _CLEAN_START_TAG_RE.match(buf, lt)
+            if clean is not None:
+                names = _CLEAN_ATTR_NAME_RE.findall(clean.group(2))
+                if len(names) == len(set(names)):
+                    self._start_tag(clean.group(1), clean.group(2), clean.group(3) == '/')
+                    return clean.end()
         
-        svg_text = response.text
+        body_end = _TAG_BODY_RE.match(buf, lt + 1).end()
+        open_quote = ''
+        if body_end < len(buf) and buf[body_end] in '"\'':
+            # Unbalanced quote: the tag ends at the next > or <
+            stop = _TAG_STOP_RE.search(buf, body_end)
+            if stop is None:
+                open_quote = buf[body_end]
+            body_end = stop.start() if stop else len(buf)
+        if body_end >= len(buf) and not final:
+            # Tag still streaming in
+            return -1
+        terminated = body_end < len(buf) and buf[body_end] == '>'
+        end = body_end + 1 if terminated else body_end
+        # A response cut off inside an attribute value keeps what it has so far
+        body = buf[lt + 1:body_end] + open_quote
         
-        if not svg_text:
-            raise HTTPException(500, detail="Gemini returned empty response")
+        if body.startswith('/'):
+            name = _NAME_RE.match(body, 1)
+            if name is not None:
+                self._end_tag(name.group())
+            return end
         
-        logger.info(f"✅ Gemini response ({len(svg_text)} chars)")
+        name = _NAME_RE.match(body)
+        rest = body[name.end():].rstrip() if name is not None else ''
+        if name is None or (not terminated and rest and '=' not in rest):
+            # Not a tag after all, e.g. the "<b and" in "a<b and 3 <4"
+            self._text(buf[lt:end])
+            return end
+        if ':' in name.group() and name.group().split(':', 1)[0] not in self._prefixes:
+            # Unbound prefix: drop the tag and keep its content
+            return end
+        # A tag cut off by the next "<" is treated as if it had been closed
+        self_closing = rest.endswith('/')
+        if self_closing:
+            rest = rest[:-1]
+        self._start_tag(name.group(), self._attributes(rest), self_closing)
+        return end
+
+    def _attributes(self, raw: str) -> str:
+        attrs = {}
+        for match in _ATTR_RE.finditer(raw):
+            key = match.group(1)
+            if not _NAME_RE.fullmatch(key) or key in attrs:
+                continue
+            value = match.group(2)
+            if value is None:
+                value = match.group(3)
+            if value is None:
+                value = match.group(4)
+            if value is None:
+                continue
+            attrs[key] = value
         
-        # Create images for React Native
-        logger.info("🖼️ Creating images...")
-        images = create_mobile_optimized_images(svg_text)
+        if not self._out:
+            self._root_attributes(attrs)
+            # Only root declarations are in scope everywhere; prefixes
+            # declared further down are treated as unbound
+            for key in [k for k in attrs if k.startswith('xmlns:')]:
+                self._prefixes.add(key[6:])
+        parts = []
+        for key, value in attrs.items():
+            if ':' in key and key.split(':', 1)[0] not in self._prefixes:
+                continue
+            parts.append(f' {key}="{_escape_attr(value)}"')
+        return ''.join(parts)
+
+    def _root_attributes(self, attrs: Dict):
+        if 'viewBox' not in attrs:
+            width = _LENGTH_RE.match(attrs.get('width', ''))
+            height = _LENGTH_RE.match(attrs.get('height', ''))
+            if width and height:
+                attrs['viewBox'] = f"0 0 {width.group(1)} {height.group(1)}"
+            else:
+                attrs['viewBox'] = DEFAULT_VIEWBOX
+        attrs['width'] = '100%'
+        attrs['height'] = 'auto'
+        attrs['preserveAspectRatio'] = 'xMidYMid meet'
+        attrs.setdefault('xmlns', SVG_NAMESPACE)
+        attrs.setdefault('xmlns:xlink', XLINK_NAMESPACE)
+
+    def _start_tag(self, name: str, attrs: str, self_closing: bool):
+        if self._held is not None:
+            self._release_held(as_container=name in SVG_LEAF_CHILDREN)
+        tag = f'<{name}{attrs}'
+        if self_closing:
+            self._emit(tag + '/>')
+            if not self._stack:
+                self.complete = True
+        elif name in SVG_LEAF_ELEMENTS and self._stack:
+            self._held = (name, tag)
+        else:
+            self._emit(tag + '>')
+            self._stack.append(name)
+
+    def _end_tag(self, name: str):
+        if self._held is not None:
+            if self._held[0] == name:
+                self._held_ws = []
+                self._release_held(as_container=False)
+                return
+            self._release_held(as_container=False)
+        if name not in self._stack:
+            return
+        while self._stack:
+            open_name = self._stack.pop()
+            self._out.append(f'</{open_name}>')
+            if open_name == name:
+                break
+        if not self._stack:
+            self.complete = True
+
+    def _text(self, text: str):
+        if self._held is not None:
+            if not text.strip():
+                self._held_ws.append(text)
+                return
+            self._release_held(as_container=True)
+        if self._stack:
+            self._out.append(_escape_text(text))
+
+    def _emit(self, markup: str):
+        if self._held is not None:
+            self._release_held(as_container=False)
+        self._out.append(markup)
+
+    def _release_held(self, as_container: bool):
+        if self._held is None:
+            return
+        name, tag = self._held
+        self._held = None
+        if as_container:
+            self._out.append(tag + '>')
+            self._stack.append(name)
+        else:
+            self._out.append(tag + '/>')
+        self._out.extend(self._held_ws)
+        self._held_ws = []
+
+def validate_and_clean_svg(svg_content: str) -> str:
+    """
+    Clean and validate SVG to ensure it's mobile-compatible and well-formed
+    """
+    try:
+        sanitizer = SVGSanitizer()
+        return sanitizer.feed(svg_content) + sanitizer.close()
         
-        # Return EXACTLY what React Native expects
-        return {
-            "svg": images.get('svg', ''),
-            "jpg": images.get('jpg', ''),  # This is what React Native uses for preview
+    except Exception as e:
+        logger.error(f"Error cleaning SVG: {str(e)}")
+        return ERROR_SVG
+
+# SVG optimizing. Runs after cleaning to cut the bytes sent to phones and
+# parsed by the rasterizer without changing how the drawing renders.
+SVG_OPTIMIZE = os.getenv("SVG_OPTIMIZE", "1") != "0"
+SVG_OPTIMIZE_PRECISION = int(os.getenv("SVG_OPTIMIZE_PRECISION", "2"))
+
+ET.register_namespace('', SVG_NAMESPACE)
+ET.register_namespace('xlink', XLINK_NAMESPACE)
+
+# Inherited presentation attributes that can move between an element and a
+# wrapping <g>. opacity, transforms and the like apply to the group as a whole
+# and are deliberately left out.
+SVG_INHERITED_ATTRIBUTES = frozenset({
+    'fill', 'fill-opacity', 'fill-rule', 'stroke', 'stroke-width', 'stroke-opacity',
+    'stroke-dasharray', 'stroke-linecap', 'stroke-linejoin', 'stroke-miterlimit',
+    'font-family', 'font-size', 'font-weight', 'font-style', 'text-anchor', 'letter-spacing',
+})
+# Elements that may be wrapped in a <g> together with their siblings
+SVG_GROUPABLE_ELEMENTS = frozenset({
+    'g', 'path', 'rect', 'circle', 'ellipse', 'line', 'polyline', 'polygon', 'text', 'use', 'image',
+})
+# Elements that are never drawn where they stand, only through a reference
+SVG_REFERENCED_ELEMENTS = frozenset({
+    'marker', 'linearGradient', 'radialGradient', 'pattern', 'clipPath', 'mask', 'symbol', 'filter',
+})
+# Whitespace inside these is content
+SVG_TEXT_ELEMENTS = frozenset({'text', 'tspan', 'textPath', 'style', 'script', 'foreignObject', 'title', 'desc'})
+SVG_NUMERIC_ATTRIBUTES = frozenset({
+    'x', 'y', 'x1', 'y1', 'x2', 'y2', 'cx', 'cy', 'r', 'rx', 'ry', 'dx', 'dy', 'width', 'height',
+    'd', 'points', 'stroke-width', 'font-size',
+})
+
+_SVG_TAG_PREFIX = f"{{{SVG_NAMESPACE}}}"
+_XLINK_HREF = f"{{{XLINK_NAMESPACE}}}href"
+_URL_REF_RE = re.compile(r'url\(\s*[\'"]?#([^)\'"\s]+)')
+_CSS_ID_RE = re.compile(r'#([A-Za-z_][\w-]*)')
+_DECIMAL_RE = re.compile(r'-?\d*\.\d+(?![\d.]*[eE])')
+_HEX_COLOR_RE = re.compile(r'^#([0-9a-fA-F])\1([0-9a-fA-F])\2([0-9a-fA-F])\3$')
+_SPACES_RE = re.compile(r'\s+')
+
+def _local_name(tag) -> str:
+    if not isinstance(tag, str):
+        return ''
+    return tag[len(_SVG_TAG_PREFIX):] if tag.startswith(_SVG_TAG_PREFIX) else tag
+
+def _round_decimal(match) -> str:
+    text = match.group(0)
+    if len(text) - text.index('.') - 1 <= SVG_OPTIMIZE_PRECISION:
+        return text
+    value = f"{round(float(text), SVG_OPTIMIZE_PRECISION):.{SVG_OPTIMIZE_PRECISION}f}".rstrip('0').rstrip('.')
+    return '0' if value in ('-0', '') else value
+
+def _minify_value(name: str, value: str) -> str:
+    if name in SVG_NUMERIC_ATTRIBUTES:
+        value = _DECIMAL_RE.sub(_round_decimal, _SPACES_RE.sub(' ', value.strip()))
+    elif name == 'transform':
+        # Matrix coefficients scale everything after them, so only spacing goes
+        value = _SPACES_RE.sub(' ', value.strip())
+    elif name in ('fill', 'stroke', 'stop-color', 'flood-color'):
+        value = _HEX_COLOR_RE.sub(r'#\1\2\3', value.strip()).lower() if value.startswith('#') else value
+    return value
+
+class SVGOptimizer:
+    """
+    Size optimizer for cleaned SVGs. Drops comments, formatting whitespace and
+    unreferenced defs/markers, rounds coordinates, removes presentation
+    attributes that repeat an inherited value and lifts ones shared by runs of
+    siblings onto a <g>. Documents with a <style> element keep their structure
+    so CSS selectors still match.
+    """
+
+    def __init__(self, clean_svg: str):
+        self.root = ET.fromstring(clean_svg)
+        self.parents = {child: parent for parent in self.root.iter() for child in parent}
+        self.has_stylesheet = any(_local_name(el.tag) == 'style' for el in self.root.iter())
+        self.referenced = set()
+
+    def optimize(self) -> str:
+        self._strip_whitespace(self.root)
+        self._drop_unused_definitions()
+        for el in self.root.iter():
+            for name, value in el.attrib.items():
+                el.set(name, _minify_value(name, value))
+        if not self.has_stylesheet:
+            self._group(self.root, {})
+        return ET.tostring(self.root, encoding='unicode')
+
+    def _strip_whitespace(self, el):
+        if _local_name(el.tag) in SVG_TEXT_ELEMENTS:
+            return
+        if el.text is not None and not el.text.strip():
+            el.text = None
+        for child in el:
+            if child.tail is not None and not child.tail.strip():
+                child.tail = None
+            self._strip_whitespace(child)
+
+    def _references(self, el):
+        """
+        Ids referenced from an element's attributes or stylesheet text
+        """
+        refs = set()
+        for name, value in el.attrib.items():
+            if name in ('href', _XLINK_HREF) and value.startswith('#'):
+                refs.add(value[1:])
+            elif 'url(' in value:
+                refs.update(_URL_REF_RE.findall(value))
+            elif name in ('begin', 'end'):
+                refs.update(part.split('.')[0].strip() for part in value.split(';'))
+        if _local_name(el.tag) == 'style' and el.text:
+            refs.update(_CSS_ID_RE.findall(el.text))
+        return refs
+
+    def _drop_unused_definitions(self):
+        candidates = {}
+        for el in self.root.iter():
+            name = _local_name(el.tag)
+            parent = self.parents.get(el)
+            in_defs = parent is not None and _local_name(parent.tag) == 'defs'
+            if (in_defs and name not in ('style', 'script')) or name in SVG_REFERENCED_ELEMENTS:
+                candidates.setdefault(el, None)
+        
+        def outside_candidates(el):
+            while el is not None:
+                if el in candidates:
+                    return False
+                el = self.parents.get(el)
+            return True
+        
+        # Everything drawn directly is live; definitions become live once
+        # something live refers to them, transitively
+        pending = [el for el in self.root.iter() if outside_candidates(el)]
+        by_id = {el.get('id'): el for el in self.root.iter() if el.get('id')}
+        while pending:
+            el = pending.pop()
+            for ref in self._references(el):
+                if ref in self.referenced:
+                    continue
+                self.referenced.add(ref)
+                target = by_id.get(ref)
+                if target is not None:
+                    pending.extend(target.iter())
+        
+        for el in candidates:
+            ids = {child.get('id') for child in el.iter()}
+            if ids.isdisjoint(self.referenced) and outside_candidates(self.parents.get(el)):
+                self.parents[el].remove(el)
+        for el in list(self.root.iter()):
+            if _local_name(el.tag) == 'defs' and len(el) == 0 and el in self.parents:
+                self.parents[el].remove(el)
+
+    def _movable(self, el) -> bool:
+        """
+        Whether an element's presentation attributes may move to a parent. A
+        <use>d element inherits from the <use>, and style="" overrides attributes.
+        """
+        return (
+            _local_name(el.tag) in SVG_GROUPABLE_ELEMENTS
+            and el.get('id') not in self.referenced
+            and 'style' not in el.attrib
+            and 'class' not in el.attrib
+        )
+
+    @staticmethod
+    def _shared(el):
+        # Relative sizes compound, so lifting one onto a group that already
+        # sets it would change the result
+        return {
+            (name, value) for name, value in el.attrib.items()
+            if name in SVG_INHERITED_ATTRIBUTES and 'inherit' not in value and 'currentColor' not in value
+            and not value.endswith(('%', 'em'))
+        }
+
+    def _group(self, el, inherited: Dict):
+        """
+        Optimize the children of an <svg> or <g>, given the attribute values
+        its ancestors are known to pass down
+        """
+        for child in el:
+            if not self._movable(child):
+                continue
+            for name in SVG_INHERITED_ATTRIBUTES & child.attrib.keys():
+                value = child.get(name)
+                # Relative font sizes compound, so they are never redundant
+                if inherited.get(name) == value and not value.endswith(('%', 'em')):
+                    del child.attrib[name]
+        
+        for child in el:
+            if _local_name(child.tag) in ('g', 'svg') and 'style' not in child.attrib and 'class' not in child.attrib:
+                passed = {**inherited, **{n: v for n, v in child.attrib.items() if n in SVG_INHERITED_ATTRIBUTES}}
+                self._group(child, passed)
+        self._wrap_runs(el)
+
+    def _wrap_runs(self, el):
+        """
+        Lift attributes shared by runs of siblings onto a <g>, then look for
+        narrower runs inside each new group
+        """
+        children = list(el)
+        i = 0
+        while i < len(children):
+            run, shared = self._run_from(children, i)
+            if len(run) == len(children) and _local_name(el.tag) == 'g' and self._movable(el):
+                # Every child agrees, so the existing group can carry it
+                self._lift(run, shared, el)
+                break
+            if len(run) > 1 and self._saving(run, shared) > 0:
+                group = ET.Element(f"{_SVG_TAG_PREFIX}g")
+                index = list(el).index(run[0])
+                for child in run:
+                    el.remove(child)
+                    group.append(child)
+                el.insert(index, group)
+                self._lift(run, shared, group)
+                self._wrap_runs(group)
+                i += len(run)
+            else:
+                i += 1
+
+    def _run_from(self, children, start):
+        run, shared = [], set()
+        for child in children[start:]:
+            if not self._movable(child):
+                break
+            narrowed = self._shared(child) if not run else shared & self._shared(child)
+            if not narrowed:
+                break
+            run.append(child)
+            shared = narrowed
+        return run, shared
+
+    @staticmethod
+    def _saving(run, shared) -> int:
+        attrs = sum(len(f' {name}="{value}"') for name, value in shared)
+        return attrs * (len(run) - 1) - len('<g></g>')
+
+    @staticmethod
+    def _lift(run, shared, group):
+        for name, value in sorted(shared):
+            group.set(name, value)
+            for child in run:
+                del child.attrib[name]
+
+def optimize_svg(clean_svg: str) -> str:
+    """
+    Shrink a cleaned SVG without changing its rendering; returns the input
+    unchanged if it cannot be optimized
+    """
+    if not SVG_OPTIMIZE:
+        return clean_svg
+    try:
+        return SVGOptimizer(clean_svg).optimize()
+    except Exception as e:
+        logger.error(f"Error optimizing SVG: {str(e)}")
+        return clean_svg
+
+# Running totals for /cache/stats
+optimizer_stats = {'documents': 0, 'bytes_in': 0, 'bytes_saved': 0}
+
+def clean_and_optimize_svg(svg_text: str) -> Dict:
+    """
+    Clean model output and optimize it, reporting the bytes the optimizer saved
+    """
+    return finish_svg(validate_and_clean_svg(svg_text))
+
+def finish_svg(clean_svg: str) -> Dict:
+    """
+    Optimize an already-cleaned SVG, reporting the bytes saved
+    """
+    svg = optimize_svg(clean_svg)
+    return {'svg': svg, 'svg_bytes_saved': len(clean_svg.encode('utf-8')) - len(svg.encode('utf-8'))}
+
+def record_optimization(images: Dict):
+    saved = images.get('svg_bytes_saved', 0)
+    size = len(images['svg'].encode('utf-8'))
+    optimizer_stats['documents'] += 1
+    optimizer_stats['bytes_in'] += size + saved
+    optimizer_stats['bytes_saved'] += saved
+    SVG_BYTES.labels('clean').observe(size + saved)
+    SVG_BYTES.labels('optimized').observe(size)
+    logger.info(f"🗜️ SVG optimized: {size + saved} → {size} bytes ({saved} saved)")
+
+# Local edits. Follow-up instructions simple enough to apply without the
+# model (thicker/thinner lines, bigger/smaller text, swapping one colour for
+# another) are applied directly to the session's SVG. Anything else, several
+# requests in one, or an edit narrowed to part of the diagram ("the arrow
+# from step 1", "the title") goes to the model.
+REFINE_LOCAL_EDITS = os.getenv("REFINE_LOCAL_EDITS", "1") != "0"
+LOCAL_EDIT_STROKE_FACTOR = 1.5
+LOCAL_EDIT_FONT_FACTOR = 1.2
+
+_THICKER_RE = re.compile(r'\b(thicker|bolder|heavier|wider)\b')
+_THINNER_RE = re.compile(r'\b(thinner|narrower|finer)\b')
+_LARGER_RE = re.compile(r'\b(bigger|larger|increase|enlarge)\b')
+_SMALLER_RE = re.compile(r'\b(smaller|decrease|shrink|reduce)\b')
+_TEXT_TARGET_RE = re.compile(r'\b(text|font|fonts|labels?|words|numbers|titles?)\b')
+_LINE_TARGET_RE = re.compile(r'\b(arrows?|lines?|connectors?)\b')
+_SHAPE_TARGET_RE = re.compile(r'\b(borders?|outlines?|boxes|box|cards?)\b')
+_COLOR_SWAP_RE = re.compile(
+    r'\b(?:change|replace|turn|recolou?r|swap|make)\s+(?:(?:the|all|every)\s+)*(#[0-9a-f]{3,6}|[a-z]+)'
+    r'(?:\s+[a-z]+)?\s+(?:to|into|with|for)\s+(#[0-9a-f]{3,6}|[a-z]+)\b'
+)
+_MULTIPLE_REQUESTS_RE = re.compile(r'\band\b|[;,\n]')
+# Prepositions, positions, numbers, quotes, demonstratives and singular
+# element names that limit an edit to some elements only
+_SCOPE_RE = re.compile(
+    r'\b(?:in|inside|within|from|of|on|at|for|to|between|near|under|above|below|beside|next|except|only|'
+    r'this|that|these|those|first|second|third|last|top|bottom|left|right|middle|'
+    r'steps?|cards?|title|heading|question|answer|table|rows?|columns?|options?|formula|equation|legend|'
+    r'label|box|arrow|line|connector|border|outline)\b|\d|["\']'
+)
+_EDIT_LENGTH_RE = re.compile(r'^\s*(\d*\.?\d+)\s*(px)?\s*$')
+
+# Subtrees that are only drawn by reference
+LOCAL_EDIT_SKIPPED = frozenset({'defs', 'marker', 'symbol', 'clipPath', 'mask', 'pattern'})
+LOCAL_EDIT_LINES = frozenset({'line', 'polyline', 'path'})
+LOCAL_EDIT_SHAPES = frozenset({'rect', 'circle', 'ellipse', 'polygon'})
+
+def _parse_length(value: str) -> Optional[float]:
+    match = _EDIT_LENGTH_RE.match(value)
+    return float(match.group(1)) if match else None
+
+def _format_number(value: float) -> str:
+    return f"{value:.2f}".rstrip('0').rstrip('.')
+
+def _parse_color(value: str):
+    from PIL import ImageColor
+    try:
+        return ImageColor.getrgb(value.strip())[:3]
+    except (ValueError, AttributeError):
+        return None
+
+def color_family(rgb) -> str:
+    """
+    Rough colour name of an RGB triple, so "red" matches #e74c3c as well
+    """
+    hue, saturation, value = colorsys.rgb_to_hsv(*(channel / 255 for channel in rgb))
+    if saturation < 0.15 or value < 0.15:
+        return 'black' if value < 0.2 else 'white' if value > 0.85 else 'gray'
+    hue *= 360
+    for limit, name in ((15, 'red'), (45, 'orange'), (70, 'yellow'), (170, 'green'), (255, 'blue'), (290, 'purple'), (345, 'pink')):
+        if hue < limit:
+            return name
+    return 'red'
+
+class SVGLocalEditor:
+    """
+    Applies one simple instruction to a cleaned SVG. Presentation attributes
+    may be inherited from a <g> (the optimizer lifts shared ones), so edits
+    compute each element's effective value and set it on the element itself.
+    """
+
+    def __init__(self, clean_svg: str):
+        self.root = ET.fromstring(clean_svg)
+
+    @staticmethod
+    def _style(el) -> Dict:
+        declarations = (part.split(':', 1) for part in el.get('style', '').split(';') if ':' in part)
+        return {name.strip(): value.strip() for name, value in declarations}
+
+    def _set(self, el, name: str, value: str):
+        # An inline style declaration would win over the attribute
+        style = self._style(el)
+        if name in style:
+            del style[name]
+            if style:
+                el.set('style', ';'.join(f"{key}:{val}" for key, val in style.items()))
+            else:
+                del el.attrib['style']
+        el.set(name, value)
+
+    def _walk(self, el, inherited: Dict):
+        values = {**inherited, **el.attrib, **self._style(el)}
+        yield el, values
+        for child in el:
+            if _local_name(child.tag) not in LOCAL_EDIT_SKIPPED:
+                yield from self._walk(child, values)
+
+    def scale_strokes(self, factor: float, elements: frozenset) -> int:
+        changed = 0
+        for el, values in list(self._walk(self.root, {})):
+            if _local_name(el.tag) not in elements or values.get('stroke', 'none') in ('none', 'transparent'):
+                continue
+            width = _parse_length(values.get('stroke-width', '1'))
+            if width is not None:
+                self._set(el, 'stroke-width', _format_number(width * factor))
+                changed += 1
+        return changed
+
+    def scale_text(self, factor: float) -> int:
+        changed = 0
+        for el, values in list(self._walk(self.root, {})):
+            name = _local_name(el.tag)
+            if name != 'text' and not (name in ('tspan', 'textPath') and 'font-size' in el.attrib):
+                continue
+            size = _parse_length(values.get('font-size', '16'))
+            if size is not None:
+                self._set(el, 'font-size', _format_number(size * factor))
+                changed += 1
+        return changed
+
+    def swap_color(self, source: str, target: str) -> int:
+        source_rgb, target_rgb = _parse_color(source), _parse_color(target)
+        if source_rgb is None or target_rgb is None:
+            return 0
+        exact = source.startswith('#')
+        replacement = '#%02x%02x%02x' % target_rgb
+        changed = 0
+        for el in self.root.iter():
+            values = {**el.attrib, **self._style(el)}
+            for name in ('fill', 'stroke', 'stop-color', 'flood-color'):
+                rgb = _parse_color(values.get(name, ''))
+                if rgb is None:
+                    continue
+                if rgb == source_rgb if exact else color_family(rgb) == color_family(source_rgb):
+                    self._set(el, name, replacement)
+                    changed += 1
+        return changed
+
+    def apply(self, instruction: str) -> int:
+        text = instruction.lower()
+        # Stylesheet rules could override the attributes set here
+        if _MULTIPLE_REQUESTS_RE.search(text) or any(_local_name(el.tag) == 'style' for el in self.root.iter()):
+            return 0
+        swap = _COLOR_SWAP_RE.search(text)
+        if _SCOPE_RE.search(text[:swap.start()] + text[swap.end():] if swap else text):
+            return 0
+        if swap:
+            return self.swap_color(swap.group(1), swap.group(2))
+        if _TEXT_TARGET_RE.search(text) and not _LINE_TARGET_RE.search(text):
+            if _LARGER_RE.search(text):
+                return self.scale_text(LOCAL_EDIT_FONT_FACTOR)
+            if _SMALLER_RE.search(text):
+                return self.scale_text(1 / LOCAL_EDIT_FONT_FACTOR)
+            return 0
+        elements = LOCAL_EDIT_LINES | LOCAL_EDIT_SHAPES
+        if _LINE_TARGET_RE.search(text) and not _SHAPE_TARGET_RE.search(text):
+            elements = LOCAL_EDIT_LINES
+        elif _SHAPE_TARGET_RE.search(text) and not _LINE_TARGET_RE.search(text):
+            elements = LOCAL_EDIT_SHAPES
+        if _THICKER_RE.search(text):
+            return self.scale_strokes(LOCAL_EDIT_STROKE_FACTOR, elements)
+        if _THINNER_RE.search(text):
+            return self.scale_strokes(1 / LOCAL_EDIT_STROKE_FACTOR, elements)
+        return 0
+
+def apply_local_edit(clean_svg: str, instruction: str) -> Optional[str]:
+    """
+    The SVG with the instruction applied, or None if it needs the model
+    """
+    try:
+        editor = SVGLocalEditor(clean_svg)
+        if editor.apply(instruction) == 0:
+            return None
+        return ET.tostring(editor.root, encoding='unicode')
+    except Exception as e:
+        logger.error(f"Error applying local edit: {str(e)}")
+        return None
+
+# Layout engine for GENERATION_MODE=layout: the question on the left, step
+# cards on the right and Manhattan arrows between them through a gutter with
+# one vertical channel per arrow. Text is measured with average glyph
+# widths, so placement is approximate, but the same spec always renders the
+# same SVG.
+LAYOUT_MARGIN = 30
+LAYOUT_LEFT_WIDTH = 760
+LAYOUT_CARD_X = 900
+LAYOUT_CARD_WIDTH = 470
+LAYOUT_CARD_GAP = 25
+LAYOUT_LINE_HEIGHT = 32
+LAYOUT_ROW_HEIGHT = 30
+LAYOUT_FONT = "Arial, sans-serif"
+LAYOUT_MATH_FONT = "Times New Roman, serif"
+# Stroke and text, fill, light border
+LAYOUT_COLORS = {
+    'red': ('#c62828', '#ffebee', '#ffcdd2'),
+    'blue': ('#0277bd', '#e3f2fd', '#90caf9'),
+    'green': ('#2e7d32', '#e8f5e9', '#a5d6a7'),
+    'orange': ('#ef6c00', '#fff3e0', '#ffcc80'),
+    'purple': ('#6a1b9a', '#f3e5f5', '#ce93d8'),
+    'gray': ('#555555', '#f5f5f5', '#cccccc'),
+}
+LAYOUT_COLOR_ALIASES = {'pink': 'red', 'grey': 'gray', 'yellow': 'orange'}
+LAYOUT_STEP_COLORS = ('blue', 'green', 'red', 'orange')
+# Deepest JSON nesting a spec may use (LAYOUT_EXAMPLE has 7); the text
+# and span walks recurse once per level
+LAYOUT_MAX_DEPTH = 16
+
+_LAYOUT_SCRIPT_RE = re.compile(r'([\^_])(\{[^}]*\}|[\w.]+)')
+_LAYOUT_WORD_RE = re.compile(r'\S+\s*|\s+')
+
+class LayoutError(ValueError):
+    """
+    The model's layout spec cannot be rendered
+    """
+
+def parse_layout(text: str) -> Dict:
+    """
+    Extract and check the JSON layout spec in a model response
+    """
+    start, end = text.find('{'), text.rfind('}')
+    if start < 0 or end < start:
+        raise LayoutError("no JSON object in response")
+    try:
+        spec = json.loads(text[start:end + 1])
+    except (json.JSONDecodeError, RecursionError) as e:
+        raise LayoutError(f"invalid JSON: {str(e)}") from e
+    if not isinstance(spec, dict) or not isinstance(spec.get("question"), list):
+        raise LayoutError("missing question blocks")
+    if _nesting_depth(spec) > LAYOUT_MAX_DEPTH:
+        raise LayoutError(f"nested deeper than {LAYOUT_MAX_DEPTH} levels")
+    if not isinstance(spec.get("steps", []), list):
+        raise LayoutError("steps must be a list")
+    return spec
+
+def _nesting_depth(value) -> int:
+    """
+    Levels of lists and objects in a parsed JSON value, counted without
+    recursing
+    """
+    depth, level = 0, [value]
+    while level:
+        depth += 1
+        level = [
+            child for item in level if isinstance(item, (dict, list))
+            for child in (item.values() if isinstance(item, dict) else item)
+        ]
+    return depth
+
+def text_width(text: str, size: float, bold: bool = False) -> float:
+    """
+    Approximate rendered width of text in Arial
+    """
+    width = 0.0
+    for char in text:
+        if char in " .,:;'!|()[]iljtf":
+            width += 0.3
+        elif char in "mwMW%@":
+            width += 0.85
+        elif char.isupper():
+            width += 0.68
+        else:
+            width += 0.55
+    return width * size * (1.08 if bold else 1.0)
+
+def _spans(value) -> List:
+    """
+    A text value as (text, span) pairs; span is None for plain text
+    """
+    if isinstance(value, dict):
+        return [(str(value.get("value", "")), value)]
+    if isinstance(value, list):
+        return [pair for item in value for pair in _spans(item)]
+    return [("" if value is None else str(value), None)]
+
+class LayoutEngine:
+    """
+    Renders one layout spec to SVG. Highlighted values and the goal block
+    register anchors by id; step cards then draw arrows from the anchors in
+    their "from" and dashed arrows back to the ones in their "to".
+    """
+
+    def __init__(self, spec: Dict):
+        self.spec = spec
+        self.anchors = {}
+        self.cards = []
+        self.root = ET.Element('svg', {'xmlns': SVG_NAMESPACE})
+        self.defs = self._add(self.root, 'defs')
+        self.markers = set()
+
+    @staticmethod
+    def _add(parent, tag: str, text: Optional[str] = None, **attrs):
+        el = ET.SubElement(parent, tag, {
+            name.replace('_', '-'): _format_number(value) if isinstance(value, (int, float)) else str(value)
+            for name, value in attrs.items()
+        })
+        if text is not None:
+            el.text = text
+        return el
+
+    @staticmethod
+    def _color(name, default: str = 'blue'):
+        name = str(name or default).lower()
+        return LAYOUT_COLORS.get(LAYOUT_COLOR_ALIASES.get(name, name), LAYOUT_COLORS[default])
+
+    def _marker(self, stroke: str) -> str:
+        marker_id = f"arrow-{stroke.lstrip('#')}"
+        if marker_id not in self.markers:
+            self.markers.add(marker_id)
+            marker = self._add(self.defs, 'marker', id=marker_id, markerWidth=8, markerHeight=8, refX=7, refY=4, orient='auto')
+            self._add(marker, 'path', d="M0,0 L8,4 L0,8", fill=stroke)
+        return f"url(#{marker_id})"
+
+    def _shadow(self):
+        shadow = self._add(self.defs, 'filter', id='shadow', x='-10%', y='-10%', width='120%', height='120%')
+        self._add(shadow, 'feGaussianBlur', **{'in': 'SourceAlpha', 'stdDeviation': 2})
+        self._add(shadow, 'feOffset', dx=2, dy=2, result='offsetblur')
+        self._add(self._add(shadow, 'feComponentTransfer'), 'feFuncA', type='linear', slope=0.2)
+        merge = self._add(shadow, 'feMerge')
+        self._add(merge, 'feMergeNode')
+        self._add(merge, 'feMergeNode', **{'in': 'SourceGraphic'})
+
+    def _highlight(self, parent, text: str, span: Dict, x: float, top: float, width: float, height: float, size: float):
+        stroke, fill, _ = self._color(span.get("color"))
+        self._add(parent, 'rect', x=x, y=top, width=width, height=height, rx=3, fill=fill, stroke=stroke, stroke_width=1.5)
+        self._add(parent, 'text', text, x=x + width / 2, y=top + height / 2 + size * 0.35, text_anchor='middle',
+                  font_weight='bold', fill=stroke)
+        if span.get("id"):
+            self.anchors[str(span["id"])] = {"box": (x, top, x + width, top + height), "gap": top + height + 4}
+
+    # Question (left zone)
+
+    def layout_question(self, parent) -> float:
+        y = LAYOUT_MARGIN
+        for block in self.spec["question"]:
+            if not isinstance(block, dict):
+                block = {"text": block}
+            if "heading" in block:
+                y = self.heading(parent, str(block["heading"]), y)
+            elif "table" in block:
+                y = self.table(parent, block["table"], y)
+            elif "options" in block:
+                y = self.options(parent, block, y)
+            else:
+                y = self.text_block(parent, block, y)
+            y += 10
+        return y
+
+    def heading(self, parent, text: str, y: float) -> float:
+        self._add(parent, 'text', text, x=LAYOUT_MARGIN, y=y + 22, font_size=20, font_weight='bold')
+        self._add(parent, 'line', x1=LAYOUT_MARGIN, y1=y + 32, x2=LAYOUT_MARGIN + LAYOUT_LEFT_WIDTH, y2=y + 32,
+                  stroke='#ccc', stroke_width=1)
+        return y + 40
+
+    def text_block(self, parent, block: Dict, y: float) -> float:
+        size = 15
+        bold = bool(block.get("bold"))
+        x0 = LAYOUT_MARGIN + 20 * int(block.get("indent") or 0) + (8 if block.get("goal") else 0)
+        right = LAYOUT_MARGIN + LAYOUT_LEFT_WIDTH - 8
+        lines, x = [[]], x0
+        for text, span in _spans(block.get("text", "")):
+            tokens = [(text, span)] if span is not None else [(word, None) for word in _LAYOUT_WORD_RE.findall(text)]
+            for token, token_span in tokens:
+                width = text_width(token, size, bold or token_span is not None) + (12 if token_span is not None else 0)
+                if x + width > right and lines[-1]:
+                    lines.append([])
+                    x = x0
+                    if token_span is None:
+                        token = token.lstrip()
+                        width = text_width(token, size, bold)
+                if token:
+                    lines[-1].append((token, token_span, x, width))
+                    x += width + (4 if token_span is not None else 0)
+
+        group = self._add(parent, 'g', font_size=size, **({'font-weight': 'bold'} if bold else {}))
+        bottom = y + len(lines) * LAYOUT_LINE_HEIGHT
+        if block.get("goal"):
+            extent = max((tokens[-1][2] + tokens[-1][3] for tokens in lines if tokens), default=x0)
+            stroke, fill, border = LAYOUT_COLORS['red']
+            box = (x0 - 8, y + 1, extent + 8, bottom - 1)
+            self._add(group, 'rect', x=box[0], y=box[1], width=box[2] - box[0], height=box[3] - box[1], rx=4,
+                      fill=fill, stroke=border, stroke_width=1.5)
+            self.anchors[str(block.get("id") or "goal")] = {"box": box, "gap": bottom + 5}
+        for index, tokens in enumerate(lines):
+            top = y + index * LAYOUT_LINE_HEIGHT
+            run, run_x = "", None
+            for token, span, x, width in tokens + [("", {}, None, 0)]:
+                if span is None:
+                    run_x = x if run_x is None else run_x
+                    run += token
+                    continue
+                if run.strip():
+                    self._add(group, 'text', run.rstrip(), x=run_x, y=top + 21)
+                run, run_x = "", None
+                if x is not None:
+                    self._highlight(group, token, span, x, top + 4, width, 24, size)
+        return bottom
+
+    def table(self, parent, rows, y: float) -> float:
+        size, pad = 14, 10
+        rows = [row if isinstance(row, list) else [row] for row in rows if row is not None]
+        if not rows:
+            return y
+        columns = max(len(row) for row in rows)
+        widths = [40.0] * columns
+        for row in rows:
+            for index, cell in enumerate(row):
+                pairs = _spans(cell)
+                highlighted = len(pairs) == 1 and pairs[0][1] is not None
+                text = "".join(text for text, _ in pairs)
+                widths[index] = max(widths[index], text_width(text, size, True) + 2 * pad + (12 if highlighted else 0))
+        if sum(widths) > LAYOUT_LEFT_WIDTH:
+            widths = [width * LAYOUT_LEFT_WIDTH / sum(widths) for width in widths]
+        lefts = [LAYOUT_MARGIN + sum(widths[:index]) for index in range(columns)]
+        total = sum(widths)
+        height = len(rows) * LAYOUT_ROW_HEIGHT
+
+        group = self._add(parent, 'g', font_size=size)
+        self._add(group, 'rect', x=LAYOUT_MARGIN, y=y, width=total, height=LAYOUT_ROW_HEIGHT, fill='#f5f5f5')
+        for index in range(1, len(rows)):
+            row_y = y + index * LAYOUT_ROW_HEIGHT
+            self._add(group, 'line', x1=LAYOUT_MARGIN, y1=row_y, x2=LAYOUT_MARGIN + total, y2=row_y, stroke='#ddd')
+        for left in lefts[1:]:
+            self._add(group, 'line', x1=left, y1=y, x2=left, y2=y + height, stroke='#ddd')
+        self._add(group, 'rect', x=LAYOUT_MARGIN, y=y, width=total, height=height, fill='none', stroke='#999')
+        for row_index, row in enumerate(rows):
+            top = y + row_index * LAYOUT_ROW_HEIGHT
+            for index, cell in enumerate(row):
+                pairs = _spans(cell)
+                if len(pairs) == 1 and pairs[0][1] is not None:
+                    text, span = pairs[0]
+                    width = min(text_width(text, size, True) + 12, widths[index] - pad)
+                    self._highlight(group, text, span, lefts[index] + pad / 2, top + 3, width, 24, size)
+                    continue
+                text = "".join(text for text, _ in pairs)
+                if text:
+                    self._add(group, 'text', text, x=lefts[index] + pad, y=top + 20,
+                              **({'font-weight': 'bold'} if row_index == 0 else {}))
+        return y + height
+
+    def options(self, parent, block: Dict, y: float) -> float:
+        size = 15
+        correct = block.get("correct")
+        group = self._add(parent, 'g', font_size=size)
+        for index, option in enumerate(block.get("options") or []):
+            text = "".join(text for text, _ in _spans(option))
+            top = y + index * LAYOUT_LINE_HEIGHT
+            x = LAYOUT_MARGIN + 12
+            if index == correct:
+                stroke, fill, _ = LAYOUT_COLORS['green']
+                width = text_width(text, size, True) + 24
+                self._add(group, 'rect', x=x - 12, y=top + 3, width=width, height=26, rx=13, fill=fill, stroke=stroke, stroke_width=2)
+                self._add(group, 'text', text, x=x, y=top + 21, font_weight='bold', fill=stroke)
+                self.anchors["answer"] = {"box": (x - 12, top + 3, x - 12 + width, top + 29), "gap": top + 31}
+            else:
+                self._add(group, 'text', text, x=x, y=top + 21)
+        return y + len(block.get("options") or []) * LAYOUT_LINE_HEIGHT
+
+    # Steps (right zone)
+
+    def _math(self, el, text: str):
+        """
+        Fill a text element with a formula, x^2 and x_1 as raised and
+        lowered tspans; dy shifts persist, so each is undone afterwards
+        """
+        shift, position = 0, 0
+
+        def plain(chunk: str):
+            nonlocal shift
+            if not chunk:
+                return
+            if shift:
+                self._add(el, 'tspan', chunk, dy=-shift)
+                shift = 0
+            elif len(el):
+                el[-1].tail = (el[-1].tail or "") + chunk
+            else:
+                el.text = (el.text or "") + chunk
+
+        for match in _LAYOUT_SCRIPT_RE.finditer(text):
+            plain(text[position:match.start()])
+            target = -6 if match.group(1) == '^' else 4
+            self._add(el, 'tspan', match.group(2).strip('{}'), dy=target - shift, font_size=11)
+            shift = target
+            position = match.end()
+        plain(text[position:])
+
+    def _wrap(self, text: str, size: float, width: float) -> List[str]:
+        lines, line = [], ""
+        for word in text.split():
+            candidate = f"{line} {word}" if line else word
+            if line and text_width(candidate, size) > width:
+                lines.append(line)
+                candidate = word
+            line = candidate
+        return lines + [line] if line else lines
+
+    def layout_steps(self, parent) -> float:
+        y = LAYOUT_MARGIN
+        for index, step in enumerate(self.spec.get("steps") or []):
+            if not isinstance(step, dict):
+                continue
+            stroke, fill, border = self._color(step.get("color"), LAYOUT_STEP_COLORS[index % len(LAYOUT_STEP_COLORS)])
+            lines = []
+            for line in step.get("lines") or []:
+                if isinstance(line, dict) and "math" in line:
+                    lines.append(("math", str(line["math"])))
+                else:
+                    lines.extend(("text", part) for part in self._wrap(str(line), 14, LAYOUT_CARD_WIDTH - 40))
+            result = str(step.get("result") or "")
+            height = 40 + 12 + 24 * len(lines) + (30 if result else 0) + 12
+
+            group = self._add(parent, 'g', transform=f"translate({LAYOUT_CARD_X},{y})")
+            self._add(group, 'rect', width=LAYOUT_CARD_WIDTH, height=height, rx=8, fill='#ffffff', stroke=stroke,
+                      stroke_width=2, filter='url(#shadow)')
+            self._add(group, 'rect', width=LAYOUT_CARD_WIDTH, height=40, rx=8, fill=fill)
+            self._add(group, 'path', d=f"M0,40 L{LAYOUT_CARD_WIDTH},40", stroke=border, stroke_width=1)
+            self._add(group, 'text', str(step.get("title") or f"Step {index + 1}"), x=20, y=26, font_size=16,
+                      font_weight='bold', fill=stroke)
+            line_y = 52
+            for kind, text in lines:
+                if kind == "math":
+                    self._math(self._add(group, 'text', x=30, y=line_y + 17, font_family=LAYOUT_MATH_FONT,
+                                         font_size=16, font_style='italic', fill='#333'), text)
+                else:
+                    self._add(group, 'text', text, x=20, y=line_y + 17, font_size=14, fill='#333')
+                line_y += 24
+            if result:
+                self._add(group, 'text', result, x=20, y=line_y + 20, font_size=15, font_weight='bold', fill=stroke)
+            self.cards.append({
+                "box": (LAYOUT_CARD_X, y, LAYOUT_CARD_X + LAYOUT_CARD_WIDTH, y + height),
+                "result_y": y + line_y + 15 if result else y + height - 12,
+                "stroke": stroke,
+                "from": [str(ref) for ref in step.get("from") or []],
+                "to": [str(ref) for ref in step.get("to") or []],
+            })
+            y += height + LAYOUT_CARD_GAP
+        return y
+
+    # Arrows
+
+    def route_arrows(self, parent):
+        """
+        Draw each arrow as value → gap below its line → own gutter channel →
+        card edge (reversed and dashed for "to"). Channels are assigned left
+        to right in whichever of a few simple orders crosses least.
+        """
+        arrows = []
+        for card in self.cards:
+            arrows += [{"anchor": self.anchors[ref], "card": card, "inbound": True} for ref in card["from"] if ref in self.anchors]
+            arrows += [{"anchor": self.anchors[ref], "card": card, "inbound": False} for ref in card["to"] if ref in self.anchors]
+        if not arrows:
+            return
+        arrows.sort(key=lambda arrow: (arrow["anchor"]["box"][1], arrow["anchor"]["box"][0]))
+
+        for card in self.cards:
+            inbound = [arrow for arrow in arrows if arrow["card"] is card and arrow["inbound"]]
+            outbound = [arrow for arrow in arrows if arrow["card"] is card and not arrow["inbound"]]
+            top, bottom = card["box"][1] + 40, card["result_y"] - 10
+            for slot, arrow in enumerate(inbound):
+                arrow["y"] = top + (slot + 1) * (bottom - top) / (len(inbound) + 1)
+            for slot, arrow in enumerate(outbound):
+                arrow["y"] = card["result_y"] + 6 * slot
+
+        arrows = min(
+            (sorted(arrows, key=lambda arrow: arrow["anchor"]["gap"]),
+             sorted(arrows, key=lambda arrow: -arrow["anchor"]["gap"]),
+             sorted(arrows, key=lambda arrow: arrow["y"]),
+             sorted(arrows, key=lambda arrow: -arrow["y"])),
+            key=self._crossings,
+        )
+
+        gutter_left = LAYOUT_MARGIN + LAYOUT_LEFT_WIDTH + 14
+        gutter_right = LAYOUT_CARD_X - 14
+        spacing = min(12.0, (gutter_right - gutter_left) / max(len(arrows) - 1, 1))
+        gap_use = {}
+        group = self._add(parent, 'g', fill='none', stroke_width=2)
+        for index, arrow in enumerate(arrows):
+            x1, y1, x2, y2 = arrow["anchor"]["box"]
+            center = (x1 + x2) / 2
+            channel = gutter_left + index * spacing
+            used = gap_use.get(arrow["anchor"]["gap"], 0)
+            gap_use[arrow["anchor"]["gap"]] = used + 1
+            gap = arrow["anchor"]["gap"] + (used + 1) // 2 * 3 * (-1 if used % 2 else 1)
+            points = [(center, y2), (center, gap), (channel, gap), (channel, arrow["y"]), (LAYOUT_CARD_X, arrow["y"])]
+            if not arrow["inbound"]:
+                points.reverse()
+            path = [points[0]] + [point for previous, point in zip(points, points[1:]) if point != previous]
+            stroke = arrow["card"]["stroke"]
+            attrs = {'stroke-dasharray': '6,4'} if not arrow["inbound"] else {}
+            self._add(group, 'path', d="M " + " L ".join(f"{_format_number(x)} {_format_number(y)}" for x, y in path),
+                      stroke=stroke, marker_end=self._marker(stroke), **attrs)
+            if arrow["inbound"]:
+                self._add(parent, 'circle', cx=center, cy=y2, r=3, fill=stroke)
+
+    @staticmethod
+    def _crossings(arrows: List[Dict]) -> int:
+        """
+        Crossings when arrows take channels left to right in this order: a
+        later arrow's value row, or an earlier arrow's card row, passing
+        through the other's vertical run
+        """
+        count = 0
+        for index, first in enumerate(arrows):
+            low, high = sorted((first["anchor"]["gap"], first["y"]))
+            for second in arrows[index + 1:]:
+                count += low < second["anchor"]["gap"] < high
+                count += min(second["anchor"]["gap"], second["y"]) < first["y"] < max(second["anchor"]["gap"], second["y"])
+        return count
+
+    def render(self) -> str:
+        self._shadow()
+        self._add(self.root, 'rect', width='100%', height='100%', fill='#ffffff')
+        left = self.layout_question(self._add(self.root, 'g', font_family=LAYOUT_FONT, fill='#333'))
+        right = self.layout_steps(self._add(self.root, 'g', font_family=LAYOUT_FONT))
+        self.route_arrows(self.root)
+        width = LAYOUT_CARD_X + LAYOUT_CARD_WIDTH + LAYOUT_MARGIN
+        height = max(left, right) + LAYOUT_MARGIN
+        self.root.set('width', _format_number(width))
+        self.root.set('height', _format_number(height))
+        self.root.set('viewBox', f"0 0 {_format_number(width)} {_format_number(height)}")
+        return ET.tostring(self.root, encoding='unicode')
+
+def render_layout(spec: Dict) -> str:
+    """
+    SVG for a parsed layout spec
+    """
+    try:
+        return LayoutEngine(spec).render()
+    except (TypeError, ValueError, AttributeError, KeyError, RecursionError) as e:
+        raise LayoutError(f"unrenderable spec: {type(e).__name__}: {str(e)}") from e
+
+def layout_to_images(response_text: str) -> Dict:
+    """
+    Parse a layout-mode response, render it and optimize the SVG
+    """
+    return finish_svg(render_layout(parse_layout(response_text)))
+
+# Previews keep the SVG's aspect ratio at a fixed width
+PREVIEW_WIDTH = 400
+PREVIEW_QUALITY = 85
+_VIEWBOX_RE = re.compile(r'<svg\b[^>]*?\sviewBox="\s*[-0-9.e]+[\s,]+[-0-9.e]+[\s,]+([0-9.e]+)[\s,]+([0-9.e]+)\s*"')
+
+def svg_aspect_ratio(clean_svg: str) -> float:
+    """
+    Height/width ratio of a cleaned SVG, taken from its root viewBox
+    """
+    match = _VIEWBOX_RE.search(clean_svg)
+    if match is not None:
+        width, height = float(match.group(1)), float(match.group(2))
+        if width > 0 and height > 0:
+            return height / width
+    return 0.75
+
+# Rasterizer backends, tried in RASTERIZERS order: a document one backend
+# fails on goes to the next, and a backend whose library cannot be loaded is
+# skipped for the life of the process. The SVG is model output, so nothing
+# outside the document may be read: cairosvg runs with unsafe off, and
+# references to anything but the document's own ids or data: URIs are
+# removed before either backend sees it.
+RASTERIZERS = tuple(name.strip() for name in os.getenv("RASTERIZERS", "cairosvg,resvg").split(",") if name.strip())
+_EXTERNAL_HREF_RE = re.compile(r'\s(?:xlink:)?href\s*=\s*(?:"(?!#|data:)[^"]*"|\'(?!#|data:)[^\']*\')')
+
+class Rasterizer:
+    """
+    Renders a cleaned SVG to a PNG of exactly width x height. The library
+    is imported on first use.
+    """
+    name = ""
+
+    def __init__(self):
+        self._module = None
+        self.error = None
+        self.stats = {"renders": 0, "failures": 0, "seconds": 0.0}
+        # Set to a list in render workers, which send their attempts back to
+        # the server process instead of recording them
+        self.unreported = None
+
+    def import_module(self):
+        raise NotImplementedError
+
+    def module(self):
+        """
+        The backend library, or None if it cannot be loaded here
+        """
+        if self._module is None and self.error is None:
+            try:
+                self._module = self.import_module()
+            except (ImportError, OSError) as e:
+                # cairocffi raises OSError when libcairo itself is missing
+                self.error = f"{type(e).__name__}: {str(e).splitlines()[0] if str(e) else ''}"
+                logger.warning(f"Rasterizer {self.name} unavailable: {self.error}")
+        return self._module
+
+    def render(self, clean_svg: str, width: int, height: int) -> bytes:
+        raise NotImplementedError
+
+    def record(self, seconds: float, ok: bool):
+        """
+        Count one render attempt and time it into the rasterize_<name> stage
+        """
+        if self.unreported is not None:
+            self.unreported.append((seconds, ok))
+            return
+        self.stats["renders" if ok else "failures"] += 1
+        self.stats["seconds"] += seconds
+        STAGE_SECONDS.labels(f"rasterize_{self.name}").observe(seconds)
+
+    def snapshot(self) -> Dict:
+        attempts = self.stats["renders"] + self.stats["failures"]
+        return {
+            "name": self.name,
+            "available": self.error is None,
+            "error": self.error,
+            "renders": self.stats["renders"],
+            "failures": self.stats["failures"],
+            "avg_ms": round(self.stats["seconds"] / attempts * 1000, 2) if attempts else None,
+        }
+
+class CairoRasterizer(Rasterizer):
+    name = "cairosvg"
+
+    def import_module(self):
+        import cairosvg  # loads libcairo; deferred to the first render or warm-up
+        return cairosvg
+
+    def render(self, clean_svg: str, width: int, height: int) -> bytes:
+        return self.module().svg2png(
+            bytestring=clean_svg.encode('utf-8'),
+            output_width=width,
+            output_height=height,
+            scale=1.0,
+            unsafe=False
+        )
+
+class ResvgRasterizer(Rasterizer):
+    """
+    resvg (Rust) through resvg_py: much faster on filters and gradients
+    """
+    name = "resvg"
+
+    def import_module(self):
+        import resvg_py
+        return resvg_py
+
+    def render(self, clean_svg: str, width: int, height: int) -> bytes:
+        png_data = bytes(self.module().svg_to_bytes(svg_string=clean_svg, width=width))
+        # resvg fits the width and rounds the height up; trim to the exact size
+        if int.from_bytes(png_data[20:24], 'big') == height:
+            return png_data
+        from PIL import Image
+        image = Image.open(BytesIO(png_data)).crop((0, 0, width, height))
+        buffer = BytesIO()
+        image.save(buffer, format='PNG')
+        return buffer.getvalue()
+
+RASTERIZER_BACKENDS = {'cairosvg': CairoRasterizer, 'resvg': ResvgRasterizer}
+
+def create_rasterizers(names) -> List[Rasterizer]:
+    unknown = [name for name in names if name not in RASTERIZER_BACKENDS]
+    if unknown:
+        raise ValueError(f"Unknown RASTERIZERS: {', '.join(unknown)}")
+    return [RASTERIZER_BACKENDS[name]() for name in names]
+
+rasterizers = create_rasterizers(RASTERIZERS)
+
+def take_rasterizer_stats() -> Dict:
+    """
+    Render attempts since the last call, for a render worker to send back
+    """
+    stats = {rasterizer.name: {"attempts": rasterizer.unreported, "error": rasterizer.error} for rasterizer in rasterizers}
+    for rasterizer in rasterizers:
+        rasterizer.unreported = []
+    return stats
+
+def merge_rasterizer_stats(stats: Dict):
+    """
+    Record a render worker's attempts on this process's rasterizers
+    """
+    for rasterizer in rasterizers:
+        report = stats.get(rasterizer.name)
+        if report is None:
+            continue
+        for seconds, ok in report["attempts"] or ():
+            rasterizer.record(seconds, ok)
+        if report["error"] is not None and rasterizer.error is None:
+            rasterizer.error = report["error"]
+
+def rasterize_svg(clean_svg: str, width: int) -> bytes:
+    """
+    Render a cleaned SVG to PNG at the given width, preserving aspect ratio,
+    with the first rasterizer that manages it
+    """
+    height = max(1, round(width * svg_aspect_ratio(clean_svg)))
+    clean_svg = _EXTERNAL_HREF_RE.sub('', clean_svg)
+    error = "no rasterizer available"
+    for rasterizer in rasterizers:
+        if rasterizer.module() is None:
+            continue
+        start = time.perf_counter()
+        try:
+            png_data = rasterizer.render(clean_svg, width, height)
+        except Exception as e:
+            rasterizer.record(time.perf_counter() - start, ok=False)
+            error = f"{rasterizer.name}: {type(e).__name__}: {e}"
+            logger.warning(f"⚠️ Rasterizer failed, trying the next one. {error}")
+            continue
+        rasterizer.record(time.perf_counter() - start, ok=True)
+        return png_data
+    raise RuntimeError(f"Could not rasterize SVG ({error})")
+
+# Raster formats and encoder presets. png8 is a palette-quantized PNG and
+# webp is lossless; both suit flat-colour diagrams far better than JPEG
+# (the PROMPT example is about a third of the size).
+# Presets trade encode CPU for size; "balanced" JPEG matches the original
+# quality=85, optimize=True previews.
+PREVIEW_FORMATS = ('jpg', 'png', 'png8', 'webp', 'avif')
+PREVIEW_PRESET = os.getenv("PREVIEW_PRESET", "balanced")
+ENCODER_PRESETS = {
+    'jpg': {'fast': {'optimize': False}, 'balanced': {'optimize': True}, 'small': {'optimize': True, 'progressive': True}},
+    # None keeps the PNG the rasterizer produced
+    'png': {'fast': None, 'balanced': None, 'small': {'optimize': True}},
+    'png8': {'fast': {'compress_level': 1}, 'balanced': {'compress_level': 6}, 'small': {'optimize': True}},
+    'webp': {
+        'fast': {'lossless': True, 'method': 1, 'quality': 0},
+        'balanced': {'lossless': True, 'method': 2, 'quality': 50},
+        'small': {'lossless': True, 'method': 4, 'quality': 50},
+    },
+    'avif': {'fast': {'speed': 10}, 'balanced': {'speed': 8}, 'small': {'speed': 4}},
+}
+PIL_FORMATS = {'jpg': 'JPEG', 'png': 'PNG', 'png8': 'PNG', 'webp': 'WEBP', 'avif': 'AVIF'}
+if PREVIEW_PRESET not in ENCODER_PRESETS['jpg']:
+    raise ValueError(f"Unknown PREVIEW_PRESET: {PREVIEW_PRESET} (expected one of {', '.join(ENCODER_PRESETS['jpg'])})")
+_supported_preview_formats = None
+
+def supported_preview_formats() -> tuple:
+    """
+    The PREVIEW_FORMATS this Pillow build can encode, checked on first use
+    """
+    global _supported_preview_formats
+    if _supported_preview_formats is None:
+        from PIL import features
+        _supported_preview_formats = tuple(
+            fmt for fmt in PREVIEW_FORMATS if fmt not in ('webp', 'avif') or features.check(fmt)
+        )
+    return _supported_preview_formats
+
+def negotiate_format(requested: str, accept: str = "") -> str:
+    """
+    Resolve a requested preview format. "auto" picks lossless WebP, then AVIF,
+    when the Accept header allows them and palette PNG otherwise; formats
+    this Pillow build cannot encode fall back to WebP, then palette PNG.
+    """
+    supported = supported_preview_formats()
+    if requested == 'auto':
+        for fmt in ('webp', 'avif'):
+            if f"image/{fmt}" in accept and fmt in supported:
+                return fmt
+        return 'png8'
+    if requested in supported:
+        return requested
+    return 'webp' if 'webp' in supported else 'png8'
+
+def encode_raster(png_data: bytes, fmt: str, quality: int = PREVIEW_QUALITY, preset: str = 'balanced') -> bytes:
+    """
+    Re-encode a rendered PNG; JPEGs get a white background behind transparency
+    """
+    if ENCODER_PRESETS[fmt][preset] is None:
+        return png_data
+    from PIL import Image
+    return encode_image(Image.open(BytesIO(png_data)), fmt, quality, preset)
+
+def encode_image(png_image: "Image.Image", fmt: str, quality: int = PREVIEW_QUALITY, preset: str = 'balanced') -> bytes:
+    """
+    Encode a decoded raster in the given format and preset
+    """
+    from PIL import Image
+    options = ENCODER_PRESETS[fmt][preset] or {}
+    buffer = BytesIO()
+    
+    if fmt == 'png8':
+        png_image = png_image.convert('RGBA').quantize(256, method=Image.Quantize.FASTOCTREE)
+    if fmt == 'avif':
+        options = {**options, 'quality': quality}
+    if fmt != 'jpg':
+        png_image.save(buffer, format=PIL_FORMATS[fmt], **options)
+        return buffer.getvalue()
+    
+    if png_image.mode in ('RGBA', 'LA', 'P'):
+        white_bg = Image.new('RGB', png_image.size, (255, 255, 255))
+        if png_image.mode == 'P':
+            png_image = png_image.convert('RGBA')
+        white_bg.paste(png_image, mask=png_image.split()[-1] if png_image.mode in ('RGBA', 'LA') else None)
+        jpg_image = white_bg
+    else:
+        jpg_image = png_image.convert('RGB')
+    
+    jpg_image.save(buffer, format='JPEG', quality=quality, **options)
+    return buffer.getvalue()
+
+def render_previews(clean_svg: str) -> Dict:
+    """
+    Rasterize an already-cleaned SVG into the base64 JPG/PNG previews.
+    Stage timings go in '_timings' (and a failed stage in '_failed_stage')
+    since this usually runs in a render worker process.
+    """
+    images = {}
+    timings = {}
+    current = 'rasterize'
+    
+    # Preview size for React Native chat (400 wide)
+    try:
+        start = time.perf_counter()
+        png_data = rasterize_svg(clean_svg, PREVIEW_WIDTH)
+        timings['rasterize'] = time.perf_counter() - start
+        
+        # Convert PNG to JPG for React Native, both in PREVIEW_PRESET so they
+        # can seed the rendition cache
+        current, start = 'jpeg_encode', time.perf_counter()
+        jpg_data = encode_raster(png_data, 'jpg', PREVIEW_QUALITY, PREVIEW_PRESET)
+        png_data = encode_raster(png_data, 'png', preset=PREVIEW_PRESET)
+        timings['jpeg_encode'] = time.perf_counter() - start
+        
+        # Store as base64 for React Native
+        current, start = 'base64', time.perf_counter()
+        images['jpg'] = base64.b64encode(jpg_data).decode('utf-8')
+        images['png'] = base64.b64encode(png_data).decode('utf-8')
+        timings['base64'] = time.perf_counter() - start
+        
+    except Exception as e:
+        logger.error(f"Error creating preview image: {str(e)}")
+        images['_failed_stage'] = current
+        # Create simple fallback image
+        from PIL import Image
+        fallback_img = Image.new('RGB', (PREVIEW_WIDTH, 300), (240, 240, 240))
+        fallback_buffer = BytesIO()
+        fallback_img.save(fallback_buffer, format='JPEG', quality=75)
+        fallback_data = fallback_buffer.getvalue()
+        images['jpg'] = base64.b64encode(fallback_data).decode('utf-8')
+        images['png'] = base64.b64encode(fallback_data).decode('utf-8')
+    
+    images['_timings'] = timings
+    return images
+
+def collect_render_metrics(images: Dict) -> Dict:
+    """
+    Record the stage timings render_previews reported and strip them. A
+    '_failed_stage' is counted but kept, so callers know the previews are
+    the gray fallback and do not cache them.
+    """
+    for name, seconds in images.pop('_timings', {}).items():
+        record_stage(name, seconds)
+    failed = images.get('_failed_stage')
+    if failed is not None:
+        STAGE_ERRORS.labels(failed).inc()
+    return images
+
+def render_rendition(clean_svg: str, width: int, fmt: str, quality: int, preset: str = 'balanced') -> bytes:
+    """
+    Render one on-demand rendition of a stored SVG
+    """
+    return encode_raster(rasterize_svg(clean_svg, width), fmt, quality, preset)
+
+# Responsive sets (srcset): the SVG is rasterized once, at the largest width,
+# and the other widths are resampled from that render, which is much cheaper
+# than parsing and rasterizing the SVG again for each. A tiny blurred JPEG
+# placeholder comes with them for the app to show until the real image loads.
+SRCSET_BASE_WIDTH = int(os.getenv("SRCSET_BASE_WIDTH", str(PREVIEW_WIDTH)))
+SRCSET_SCALES = tuple(int(scale) for scale in os.getenv("SRCSET_SCALES", "1,2,3").split(","))
+SRCSET_PLACEHOLDER_WIDTH = int(os.getenv("SRCSET_PLACEHOLDER_WIDTH", "24"))
+
+def render_placeholder(image: "Image.Image") -> bytes:
+    """
+    A few hundred bytes of blurred JPEG with the image's layout and colours
+    """
+    from PIL import Image, ImageFilter
+    image = image.convert('RGBA')
+    height = max(1, round(image.height * SRCSET_PLACEHOLDER_WIDTH / image.width))
+    small = Image.new('RGB', (SRCSET_PLACEHOLDER_WIDTH, height), (255, 255, 255))
+    thumbnail = image.resize((SRCSET_PLACEHOLDER_WIDTH, height), Image.Resampling.BOX, reducing_gap=2.0)
+    small.paste(thumbnail, mask=thumbnail.split()[-1])
+    buffer = BytesIO()
+    small.filter(ImageFilter.GaussianBlur(1)).save(buffer, format='JPEG', quality=40)
+    return buffer.getvalue()
+
+def render_srcset(clean_svg: str, widths: List[int], fmt: str, quality: int, preset: str = 'balanced') -> Dict:
+    """
+    Rasterize once at the largest width and resample the rest from it.
+    Returns the encoded images by width and the placeholder, with stage
+    timings in '_timings' like render_previews.
+    """
+    from PIL import Image
+    timings = {}
+    widths = sorted(set(widths), reverse=True)
+    ratio = svg_aspect_ratio(clean_svg)
+    
+    start = time.perf_counter()
+    png_data = rasterize_svg(clean_svg, widths[0])
+    full = Image.open(BytesIO(png_data))
+    full.load()
+    timings['rasterize'] = time.perf_counter() - start
+    
+    renditions = {}
+    decoded = {widths[0]: full}
+    encode_seconds = resample_seconds = 0.0
+    for width in widths:
+        start = time.perf_counter()
+        if width == widths[0]:
+            renditions[width] = encode_raster(png_data, fmt, quality, preset)
+            encode_seconds += time.perf_counter() - start
+            continue
+        # Same height rasterize_svg would give, so these match /render output
+        height = max(1, round(width * ratio))
+        # Exact multiples (3x → 1x, 2x → 1x) are box-averaged from the
+        # smallest image already made, several times faster than resampling
+        source = next((image for image in reversed(decoded.values()) if image.width % width == 0), full)
+        if source.width % width == 0:
+            resized = source.reduce(source.width // width).crop((0, 0, width, height))
+        else:
+            resized = source.resize((width, height), Image.Resampling.BICUBIC, reducing_gap=2.0)
+        decoded[width] = resized
+        middle = time.perf_counter()
+        renditions[width] = encode_image(resized, fmt, quality, preset)
+        resample_seconds += middle - start
+        encode_seconds += time.perf_counter() - middle
+    
+    start = time.perf_counter()
+    placeholder = render_placeholder(decoded[widths[-1]])
+    timings['resample'] = resample_seconds + time.perf_counter() - start
+    timings['encode'] = encode_seconds
+    return {'renditions': renditions, 'placeholder': placeholder, '_timings': timings}
+
+def create_mobile_optimized_images(svg_content: str) -> Dict:
+    """
+    Create mobile-optimized images from SVG for React Native
+    """
+    try:
+        clean_svg = optimize_svg(validate_and_clean_svg(svg_content))
+        
+        images = collect_render_metrics(render_previews(clean_svg))
+        
+        # Store SVG
+        images['svg'] = clean_svg
+        
+        return images
+        
+    except Exception as e:
+        logger.error(f"Error in create_mobile_optimized_images: {str(e)}")
+        return {
+            'svg': validate_and_clean_svg(''),
+            'jpg': '',
+            'png': ''
+        }
+
+WARMUP_SVG = '<svg xmlns="http://www.w3.org/2000/svg" width="60" height="20"><text x="2" y="15" font-family="Arial" font-size="12">warm</text></svg>'
+
+def _render_worker_main(conn):
+    """
+    Entry point of a render worker process: load the rasterizer, fonts and
+    the encoders, then serve jobs, sending back the render attempts with
+    each result
+    """
+    for rasterizer in rasterizers:
+        rasterizer.unreported = []
+    try:
+        render_previews(WARMUP_SVG)
+    except Exception as e:
+        logger.warning(f"Render worker warm-up failed: {str(e)}")
+    conn.send("ready")
+    
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        func, args = job
+        try:
+            result = (True, func(*args))
+        except Exception as e:
+            result = (False, f"{type(e).__name__}: {e}")
+        conn.send((*result, take_rasterizer_stats()))
+
+class RenderTimeout(Exception):
+    pass
+
+class RenderQueueFull(Exception):
+    pass
+
+class RenderProcessPool:
+    """
+    Fixed pool of warm render processes with a bounded queue and per-job timeouts.
+    A job that overruns its timeout has its worker killed and replaced; a
+    worker that cannot be replaced is dropped, and once none are left jobs
+    render on the dispatch threads.
+    """
+
+    def __init__(self, processes: int, queue_size: int, timeout: float):
+        self.processes = processes
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.started = False
+        self._ctx = multiprocessing.get_context("spawn")
+        self._idle: "queue.Queue" = queue.Queue()
+        self._dispatch = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        workers = [self._spawn() for _ in range(self.processes)]
+        for proc, conn in workers:
+            self._wait_ready(proc, conn)
+            self._idle.put((proc, conn))
+        self._dispatch = ThreadPoolExecutor(max_workers=self.processes, thread_name_prefix="render-dispatch")
+        self.started = True
+        logger.info(f"🎨 Render pool ready ({self.processes} processes)")
+
+    def _spawn(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        proc = self._ctx.Process(target=_render_worker_main, args=(child_conn,), daemon=True)
+        proc.start()
+        child_conn.close()
+        return proc, parent_conn
+
+    def _wait_ready(self, proc, conn):
+        # Worker start-up imports this module, so allow generous time for it
+        try:
+            if not conn.poll(max(self.timeout, 60)):
+                raise RenderTimeout("Render worker failed to start")
+            conn.recv()
+        except (RenderTimeout, EOFError):
+            proc.kill()
+            raise RuntimeError("Render worker failed to start")
+
+    def _replace(self, proc, conn):
+        proc.kill()
+        proc.join()
+        conn.close()
+        proc, conn = self._spawn()
+        self._wait_ready(proc, conn)
+        return proc, conn
+
+    def _retire(self, proc, conn, reason: str):
+        """
+        Drop a worker that could not be replaced, shrinking the pool
+        """
+        proc.kill()
+        conn.close()
+        with self._lock:
+            self.processes -= 1
+            remaining = self.processes
+        logger.error(f"Render worker dropped ({reason}), {remaining} left")
+        if remaining == 0:
+            # Wakes jobs waiting for a worker so they render in-thread
+            self._idle.put(None)
+
+    def _run(self, func, args):
+        worker = self._idle.get()
+        if worker is None:
+            self._idle.put(None)
+            return func(*args)
+        proc, conn = worker
+        try:
+            conn.send((func, args))
+            if not conn.poll(self.timeout):
+                raise RenderTimeout(f"Render exceeded {self.timeout}s")
+            ok, result, stats = conn.recv()
+            merge_rasterizer_stats(stats)
+        except (RenderTimeout, EOFError, OSError):
+            try:
+                worker = self._replace(proc, conn)
+            except Exception as e:
+                worker = None
+                self._retire(proc, conn, f"replacement failed: {str(e)}")
+            raise
+        finally:
+            if worker is not None and worker[0].is_alive():
+                self._idle.put(worker)
+            elif worker is not None:
+                self._retire(*worker, "worker exited")
+        if not ok:
+            raise RuntimeError(result)
+        return result
+
+    def saturated(self) -> bool:
+        """
+        True while the queue is full and new renders are turned away
+        """
+        return self.started and self._pending >= self.processes + self.queue_size
+
+    async def submit(self, func, *args):
+        if not self.started:
+            return await run_in_render_pool(func, *args)
+        if self.saturated():
+            raise RenderQueueFull()
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._dispatch, self._run, func, args)
+        finally:
+            self._pending -= 1
+
+    def shutdown(self):
+        if not self.started:
+            return
+        self.started = False
+        self._dispatch.shutdown(wait=False, cancel_futures=True)
+        while not self._idle.empty():
+            worker = self._idle.get_nowait()
+            if worker is None:
+                continue
+            proc, conn = worker
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            proc.join(timeout=2)
+            if proc.is_alive():
+                proc.kill()
+            conn.close()
+
+render_pool = RenderProcessPool(RENDER_PROCESSES, RENDER_QUEUE_SIZE, RENDER_TIMEOUT)
+
+# Upload ingest limits. Photos are downscaled to MODEL_IMAGE_MAX_SIDE before
+# they are sent to Gemini, which does not use the extra resolution anyway.
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+MODEL_IMAGE_MAX_SIDE = int(os.getenv("MODEL_IMAGE_MAX_SIDE", "1536"))
+MODEL_IMAGE_QUALITY = int(os.getenv("MODEL_IMAGE_QUALITY", "85"))
+
+# Result cache: bounded in-memory LRU, optionally backed by a SQLite file that
+# several uvicorn workers can share. Set CACHE_DB_PATH to enable the disk tier.
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "256"))
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "")
+CACHE_DISK_MAX_ENTRIES = int(os.getenv("CACHE_DISK_MAX_ENTRIES", "10000"))
+
+class ResultCache:
+    """
+    Two-tier cache of generated images keyed by request content
+    """
+
+    def __init__(self, max_entries: int, db_path: str = "", disk_max_entries: int = 10000):
+        self.max_entries = max_entries
+        self.disk_max_entries = disk_max_entries
+        self._memory: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0,
+        }
+        if db_path:
+            self._db = sqlite3.connect(db_path, timeout=5, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS results_created_at ON results (created_at)")
+            self._db.commit()
+
+    @staticmethod
+    def make_key(image_bytes: bytes, request_text: str, mode: str = "svg") -> str:
+        # Keyed on the request text as sent, context label included, since
+        # the endpoints label the same user text differently
+        digest = hashlib.sha256()
+        digest.update(hashlib.sha256(image_bytes).digest())
+        version = PROMPT_VERSION if mode == "svg" else f"{mode}-{LAYOUT_PROMPT_VERSION}"
+        for part in (request_text.strip(), llm_backend.model, version):
+            digest.update(b"\0" + part.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return self._memory[key]
+            if self._db is not None:
+                row = self._db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value = json.loads(row[0])
+                    self._remember(key, value)
+                    self.stats["disk_hits"] += 1
+                    return value
+            self.stats["misses"] += 1
+            return None
+
+    def set(self, key: str, value: Dict):
+        with self._lock:
+            self._remember(key, value)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO results (key, value, created_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), time.time()),
+                )
+                evicted = self._db.execute(
+                    "DELETE FROM results WHERE key IN ("
+                    "SELECT key FROM results ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.disk_max_entries,),
+                ).rowcount
+                self._db.commit()
+                self.stats["disk_evictions"] += max(evicted, 0)
+
+    def _remember(self, key: str, value: Dict):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.stats["memory_evictions"] += 1
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["memory_entries"] = len(self._memory)
+            stats["memory_max_entries"] = self.max_entries
+            stats["disk_enabled"] = self._db is not None
+            return stats
+
+result_cache = ResultCache(CACHE_MAX_ENTRIES, CACHE_DB_PATH, CACHE_DISK_MAX_ENTRIES)
+
+class SingleFlight:
+    """
+    Coalesce identical concurrent calls so only the first one does the work
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.stats = {"leaders": 0, "coalesced": 0}
+
+    async def run(self, key: str, factory):
+        task = self._inflight.get(key)
+        if task is None:
+            self.stats["leaders"] += 1
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.stats["coalesced"] += 1
+        # Shield so a cancelled caller does not cancel the work for everyone else
+        return await asyncio.shield(task)
+
+    def snapshot(self) -> Dict:
+        return {**self.stats, "inflight": len(self._inflight)}
+
+single_flight = SingleFlight()
+
+# Asset store for the "urls" response mode: generated files are kept by content
+# hash and served raw from /assets/{id}. Set ASSET_DIR to share them between
+# workers through a sharded directory.
+ASSET_STORE_MAX_BYTES = int(os.getenv("ASSET_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+ASSET_DIR = os.getenv("ASSET_DIR", "")
+ASSET_CONTENT_TYPES = {
+    'svg': 'image/svg+xml', 'jpg': 'image/jpeg', 'png': 'image/png',
+    'png8': 'image/png', 'webp': 'image/webp', 'avif': 'image/avif',
+}
+_ASSET_ID_RE = re.compile(r'^[0-9a-f]{32}\.(svg|jpg|png)$')
+# Generated SVG is served from the API origin, and a prompt-injected image
+# could carry script; these headers keep it inert when opened directly
+SVG_ASSET_HEADERS = {
+    "Content-Security-Policy": "default-src 'none'; style-src 'unsafe-inline'; sandbox",
+    "X-Content-Type-Options": "nosniff",
+}
+
+class AssetStore:
+    """
+    Content-addressed byte store with an in-memory LRU bounded by size
+    """
+
+    def __init__(self, max_bytes: int, directory: str = ""):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_valid_id(asset_id: str) -> bool:
+        return _ASSET_ID_RE.match(asset_id) is not None
+
+    def put(self, data: bytes, ext: str) -> str:
+        asset_id = f"{hashlib.sha256(data).hexdigest()[:32]}.{ext}"
+        self.remember(asset_id, data)
+        if self.directory:
+            path = self._path(asset_id)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+        return asset_id
+
+    def get(self, asset_id: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._memory.get(asset_id)
+            if data is not None:
+                self._memory.move_to_end(asset_id)
+                return data
+        if self.directory:
+            try:
+                with open(self._path(asset_id), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                return None
+            self.remember(asset_id, data)
+            return data
+        return None
+
+    def encoded(self, asset_id: str, data: bytes, encoding: str) -> bytes:
+        """
+        Return a compressed variant of an asset, compressing it only once
+        """
+        key = f"{asset_id}:{encoding}"
+        with self._lock:
+            cached = self._memory.get(key)
+        if cached is not None:
+            return cached
+        if encoding == 'br':
+            compressed = brotli.compress(data, quality=9)
+        else:
+            compressed = gzip.compress(data, compresslevel=9)
+        self.remember(key, compressed)
+        return compressed
+
+    def _path(self, asset_id: str) -> str:
+        return os.path.join(self.directory, asset_id[:2], asset_id)
+
+    def remember(self, key: str, data: bytes):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes and len(self._memory) > 1:
+                _, evicted = self._memory.popitem(last=False)
+                self._size -= len(evicted)
+
+asset_store = AssetStore(ASSET_STORE_MAX_BYTES, ASSET_DIR)
+
+# Renditions rendered by /render/{id}, keyed by svg id, width, format and quality
+RENDITION_CACHE_MAX_BYTES = int(os.getenv("RENDITION_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+RENDITION_MAX_WIDTH = int(os.getenv("RENDITION_MAX_WIDTH", "2048"))
+rendition_cache = AssetStore(RENDITION_CACHE_MAX_BYTES)
+
+def rendition_key(svg_id: str, width: int, fmt: str, quality: int, preset: str = 'balanced') -> str:
+    quality = quality if fmt in ('jpg', 'avif') else 0
+    return f"{svg_id.split('.')[0]}-{width}-{quality}-{preset}.{fmt}"
+
+def store_result_assets(images: Dict):
+    """
+    Put a result's SVG into the asset store, seeding the rendition cache with
+    any previews that were already rendered. Returns the SVG id and size.
+    """
+    svg_data = images['svg'].encode('utf-8')
+    svg_id = asset_store.put(svg_data, 'svg')
+    # The gray fallback of a failed render is not a rendition of this SVG
+    if '_failed_stage' in images:
+        return svg_id, len(svg_data)
+    for fmt, signature in (('jpg', b'\xff\xd8'), ('png', b'\x89PNG')):
+        if not images.get(fmt):
+            continue
+        data = base64.b64decode(images[fmt])
+        if data.startswith(signature):
+            rendition_cache.remember(rendition_key(svg_id, PREVIEW_WIDTH, fmt, PREVIEW_QUALITY, PREVIEW_PRESET), data)
+    return svg_id, len(svg_data)
+
+async def build_asset_refs(base_url, images: Dict, preview_format: str = "", preview_preset: str = PREVIEW_PRESET) -> Dict:
+    """
+    Describe a result by URL: the stored SVG plus lazily rendered previews
+    """
+    svg_id, svg_size = await asyncio.to_thread(store_result_assets, images)
+    render_url = app.url_path_for("render_svg", svg_id=svg_id).make_absolute_url(base_url)
+    refs = {
+        "svg": {
+            "id": svg_id,
+            "url": str(app.url_path_for("get_asset", asset_id=svg_id).make_absolute_url(base_url)),
+            "content_type": ASSET_CONTENT_TYPES['svg'],
+            "bytes": svg_size,
+            "bytes_saved": images.get('svg_bytes_saved', 0),
+        },
+        "jpg": {
+            "url": str(render_url.include_query_params(w=PREVIEW_WIDTH, fmt='jpg', q=PREVIEW_QUALITY)),
+            "content_type": ASSET_CONTENT_TYPES['jpg'],
+        },
+        "png": {
+            "url": str(render_url.include_query_params(w=PREVIEW_WIDTH, fmt='png')),
+            "content_type": ASSET_CONTENT_TYPES['png'],
+        },
+    }
+    if preview_format:
+        # Left unresolved so "auto" is negotiated against the Accept header
+        # of whoever fetches the image
+        refs["preview"] = {
+            "url": str(render_url.include_query_params(
+                w=PREVIEW_WIDTH, fmt=preview_format, q=PREVIEW_QUALITY, preset=preview_preset
+            )),
+            "format": preview_format,
+            "preset": preview_preset,
+        }
+    return refs
+
+def check_preview_options(preview_format: str, preview_preset: str):
+    """
+    Reject unknown preview_format / preview_preset form values
+    """
+    if preview_format and preview_format not in PREVIEW_FORMATS + ('auto',):
+        raise HTTPException(400, detail=f"preview_format must be one of {', '.join(PREVIEW_FORMATS + ('auto',))}")
+    if preview_preset not in ENCODER_PRESETS['jpg']:
+        raise HTTPException(400, detail=f"preview_preset must be one of {', '.join(ENCODER_PRESETS['jpg'])}")
+
+def check_generation_mode(generation_mode: str):
+    """
+    Reject unknown generation_mode form values
+    """
+    if generation_mode not in GENERATION_MODES:
+        raise HTTPException(400, detail=f"generation_mode must be one of {', '.join(GENERATION_MODES)}")
+
+async def get_rendition(svg_id: str, width: int, fmt: str, quality: int, preset: str, clean_svg: Optional[str] = None) -> bytes:
+    """
+    Fetch a rendition from the cache or render it once, however many
+    requests want it at the same time
+    """
+    key = rendition_key(svg_id, width, fmt, quality, preset)
+    data = rendition_cache.get(key)
+    if data is not None:
+        return data
+    if clean_svg is None:
+        svg_data = await asyncio.to_thread(asset_store.get, svg_id)
+        if svg_data is None:
+            raise HTTPException(404, detail="SVG not found")
+        clean_svg = svg_data.decode('utf-8')
+    data = await single_flight.run(
+        f"render:{key}", lambda: rasterize(render_rendition, clean_svg, width, fmt, quality, preset)
+    )
+    rendition_cache.remember(key, data)
+    return data
+
+async def build_preview(request: Request, images: Dict, preview_format: str, preview_preset: str) -> Dict:
+    """
+    Render the preview in the negotiated format, reporting what was chosen
+    """
+    fmt = negotiate_format(preview_format, request.headers.get("accept", ""))
+    svg_id, _ = await asyncio.to_thread(store_result_assets, images)
+    data = await get_rendition(svg_id, PREVIEW_WIDTH, fmt, PREVIEW_QUALITY, preview_preset, images['svg'])
+    logger.info(f"🖼️ Preview: {fmt} ({preview_preset}), {len(data)} bytes")
+    return {
+        "format": fmt,
+        "content_type": ASSET_CONTENT_TYPES[fmt],
+        "bytes": len(data),
+        "width": PREVIEW_WIDTH,
+        "preset": preview_preset,
+        "data": base64.b64encode(data).decode('utf-8'),
+    }
+
+def srcset_widths(base_width: int) -> Dict[int, int]:
+    """
+    Width for each SRCSET_SCALES scale, capped at RENDITION_MAX_WIDTH
+    """
+    return {scale: min(base_width * scale, RENDITION_MAX_WIDTH) for scale in SRCSET_SCALES}
+
+async def get_srcset(svg_id: str, base_width: int, fmt: str, quality: int, preset: str,
+                     clean_svg: Optional[str] = None):
+    """
+    Fetch a responsive set from the rendition cache or render it in one
+    pass; returns the images by width and the placeholder
+    """
+    widths = sorted(set(srcset_widths(base_width).values()))
+    keys = {width: rendition_key(svg_id, width, fmt, quality, preset) for width in widths}
+    placeholder_key = f"{svg_id.split('.')[0]}-placeholder.jpg"
+    renditions = {width: rendition_cache.get(key) for width, key in keys.items()}
+    placeholder = rendition_cache.get(placeholder_key)
+    if placeholder is not None and all(data is not None for data in renditions.values()):
+        return renditions, placeholder
+    
+    if clean_svg is None:
+        svg_data = await asyncio.to_thread(asset_store.get, svg_id)
+        if svg_data is None:
+            raise HTTPException(404, detail="SVG not found")
+        clean_svg = svg_data.decode('utf-8')
+    result = await single_flight.run(
+        f"srcset:{keys[widths[-1]]}:{base_width}",
+        lambda: rasterize(render_srcset, clean_svg, widths, fmt, quality, preset)
+    )
+    collect_render_metrics(result)
+    for width, data in result['renditions'].items():
+        rendition_cache.remember(keys[width], data)
+    rendition_cache.remember(placeholder_key, result['placeholder'])
+    return result['renditions'], result['placeholder']
+
+async def build_srcset(request: Request, svg_id: str, clean_svg: Optional[str], fmt: str, preset: str,
+                       base_width: int = SRCSET_BASE_WIDTH, quality: int = PREVIEW_QUALITY, inline: bool = False) -> Dict:
+    """
+    Describe a responsive set: each scale's width, height and size, with
+    /render URLs (already cached) or inline base64 data, plus the
+    placeholder as a data URI
+    """
+    fmt = negotiate_format(fmt, request.headers.get("accept", ""))
+    if clean_svg is None:
+        svg_data = await asyncio.to_thread(asset_store.get, svg_id)
+        if svg_data is None:
+            raise HTTPException(404, detail="SVG not found")
+        clean_svg = svg_data.decode('utf-8')
+    renditions, placeholder = await get_srcset(svg_id, base_width, fmt, quality, preset, clean_svg)
+    ratio = svg_aspect_ratio(clean_svg)
+    render_url = app.url_path_for("render_svg", svg_id=svg_id).make_absolute_url(request.base_url)
+    images = []
+    for scale, width in srcset_widths(base_width).items():
+        data = renditions[width]
+        entry = {"scale": scale, "width": width, "height": max(1, round(width * ratio)), "bytes": len(data)}
+        if inline:
+            entry["data"] = base64.b64encode(data).decode('utf-8')
+        else:
+            entry["url"] = str(render_url.include_query_params(w=width, fmt=fmt, q=quality, preset=preset))
+        images.append(entry)
+    logger.info(f"🖼️ Srcset: {fmt} ({preset}), " + ", ".join(f"{entry['width']}w {entry['bytes']}B" for entry in images))
+    return {
+        "format": fmt,
+        "content_type": ASSET_CONTENT_TYPES[fmt],
+        "preset": preset,
+        "images": images,
+        "placeholder": "data:image/jpeg;base64," + base64.b64encode(placeholder).decode('utf-8'),
+    }
+
+# Asynchronous jobs. Submissions are persisted to SQLite and consumed by
+# JOB_WORKERS workers, so queued work survives a restart and clients can poll
+# or take a callback instead of holding a connection open. A running job is
+# leased to the process that claimed it, which renews the lease every
+# JOB_LEASE / 3 seconds; only jobs whose lease ran out, because their process
+# died, are queued again, so uvicorn workers sharing jobs.db leave each
+# other's jobs alone.
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "jobs.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "8"))
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", "1000"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", str(24 * 3600)))
+JOB_POLL_INTERVAL = 1.0
+JOB_LEASE = float(os.getenv("JOB_LEASE", "60"))
+JOB_CALLBACK_TIMEOUT = float(os.getenv("JOB_CALLBACK_TIMEOUT", "10"))
+JOB_CALLBACK_ATTEMPTS = 3
+# Callback targets. JOB_CALLBACK_HOSTS, when set, is a comma-separated
+# allowlist of hosts (".example.com" also allows its subdomains). Callbacks
+# only go to public addresses, checked when the job is submitted and again on
+# the connected socket, and redirects are not followed.
+# JOB_CALLBACK_ALLOW_PRIVATE=1 lifts the address check for receivers on a
+# private network.
+JOB_CALLBACK_HOSTS = tuple(host.strip().lower() for host in os.getenv("JOB_CALLBACK_HOSTS", "").split(",") if host.strip())
+JOB_CALLBACK_ALLOW_PRIVATE = os.getenv("JOB_CALLBACK_ALLOW_PRIVATE", "0") == "1"
+
+class JobQueueFull(Exception):
+    pass
+
+class JobQueue:
+    """
+    Durable FIFO of generation jobs. A job moves from queued to running to
+    done or failed; running jobs whose lease has expired were interrupted
+    and are queued again, up to JOB_MAX_ATTEMPTS times.
+    """
+
+    def __init__(self, db_path: str, max_queued: int, retention: float, lease: float):
+        self.db_path = db_path
+        self.max_queued = max_queued
+        self.retention = retention
+        self.lease = lease
+        self.owner = None
+        self._lock = threading.Lock()
+        self._db = None
+
+    @property
+    def available(self) -> bool:
+        return self._db is not None
+
+    def open(self):
+        # Set here rather than at import so every worker process has its own
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        with self._lock:
+            self._db = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
+            self._db.row_factory = sqlite3.Row
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, text TEXT NOT NULL, image BLOB, "
+                "response_mode TEXT NOT NULL, base_url TEXT NOT NULL, callback_url TEXT, "
+                "callback_status TEXT, attempts INTEGER NOT NULL DEFAULT 0, result TEXT, error TEXT, "
+                "created_at REAL NOT NULL, started_at REAL, finished_at REAL, owner TEXT, lease_until REAL)"
+            )
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+            for column, kind in (("owner", "TEXT"), ("lease_until", "REAL")):
+                if column not in columns:
+                    self._db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status_created_at ON jobs (status, created_at)")
+            self._db.commit()
+        self.recover()
+        self.purge()
+
+    def recover(self):
+        """
+        Queue again the running jobs whose lease has expired, failing those
+        already tried JOB_MAX_ATTEMPTS times
+        """
+        expired = "status = 'running' AND (lease_until IS NULL OR lease_until < ?)"
+        now = time.time()
+        with self._lock:
+            failed = self._db.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Job interrupted too many times', "
+                f"image = NULL, finished_at = ? WHERE {expired} AND attempts >= ?",
+                (now, now, JOB_MAX_ATTEMPTS),
+            ).rowcount
+            requeued = self._db.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL, owner = NULL, lease_until = NULL "
+                f"WHERE {expired}",
+                (now,),
+            ).rowcount
+            self._db.commit()
+        if requeued or failed:
+            logger.info(f"📋 Recovered {requeued} interrupted job(s), {failed} given up")
+
+    def renew(self):
+        """
+        Extend the lease on every job this process is running
+        """
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET lease_until = ? WHERE status = 'running' AND owner = ?",
+                (time.time() + self.lease, self.owner),
+            )
+            self._db.commit()
+
+    def submit(self, image_bytes: bytes, text: str, response_mode: str, base_url: str,
+               callback_url: Optional[str]) -> Dict:
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            queued = self._db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= self.max_queued:
+                raise JobQueueFull()
+            self._db.execute(
+                "INSERT INTO jobs (id, status, text, image, response_mode, base_url, callback_url, created_at) "
+                "VALUES (?, 'queued', ?, ?, ?, ?, ?, ?)",
+                (job_id, text, image_bytes, response_mode, base_url, callback_url, time.time()),
+            )
+            self._db.commit()
+        return {"id": job_id, "queue_position": queued + 1}
+
+    def claim(self) -> Optional[Dict]:
+        """
+        Mark the oldest queued job running and return it with its image
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1, "
+                "owner = ?, lease_until = ? "
+                "WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1) "
+                "RETURNING id, text, image, response_mode, created_at",
+                (now, self.owner, now + self.lease),
+            ).fetchone()
+            self._db.commit()
+        return dict(row) if row is not None else None
+
+    def finish(self, job_id: str, result: Optional[Dict] = None, error: Optional[str] = None) -> bool:
+        # A job whose lease was lost has been queued again; leave it be
+        with self._lock:
+            finished = self._db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, image = NULL, finished_at = ?, lease_until = NULL "
+                "WHERE id = ? AND status = 'running' AND owner = ?",
+                ('failed' if error is not None else 'done',
+                 json.dumps(result) if result is not None else None, error, time.time(), job_id, self.owner),
+            ).rowcount
+            self._db.commit()
+        return finished > 0
+
+    def set_callback_status(self, job_id: str, status: str):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET callback_status = ? WHERE id = ?", (status, job_id))
+            self._db.commit()
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, status, response_mode, base_url, callback_url, callback_status, attempts, "
+                "result, error, created_at, started_at, finished_at FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            job = dict(row)
+            if job["status"] == 'queued':
+                job["queue_position"] = self._db.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at <= ?",
+                    (job["created_at"],),
+                ).fetchone()[0]
+        if job["result"] is not None:
+            job["result"] = json.loads(job["result"])
+        return job
+
+    def purge(self):
+        """
+        Drop finished jobs older than the retention period
+        """
+        with self._lock:
+            purged = self._db.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+                (time.time() - self.retention,),
+            ).rowcount
+            self._db.commit()
+        if purged:
+            logger.info(f"📋 Purged {purged} finished job(s)")
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def snapshot(self) -> Dict:
+        now = time.time()
+        with self._lock:
+            counts = dict(self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            oldest = self._db.execute(
+                "SELECT MIN(created_at) FROM jobs WHERE status = 'queued'"
+            ).fetchone()[0]
+            wait = self._db.execute(
+                "SELECT AVG(started_at - created_at), MAX(started_at - created_at), COUNT(*) "
+                "FROM jobs WHERE started_at >= ?",
+                (now - 3600,),
+            ).fetchone()
+        return {
+            "queued": counts.get('queued', 0),
+            "running": counts.get('running', 0),
+            "done": counts.get('done', 0),
+            "failed": counts.get('failed', 0),
+            "max_queued": self.max_queued,
+            "workers": JOB_WORKERS,
+            "oldest_queued_seconds": round(now - oldest, 3) if oldest is not None else 0,
+            "wait_seconds_last_hour": {
+                "avg": round(wait[0] or 0, 3),
+                "max": round(wait[1] or 0, 3),
+                "jobs": wait[2],
+            },
+        }
+
+job_queue = JobQueue(JOB_DB_PATH, JOB_MAX_QUEUED, JOB_RETENTION, JOB_LEASE)
+
+async def read_upload(image: UploadFile, max_size: int = MAX_UPLOAD_SIZE) -> bytes:
+    """
+    Read an upload in chunks, rejecting it once it exceeds max_size. The form
+    parser has already spooled it; BodyLimitMiddleware bounds the request.
+    """
+    too_large = f"Image too large (max {max_size / (1024 * 1024):g}MB)"
+    if image.size is not None and image.size > max_size:
+        raise HTTPException(400, detail=too_large)
+    
+    chunks = []
+    total = 0
+    with stage("upload_read"):
+        while True:
+            chunk = await image.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            total += len(chunk)
+            if total > max_size:
+                raise HTTPException(400, detail=too_large)
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+def prepare_model_image(image_bytes: bytes, max_side: int = MODEL_IMAGE_MAX_SIDE) -> bytes:
+    """
+    Decode an upload at (close to) the resolution Gemini uses, fix its EXIF
+    orientation and re-encode it as a compact JPEG
+    """
+    from PIL import Image, ImageOps
+    pil_image = Image.open(BytesIO(image_bytes))
+    if pil_image.format == 'JPEG':
+        # Let libjpeg decode at a reduced scale instead of the full 12MP
+        pil_image.draft('RGB', (max_side, max_side))
+    pil_image = ImageOps.exif_transpose(pil_image)
+    
+    if pil_image.mode in ('RGBA', 'LA', 'P'):
+        white_bg = Image.new('RGB', pil_image.size, (255, 255, 255))
+        pil_image = pil_image.convert('RGBA')
+        white_bg.paste(pil_image, mask=pil_image.split()[-1])
+        pil_image = white_bg
+    elif pil_image.mode != 'RGB':
+        pil_image = pil_image.convert('RGB')
+    
+    pil_image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    
+    buffer = BytesIO()
+    pil_image.save(buffer, format='JPEG', quality=MODEL_IMAGE_QUALITY)
+    return buffer.getvalue()
+
+async def run_in_render_pool(func, *args):
+    """
+    Run CPU-bound work on the render executor, capped at RENDER_CONCURRENCY
+    """
+    async with render_semaphore:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(render_executor, func, *args)
+
+async def rasterize(func, *args):
+    """
+    Run a rasterization function on the render process pool
+    """
+    try:
+        with stage("render"):
+            return await render_pool.submit(func, *args)
+    except RenderQueueFull:
+        raise HTTPException(503, detail="Renderer busy, please retry", headers={"Retry-After": "1"})
+
+async def rasterize_previews(clean_svg: str) -> Dict:
+    """
+    Render the JPG/PNG previews on the render pool and record their stages
+    """
+    return collect_render_metrics(await rasterize(render_previews, clean_svg))
+
+def llm_http_error(error: Exception) -> Optional[HTTPException]:
+    """
+    The HTTP error for a model call the policy gave up on, or None for
+    errors that are not the backend's (those propagate unchanged)
+    """
+    if isinstance(error, CircuitOpen):
+        return HTTPException(
+            503, detail="Model temporarily unavailable, please retry",
+            headers={"Retry-After": str(max(1, math.ceil(error.retry_after)))}
+        )
+    if isinstance(error, DeadlineExceeded):
+        return HTTPException(504, detail="Model timed out")
+    if llm_backend.retryable(error):
+        return HTTPException(502, detail="Model request failed")
+    return None
+
+async def call_model(make_call) -> str:
+    """
+    Run a backend call under the call policy, capped at LLM_CONCURRENCY
+    """
+    async with llm_semaphore:
+        try:
+            return await llm_policy.call(make_call)
+        except Exception as e:
+            error = llm_http_error(e)
+            if error is None:
+                raise
+            raise error from e
+
+async def call_llm(request_text: str, model_image: bytes, mode: str = "svg") -> str:
+    return await call_model(lambda: llm_backend.generate(request_text, model_image, mode))
+
+async def call_llm_refine(prompt_text: str, image: Optional[bytes]) -> str:
+    return await call_model(lambda: llm_backend.refine(prompt_text, image))
+
+async def call_llm_stream(request_text: str, model_image: bytes, is_complete=lambda: False) -> AsyncIterator[str]:
+    """
+    Stream LLM output text chunk by chunk, capped at LLM_CONCURRENCY. Close
+    it (e.g. with aclosing) when stopping early, so the slot is freed at once;
+    is_complete() tells the policy whether that was a success.
+    """
+    async with llm_semaphore:
+        try:
+            stream = llm_policy.stream(lambda: llm_backend.stream(request_text, model_image), is_complete)
+            async with aclosing(stream) as deltas:
+                async for delta in deltas:
+                    yield delta
+        except Exception as e:
+            error = llm_http_error(e)
+            if error is None:
+                raise
+            raise error from e
+
+def build_request_text(text: str, context_label: str) -> str:
+    """
+    The per-request part of the prompt: the user's text under the given label
+    """
+    if text and text.strip():
+        return f"{context_label}: {text}"
+    return ""
+
+async def produce_svg(image_bytes: bytes, request_text: str, cache_key: str, mode: str = "svg") -> Dict:
+    """
+    Run the LLM for one upload and cache the cleaned SVG; in layout mode the
+    model's JSON spec is rendered to SVG locally instead
+    """
+    with stage("image_prep"):
+        model_image = await run_in_render_pool(prepare_model_image, image_bytes)
+    
+    logger.info(f"🤖 Calling {llm_backend.name} ({len(model_image)} image bytes)...")
+    
+    with stage("llm"):
+        svg_text = await call_llm(request_text, model_image, mode)
+    
+    if not svg_text:
+        raise HTTPException(500, detail="Gemini returned empty response")
+    
+    logger.info(f"✅ {llm_backend.name} response ({len(svg_text)} chars)")
+    
+    if mode == "layout":
+        with stage("layout"):
+            try:
+                images = await run_in_render_pool(layout_to_images, svg_text)
+            except LayoutError as e:
+                raise HTTPException(502, detail=f"Model returned an invalid layout: {str(e)}") from e
+    else:
+        with stage("svg_clean"):
+            images = await run_in_render_pool(clean_and_optimize_svg, svg_text)
+    record_optimization(images)
+    await asyncio.to_thread(result_cache.set, cache_key, images)
+    return images
+
+async def add_previews(images: Dict, cache_key: str) -> Dict:
+    """
+    Render the JPG/PNG previews for a result that does not have them yet
+    """
+    if images.get('jpg'):
+        return images
+    
+    logger.info("🖼️ Creating images...")
+    previews = await rasterize_previews(images['svg'])
+    images = {**images, **previews}
+    if '_failed_stage' not in previews:
+        await asyncio.to_thread(result_cache.set, cache_key, images)
+    return images
+
+async def get_or_generate_images(image_bytes: bytes, text: str, context_label: str, previews: bool = True,
+                                 mode: str = GENERATION_MODE) -> Dict:
+    """
+    Serve from cache, join an identical in-flight request, or generate afresh.
+    Raster previews are only rendered when asked for.
+    """
+    request_text = build_request_text(text, context_label)
+    cache_key = await asyncio.to_thread(ResultCache.make_key, image_bytes, request_text, mode)
+    images = await asyncio.to_thread(result_cache.get, cache_key)
+    if images is not None:
+        logger.info("⚡ Cache hit")
+    else:
+        images = await single_flight.run(
+            cache_key, lambda: produce_svg(image_bytes, request_text, cache_key, mode)
+        )
+    
+    if previews and not images.get('jpg'):
+        images = await single_flight.run(
+            f"{cache_key}:previews", lambda: add_previews(images, cache_key)
+        )
+    return images
+
+# Refinement sessions. /generate-svg with session=true keeps a smaller copy
+# of the upload, the latest SVG and the instructions so far, so follow-ups to
+# /sessions/{id}/refine send only the instruction. Sessions live in this
+# process's memory, expire SESSION_TTL after their last use and are evicted
+# least recently used first beyond SESSION_MAX_BYTES.
+SESSION_TTL = float(os.getenv("SESSION_TTL", "1800"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(64 * 1024 * 1024)))
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "8"))
+SESSION_IMAGE_MAX_SIDE = int(os.getenv("SESSION_IMAGE_MAX_SIDE", "768"))
+REFINE_SEND_IMAGE = os.getenv("REFINE_SEND_IMAGE", "1") != "0"
+
+class SessionStore:
+    """
+    In-memory refinement sessions with a TTL and a total size bound
+    """
+
+    def __init__(self, ttl: float, max_bytes: int, max_turns: int):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_turns = max_turns
+        self._sessions = OrderedDict()
+        self._size = 0
+        self.stats = {"created": 0, "expired": 0, "evicted": 0, "refines": 0, "local_edits": 0}
+
+    @staticmethod
+    def _session_size(session: Dict) -> int:
+        return len(session["image"]) + len(session["svg"]) + sum(len(turn["instruction"]) for turn in session["turns"])
+
+    def _remove(self, session_id: str):
+        session = self._sessions.pop(session_id)
+        self._size -= session["size"]
+
+    def _resize(self, session: Dict):
+        self._size -= session["size"]
+        session["size"] = self._session_size(session)
+        self._size += session["size"]
+        while self._size > self.max_bytes and len(self._sessions) > 1:
+            oldest = next(iter(self._sessions))
+            self._remove(oldest)
+            self.stats["evicted"] += 1
+
+    def _expire(self):
+        now = time.time()
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if session["updated_at"] + self.ttl > now:
+                break
+            self._remove(session_id)
+            self.stats["expired"] += 1
+
+    def create(self, image: bytes, svg: str, text: str) -> Dict:
+        self._expire()
+        now = time.time()
+        session = {
+            "id": uuid.uuid4().hex,
+            "image": image,
+            "svg": svg,
+            "turns": [{"instruction": text, "edit": "generate", "at": now}],
+            "created_at": now,
+            "updated_at": now,
+            "size": 0,
+            "lock": asyncio.Lock(),
+        }
+        self._sessions[session["id"]] = session
+        self.stats["created"] += 1
+        self._resize(session)
+        return session
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        self._expire()
+        session = self._sessions.get(session_id)
+        if session is not None:
+            session["updated_at"] = time.time()
+            self._sessions.move_to_end(session_id)
+        return session
+
+    def update(self, session: Dict, svg: str, instruction: str, edit: str):
+        session["svg"] = svg
+        session["turns"].append({"instruction": instruction, "edit": edit, "at": time.time()})
+        # The first turn holds the original context; keep it and the latest ones
+        if len(session["turns"]) > self.max_turns:
+            session["turns"] = session["turns"][:1] + session["turns"][-(self.max_turns - 1):]
+        session["updated_at"] = time.time()
+        self.stats["refines"] += 1
+        self.stats["local_edits"] += edit == "local"
+        if session["id"] in self._sessions:
+            self._sessions.move_to_end(session["id"])
+            self._resize(session)
+
+    def delete(self, session_id: str) -> bool:
+        if session_id not in self._sessions:
+            return False
+        self._remove(session_id)
+        return True
+
+    def snapshot(self) -> Dict:
+        self._expire()
+        return {"sessions": len(self._sessions), "bytes": self._size, "max_bytes": self.max_bytes, **self.stats}
+
+session_store = SessionStore(SESSION_TTL, SESSION_MAX_BYTES, SESSION_MAX_TURNS)
+
+async def open_session(image_bytes: bytes, text: str, images: Dict) -> Dict:
+    """
+    Start a refinement session for a generated result
+    """
+    with stage("session_image"):
+        image = await run_in_render_pool(prepare_model_image, image_bytes, SESSION_IMAGE_MAX_SIDE)
+    session = session_store.create(image, images['svg'], text)
+    logger.info(f"💬 Session {session['id']} opened ({session['size']} bytes)")
+    return {"session_id": session["id"]}
+
+def build_refine_text(session: Dict, instruction: str) -> str:
+    """
+    The refine request: the editing instructions, the current SVG and the
+    conversation so far, but not PROMPT or a fresh upload
+    """
+    original, *earlier = session["turns"]
+    parts = [REFINE_PROMPT]
+    if original["instruction"].strip():
+        parts.append(f"Original context: {original['instruction']}")
+    if earlier:
+        parts.append("Changes already made:\n" + "\n".join(f"- {turn['instruction']}" for turn in earlier))
+    parts.append(f"Current SVG:\n```svg\n{session['svg']}\n```")
+    parts.append(f"Requested change: {instruction}")
+    return "\n\n".join(parts)
+
+async def refine_svg(session: Dict, instruction: str):
+    """
+    Apply an instruction to the session's SVG, locally when possible,
+    otherwise through the model; returns the images and the edit kind
+    """
+    edited = None
+    if REFINE_LOCAL_EDITS:
+        with stage("local_edit"):
+            edited = await run_in_render_pool(apply_local_edit, session['svg'], instruction)
+    if edited is not None:
+        with stage("svg_clean"):
+            images = await run_in_render_pool(finish_svg, edited)
+        edit = "local"
+    else:
+        prompt_text = build_refine_text(session, instruction)
+        logger.info(f"🤖 Refining with {llm_backend.name} ({len(prompt_text)} chars, no PROMPT)...")
+        with stage("llm"):
+            svg_text = await call_llm_refine(prompt_text, session['image'] if REFINE_SEND_IMAGE else None)
+        if not svg_text or '<svg' not in svg_text:
+            raise HTTPException(502, detail="Model returned no SVG")
+        with stage("svg_clean"):
+            images = await run_in_render_pool(clean_and_optimize_svg, svg_text)
+        edit = "model"
+    
+    record_optimization(images)
+    session_store.update(session, images['svg'], instruction, edit)
+    logger.info(f"✏️ Session {session['id']} refined ({edit})")
+    return images, edit
+
+# Startup warm-up. STARTUP_WARMUP=0 skips rendering a sample and waiting for
+# the model connection, so /ready passes as soon as the render pool is up.
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "1") != "0"
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "30"))
+warmup_state = {"ready": False, "seconds": None, "steps": {}}
+
+async def warmup_step(name: str, awaitable):
+    """
+    Run one warm-up step, recording its duration and any failure; a failed
+    step is logged but does not keep the service from becoming ready
+    """
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(awaitable, WARMUP_TIMEOUT)
+        result = {"ok": True}
+    except Exception as e:
+        logger.warning(f"Warm-up step {name} failed: {type(e).__name__}: {str(e)}")
+        result = {"ok": False, "error": f"{type(e).__name__}: {str(e)}"}
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    warmup_state["steps"][name] = result
+
+async def warm_renderer():
+    images = await render_pool.submit(render_previews, WARMUP_SVG)
+    if '_failed_stage' in images:
+        raise RuntimeError(f"{images['_failed_stage']} failed")
+
+def warm_pillow():
+    """
+    Load Pillow and its codec plugins in this process, which decodes uploads
+    """
+    from PIL import Image, ImageOps  # noqa: F401
+    Image.init()
+    supported_preview_formats()
+
+async def warm_up(llm_start: asyncio.Task):
+    """
+    Start the render pool, then render a tiny SVG (loading cairo, fonts and
+    the encoders) and load Pillow here while the model client connects
+    """
+    start = time.perf_counter()
+    if RENDER_PROCESSES > 0:
+        try:
+            await asyncio.to_thread(render_pool.start)
+        except Exception as e:
+            logger.error(f"Render pool unavailable, rendering on threads: {str(e)}")
+    if STARTUP_WARMUP:
+        await asyncio.gather(
+            warmup_step("render", warm_renderer()),
+            warmup_step("pillow", asyncio.to_thread(warm_pillow)),
+            # Shielded so a slow model does not lose its prompt cache on timeout
+            warmup_step("llm", asyncio.shield(llm_start)),
+        )
+    warmup_state["seconds"] = round(time.perf_counter() - start, 3)
+    warmup_state["ready"] = True
+    logger.info(f"🔥 Warm-up done in {warmup_state['seconds']:.2f}s")
+
+@app.post("/generate-svg")
+async def generate_svg(
+    request: Request,
+    text: str = Form(""),
+    image: UploadFile = File(...),
+    response_mode: str = Form("inline"),
+    previews: bool = Form(True),
+    preview_format: str = Form(""),
+    preview_preset: str = Form(PREVIEW_PRESET),
+    session: bool = Form(False),
+    generation_mode: str = Form(GENERATION_MODE),
+    srcset: bool = Form(False)
+):
+    """
+    Main endpoint for React Native app
+    Returns JSON exactly as React Native expects
+    With response_mode=urls, returns asset URLs instead of inline base64 and
+    renders previews only when those URLs are fetched
+    preview_format (jpg, png, png8, webp, avif or auto, which follows the
+    Accept header) replaces the jpg/png pair with a single "preview"
+    session=true adds a session_id for follow-ups to /sessions/{id}/refine
+    generation_mode=layout has the model return a JSON layout that is
+    rendered to SVG locally
+    srcset=true adds 1x/2x/3x images (in preview_format, default jpg) and a
+    blurred placeholder, rendered in one pass
+    """
+    try:
+        logger.info(f"📱 React Native request received")
+        logger.info(f"📝 Text: {text[:100] if text else 'None'}")
+        logger.info(f"🖼️ Image: {image.filename}")
+        
+        # Validate image
+        if not image.content_type or not image.content_type.startswith('image/'):
+            raise HTTPException(400, detail="File must be an image")
+        
+        check_preview_options(preview_format, preview_preset)
+        check_generation_mode(generation_mode)
+        
+        # Read image, stopping as soon as it exceeds 10MB
+        image_bytes = await read_upload(image)
+        
+        images = await get_or_generate_images(
+            image_bytes, text, "Additional context",
+            previews=previews and response_mode != "urls" and not preview_format, mode=generation_mode
+        )
+        extra = await open_session(image_bytes, text, images) if session else {}
+        if srcset:
+            svg_id, _ = await asyncio.to_thread(store_result_assets, images)
+            extra["srcset"] = await build_srcset(
+                request, svg_id, images['svg'], preview_format or 'jpg', preview_preset, inline=response_mode != "urls"
+            )
+        
+        if response_mode == "urls":
+            return {
+                "assets": await build_asset_refs(request.base_url, images, preview_format, preview_preset),
+                **extra,
+                "success": True
+            }
+        
+        if preview_format:
+            return {
+                "svg": images.get('svg', ''),
+                "jpg": "",
+                "png": "",
+                "preview": await build_preview(request, images, preview_format, preview_preset) if previews else None,
+                **extra,
+                "success": True
+            }
+        
+        # Return EXACTLY what React Native expects
+        return {
+            "svg": images.get('svg', ''),
+            "jpg": images.get('jpg', ''),  # This is what React Native uses for preview
             "png": images.get('png', ''),
+            **extra,
             # Optional: Add success flag
             "success": True
         }
@@ -500,34 +4401,571 @@ async def generate_svg(
             "error": str(e)
         }
 
-@app.post("/generate-analysis")
-async def generate_analysis(
+def sse_event(event: str, data: Dict) -> str:
+    """
+    Format one Server-Sent Event
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def stream_generation(image_bytes: bytes, text: str) -> AsyncIterator[str]:
+    """
+    Yield SSE events for one generation: the cleaned SVG is sent as soon as the
+    model closes the root element, before the raster previews are rendered
+    """
+    yield sse_event("received", {"bytes": len(image_bytes)})
+    try:
+        request_text = build_request_text(text, "Additional context")
+        cache_key = await asyncio.to_thread(ResultCache.make_key, image_bytes, request_text)
+        images = await asyncio.to_thread(result_cache.get, cache_key)
+        if images is not None:
+            yield sse_event("svg-complete", {"svg": images.get('svg', ''), "bytes_saved": images.get('svg_bytes_saved', 0), "cached": True})
+            images = await add_previews(images, cache_key)
+            yield sse_event("preview-ready", {"jpg": images.get('jpg', ''), "png": images.get('png', ''), "cached": True})
+            yield sse_event("done", {"success": True})
+            return
+        
+        with stage("image_prep"):
+            model_image = await run_in_render_pool(prepare_model_image, image_bytes)
+        
+        yield sse_event("generating", {"chars": 0, "delta": ""})
+        sanitizer = SVGSanitizer()
+        svg_parts = []
+        chars = 0
+        with stage("llm"):
+            stream = call_llm_stream(request_text, model_image, lambda: sanitizer.complete)
+            async with aclosing(stream) as deltas:
+                async for delta in deltas:
+                    chars += len(delta)
+                    svg_parts.append(sanitizer.feed(delta))
+                    yield sse_event("generating", {"chars": chars, "delta": delta})
+                    if sanitizer.complete:
+                        # Anything after the closing tag is markdown fence noise
+                        break
+        
+        if not chars:
+            raise HTTPException(500, detail="Gemini returned empty response")
+        
+        logger.info(f"✅ {llm_backend.name} stream complete ({chars} chars)")
+        
+        svg_parts.append(sanitizer.close())
+        with stage("svg_clean"):
+            result = await run_in_render_pool(finish_svg, ''.join(svg_parts))
+        record_optimization(result)
+        yield sse_event("svg-complete", {"svg": result['svg'], "bytes_saved": result['svg_bytes_saved']})
+        
+        images = await rasterize_previews(result['svg'])
+        images.update(result)
+        if images.get('jpg') and '_failed_stage' not in images:
+            await asyncio.to_thread(result_cache.set, cache_key, images)
+        yield sse_event("preview-ready", {"jpg": images.get('jpg', ''), "png": images.get('png', '')})
+        yield sse_event("done", {"success": True})
+        
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        logger.error(f"Streaming error: {detail}", exc_info=True)
+        yield sse_event("error", {"error": detail})
+
+@app.post("/generate-svg/stream")
+async def generate_svg_stream(
     text: str = Form(""),
     image: UploadFile = File(...)
 ):
     """
-    Alternative endpoint with detailed response
+    Streaming variant of /generate-svg over Server-Sent Events
+    Emits received, generating, svg-complete, preview-ready and done events
     """
+    logger.info(f"📱 React Native streaming request received")
+    
+    if not image.content_type or not image.content_type.startswith('image/'):
+        raise HTTPException(400, detail="File must be an image")
+    
+    image_bytes = await read_upload(image)
+    
+    return StreamingResponse(
+        stream_generation(image_bytes, text),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Batch submissions fan out over the items; each item still goes through the
+# global LLM and render limits, and a batch never holds more than
+# BATCH_CONCURRENCY of them in flight so one batch cannot starve other users.
+# Uploads stay spooled by the form parser until their item runs, so a batch
+# holds at most BATCH_CONCURRENCY of them in memory; BATCH_MAX_BYTES caps the
+# whole request.
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "32"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", str(64 * 1024 * 1024)))
+
+async def generate_batch_item(
+    request: Request,
+    index: int,
+    image: UploadFile,
+    text: str,
+    response_mode: str,
+    preview_format: str,
+    preview_preset: str,
+    limit: asyncio.Semaphore
+) -> Dict:
+    """
+    Generate one batch item, turning any failure into an error result
+    """
+    result = {"index": index, "filename": image.filename}
     try:
-        # Same logic as generate-svg but with different response format
-        image_bytes = await image.read()
-        pil_image = Image.open(BytesIO(image_bytes))
+        if not image.content_type or not image.content_type.startswith('image/'):
+            raise HTTPException(400, detail="File must be an image")
+        
+        async with limit:
+            image_bytes = await read_upload(image)
+            images = await get_or_generate_images(
+                image_bytes, text, "Additional context", previews=response_mode != "urls" and not preview_format
+            )
+        
+        if response_mode == "urls":
+            result["assets"] = await build_asset_refs(request.base_url, images, preview_format, preview_preset)
+        elif preview_format:
+            async with limit:
+                preview = await build_preview(request, images, preview_format, preview_preset)
+            result.update(svg=images.get('svg', ''), jpg='', png='', preview=preview)
+        else:
+            result.update(svg=images.get('svg', ''), jpg=images.get('jpg', ''), png=images.get('png', ''))
+        result["success"] = True
         
-        full_prompt = PROMPT
-        if text and text.strip():
-            full_prompt = f"{PROMPT}\n\nUser context: {text}"
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        logger.error(f"Batch item {index} failed: {detail}")
+        result.update(success=False, error=detail)
+    return result
+
+async def stream_batch(tasks) -> AsyncIterator[str]:
+    """
+    Yield one SSE item event per result as it finishes, then a done summary
+    """
+    succeeded = 0
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            result = await next_result
+            succeeded += result["success"]
+            yield sse_event("item", result)
+        yield sse_event("done", {"success": True, "succeeded": succeeded, "failed": len(tasks) - succeeded})
+    finally:
+        # The client went away; stop work nobody will receive
+        for task in tasks:
+            task.cancel()
+
+@app.post("/generate-svg/batch")
+async def generate_svg_batch(
+    request: Request,
+    images: List[UploadFile] = File(...),
+    texts: List[str] = Form([]),
+    text: str = Form(""),
+    response_mode: str = Form("inline"),
+    preview_format: str = Form(""),
+    preview_preset: str = Form(PREVIEW_PRESET),
+    stream: bool = Form(False)
+):
+    """
+    Generate SVGs for several images in one request
+    texts[i] is the context for images[i], falling back to text. Each item
+    succeeds or fails on its own. With stream=true results are sent as
+    Server-Sent Events in completion order; otherwise they are returned
+    together in upload order.
+    """
+    logger.info(f"📱 Batch request received ({len(images)} images)")
+    
+    if len(images) > BATCH_MAX_ITEMS:
+        raise HTTPException(400, detail=f"Too many images (max {BATCH_MAX_ITEMS})")
+    check_preview_options(preview_format, preview_preset)
+    
+    # Each item reads its own upload when it runs; the form's files stay
+    # open until the response, streamed or not, has been sent
+    limit = asyncio.Semaphore(BATCH_CONCURRENCY)
+    tasks = [
+        asyncio.ensure_future(generate_batch_item(
+            request, index, image,
+            texts[index] if index < len(texts) and texts[index].strip() else text,
+            response_mode, preview_format, preview_preset, limit
+        ))
+        for index, image in enumerate(images)
+    ]
+    
+    if stream:
+        return StreamingResponse(
+            stream_batch(tasks),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    
+    results = await asyncio.gather(*tasks)
+    succeeded = sum(result["success"] for result in results)
+    return {
+        "items": results,
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "success": True
+    }
+
+async def job_response(job: Dict) -> Dict:
+    """
+    Public view of a job, with its result in the shape /generate-svg returns
+    """
+    body = {
+        "id": job["id"],
+        "status": job["status"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+    }
+    if job["started_at"] is not None:
+        body["wait_seconds"] = round(job["started_at"] - job["created_at"], 3)
+    if "queue_position" in job:
+        body["queue_position"] = job["queue_position"]
+    if job["callback_url"]:
+        body["callback_status"] = job["callback_status"] or "pending"
+    if job["status"] == 'done':
+        images = job["result"]
+        if job["response_mode"] == "urls":
+            body["result"] = {"assets": await build_asset_refs(job["base_url"], images), "success": True}
+        else:
+            body["result"] = {
+                "svg": images.get('svg', ''),
+                "jpg": images.get('jpg', ''),
+                "png": images.get('png', ''),
+                "success": True
+            }
+    elif job["status"] == 'failed':
+        body["error"] = job["error"]
+    return body
+
+def check_callback_address(address: str):
+    ip = ipaddress.ip_address(address.split('%', 1)[0])
+    if getattr(ip, "ipv4_mapped", None) is not None:
+        ip = ip.ipv4_mapped
+    if not JOB_CALLBACK_ALLOW_PRIVATE and (not ip.is_global or ip.is_multicast):
+        raise ValueError(f"callback_url must not point at a private address ({ip})")
+
+def check_callback_url(callback_url: str):
+    """
+    Validate a callback URL's scheme, host and resolved addresses, raising
+    ValueError with the reason
+    """
+    parts = urllib.parse.urlsplit(callback_url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError("callback_url must be an http(s) URL")
+    host = parts.hostname.lower()
+    if JOB_CALLBACK_HOSTS and not any(
+        host == allowed or (allowed.startswith('.') and host.endswith(allowed)) for allowed in JOB_CALLBACK_HOSTS
+    ):
+        raise ValueError(f"callback_url host {host} is not allowed")
+    try:
+        addresses = socket.getaddrinfo(host, parts.port or (443 if parts.scheme == 'https' else 80), proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, ValueError) as e:
+        raise ValueError(f"callback_url host {host} does not resolve") from e
+    for *_, sockaddr in addresses:
+        check_callback_address(sockaddr[0])
+
+class _CallbackHTTPConnection(http.client.HTTPConnection):
+    # The address is checked again once connected, in case DNS changed
+    def connect(self):
+        super().connect()
+        check_callback_address(self.sock.getpeername()[0])
+
+class _CallbackHTTPSConnection(http.client.HTTPSConnection):
+    def connect(self):
+        super().connect()
+        check_callback_address(self.sock.getpeername()[0])
+
+class _CallbackHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_CallbackHTTPConnection, req)
+
+class _CallbackHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_CallbackHTTPSConnection, req, context=self._context)
+
+class _NoRedirectHandler(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+# No proxies from the environment, so the checked address is the receiver's
+callback_opener = urllib.request.build_opener(
+    urllib.request.ProxyHandler({}), _CallbackHTTPHandler, _CallbackHTTPSHandler, _NoRedirectHandler
+)
+
+def post_callback(callback_url: str, body: Dict) -> bool:
+    """
+    POST a finished job to its callback URL, retrying with backoff
+    """
+    data = json.dumps(body).encode('utf-8')
+    for attempt in range(JOB_CALLBACK_ATTEMPTS):
+        try:
+            req = urllib.request.Request(
+                callback_url, data=data, headers={"Content-Type": "application/json"}, method="POST"
+            )
+            with callback_opener.open(req, timeout=JOB_CALLBACK_TIMEOUT) as response:
+                if response.status < 300:
+                    return True
+        except Exception as e:
+            logger.error(f"Callback to {callback_url} failed (attempt {attempt + 1}): {str(e)}")
+        if attempt + 1 < JOB_CALLBACK_ATTEMPTS:
+            time.sleep(2 ** attempt)
+    return False
+
+async def acquire_job_slot():
+    """
+    Wait for an admission slot in the job lane, however long it takes; a
+    job turned away tries again after the suggested Retry-After
+    """
+    while True:
+        try:
+            await admission.acquire("job")
+            return
+        except Overloaded as e:
+            await asyncio.sleep(e.retry_after)
+
+async def run_job(job: Dict):
+    """
+    Generate one claimed job through the usual pipeline and record the outcome
+    """
+    job_id = job["id"]
+    logger.info(f"📋 Job {job_id} started after {time.time() - job['created_at']:.1f}s in queue")
+    try:
+        await acquire_job_slot()
+        start = time.perf_counter()
+        try:
+            images = await get_or_generate_images(
+                job["image"], job["text"], "Additional context", previews=job["response_mode"] != "urls"
+            )
+        finally:
+            admission.release("job", time.perf_counter() - start)
+        finished = await asyncio.to_thread(job_queue.finish, job_id, result=images)
+        logger.info(f"✅ Job {job_id} done")
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        logger.error(f"Job {job_id} failed: {detail}")
+        finished = await asyncio.to_thread(job_queue.finish, job_id, error=detail)
+    if not finished:
+        logger.warning(f"📋 Job {job_id} lost its lease and was queued again")
+        return
+    
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is not None and job["callback_url"]:
+        sent = await asyncio.to_thread(post_callback, job["callback_url"], await job_response(job))
+        await asyncio.to_thread(job_queue.set_callback_status, job_id, "sent" if sent else "failed")
+
+async def job_worker():
+    """
+    Claim and run queued jobs until cancelled, purging old ones when idle
+    """
+    last_purge = time.monotonic()
+    while True:
+        job_wakeup.clear()
+        try:
+            job = await asyncio.to_thread(job_queue.claim)
+        except Exception as e:
+            logger.error(f"Job queue error: {str(e)}")
+            job = None
+        if job is not None:
+            await run_job(job)
+            continue
         
-        response = client.models.generate_content(
-            model="gemini-2.5-flash-image",
-            contents=[full_prompt, pil_image],
+        if time.monotonic() - last_purge > 60:
+            last_purge = time.monotonic()
+            await asyncio.to_thread(job_queue.purge)
+        try:
+            await asyncio.wait_for(job_wakeup.wait(), JOB_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+async def job_heartbeat():
+    """
+    Renew this process's job leases and requeue jobs whose lease expired
+    """
+    while True:
+        await asyncio.sleep(JOB_LEASE / 3)
+        try:
+            await asyncio.to_thread(job_queue.renew)
+            await asyncio.to_thread(job_queue.recover)
+        except Exception as e:
+            logger.error(f"Job queue error: {str(e)}")
+
+job_wakeup = asyncio.Event()
+
+@app.post("/jobs", status_code=202)
+async def create_job(
+    request: Request,
+    text: str = Form(""),
+    image: UploadFile = File(...),
+    response_mode: str = Form("inline"),
+    callback_url: Optional[str] = Form(None)
+):
+    """
+    Queue a generation and return its id right away
+    Poll GET /jobs/{id}, or pass callback_url to have the finished job POSTed
+    there
+    """
+    if not job_queue.available:
+        raise HTTPException(503, detail="Job queue unavailable")
+    
+    if not image.content_type or not image.content_type.startswith('image/'):
+        raise HTTPException(400, detail="File must be an image")
+    
+    if callback_url:
+        try:
+            await asyncio.to_thread(check_callback_url, callback_url)
+        except ValueError as e:
+            raise HTTPException(400, detail=str(e))
+    
+    image_bytes = await read_upload(image)
+    
+    try:
+        job = await asyncio.to_thread(
+            job_queue.submit, image_bytes, text, response_mode, str(request.base_url), callback_url or None
         )
+    except JobQueueFull:
+        raise HTTPException(503, detail="Job queue full, please retry", headers={"Retry-After": "5"})
+    job_wakeup.set()
+    
+    logger.info(f"📋 Job {job['id']} queued at position {job['queue_position']}")
+    return {
+        "id": job["id"],
+        "status": "queued",
+        "queue_position": job["queue_position"],
+        "status_url": str(request.url_for("get_job", job_id=job["id"]))
+    }
+
+@app.get("/jobs/stats")
+async def job_stats():
+    """
+    Queue depth, worker count and recent queue wait times
+    """
+    if not job_queue.available:
+        raise HTTPException(503, detail="Job queue unavailable")
+    return await asyncio.to_thread(job_queue.snapshot)
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    Status of a job, with its result once done
+    """
+    if not job_queue.available:
+        raise HTTPException(503, detail="Job queue unavailable")
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(404, detail="Job not found")
+    return await job_response(job)
+
+@app.post("/sessions/{session_id}/refine")
+async def refine_session(
+    request: Request,
+    session_id: str,
+    instruction: str = Form(...),
+    response_mode: str = Form("inline"),
+    previews: bool = Form(True)
+):
+    """
+    Apply a follow-up instruction ("make arrows thicker", "fix step 2") to a
+    session's latest SVG, without re-uploading the image
+    Returns the same shape as /generate-svg plus the session_id, the turn
+    number and whether the edit was applied locally or by the model
+    """
+    if not instruction.strip():
+        raise HTTPException(400, detail="Instruction is required")
+    session = session_store.get(session_id)
+    if session is None:
+        raise HTTPException(404, detail="Session not found or expired")
+    
+    try:
+        logger.info(f"📝 Refine {session_id}: {instruction[:100]}")
+        # One refinement at a time per session, each building on the last
+        async with session["lock"]:
+            images, edit = await refine_svg(session, instruction)
+            turn = len(session["turns"]) - 1
+        
+        body = {"session_id": session_id, "turn": turn, "edit": edit}
+        if response_mode == "urls":
+            return {"assets": await build_asset_refs(request.base_url, images), **body, "success": True}
+        if previews:
+            images = {**images, **await rasterize_previews(images['svg'])}
+        return {
+            "svg": images.get('svg', ''),
+            "jpg": images.get('jpg', ''),
+            "png": images.get('png', ''),
+            **body,
+            "success": True
+        }
         
-        svg_text = response.text
+    except HTTPException as he:
+        logger.error(f"HTTP Exception: {he.detail}")
+        raise
+    except Exception as e:
+        logger.error(f"Unexpected error: {str(e)}", exc_info=True)
+        return {
+            "svg": "",
+            "jpg": "",
+            "png": "",
+            "session_id": session_id,
+            "error": str(e)
+        }
+
+@app.get("/sessions/{session_id}")
+async def get_session(session_id: str):
+    session = session_store.get(session_id)
+    if session is None:
+        raise HTTPException(404, detail="Session not found or expired")
+    return {
+        "session_id": session_id,
+        "turns": session["turns"],
+        "svg_bytes": len(session["svg"].encode('utf-8')),
+        "image_bytes": len(session["image"]),
+        "expires_at": session["updated_at"] + session_store.ttl,
+    }
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    if not session_store.delete(session_id):
+        raise HTTPException(404, detail="Session not found or expired")
+    return {"success": True}
+
+@app.post("/generate-analysis")
+async def generate_analysis(
+    request: Request,
+    text: str = Form(""),
+    image: UploadFile = File(...),
+    response_mode: str = Form("inline"),
+    preview_format: str = Form(""),
+    preview_preset: str = Form(PREVIEW_PRESET),
+    generation_mode: str = Form(GENERATION_MODE)
+):
+    """
+    Alternative endpoint with detailed response
+    """
+    try:
+        # Same logic as generate-svg but with different response format
+        check_preview_options(preview_format, preview_preset)
+        check_generation_mode(generation_mode)
+        image_bytes = await read_upload(image)
+        images = await get_or_generate_images(
+            image_bytes, text, "User context", previews=response_mode != "urls" and not preview_format,
+            mode=generation_mode
+        )
         
-        if not svg_text:
-            raise HTTPException(500, detail="Empty response from Gemini")
+        if response_mode == "urls":
+            return {
+                "success": True,
+                "message": "Analysis complete",
+                "data": {"assets": await build_asset_refs(request.base_url, images, preview_format, preview_preset)}
+            }
         
-        images = create_mobile_optimized_images(svg_text)
+        if preview_format:
+            return {
+                "success": True,
+                "message": "Analysis complete",
+                "data": {
+                    "svg": images.get('svg', ''),
+                    "preview": await build_preview(request, images, preview_format, preview_preset)
+                }
+            }
         
         return {
             "success": True,
@@ -539,6 +4977,10 @@ async def generate_analysis(
             }
         }
         
+    except HTTPException as he:
+        # Upstream failures keep their status and Retry-After
+        logger.error(f"HTTP Exception: {he.detail}")
+        raise
     except Exception as e:
         logger.error(f"Error: {str(e)}")
         return {
@@ -547,6 +4989,111 @@ async def generate_analysis(
             "message": "Analysis failed"
         }
 
+@app.get("/assets/{asset_id}")
+async def get_asset(asset_id: str, request: Request):
+    """
+    Serve a generated svg/jpg/png by id with caching and compression headers
+    """
+    if not AssetStore.is_valid_id(asset_id):
+        raise HTTPException(404, detail="Asset not found")
+    data = await asyncio.to_thread(asset_store.get, asset_id)
+    if data is None:
+        raise HTTPException(404, detail="Asset not found")
+    
+    digest, ext = asset_id.split('.')
+    headers = {"Cache-Control": "public, max-age=31536000, immutable"}
+    encoding = None
+    if ext == 'svg':
+        headers.update(SVG_ASSET_HEADERS)
+        headers["Vary"] = "Accept-Encoding"
+        accepted = request.headers.get("accept-encoding", "")
+        if brotli is not None and "br" in accepted:
+            encoding = "br"
+        elif "gzip" in accepted:
+            encoding = "gzip"
+    
+    etag = f'"{digest}-{encoding}"' if encoding else f'"{digest}"'
+    headers["ETag"] = etag
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    
+    if encoding:
+        data = await asyncio.to_thread(asset_store.encoded, asset_id, data, encoding)
+        headers["Content-Encoding"] = encoding
+    return Response(content=data, media_type=ASSET_CONTENT_TYPES[ext], headers=headers)
+
+@app.get("/render/{svg_id}")
+async def render_svg(
+    svg_id: str,
+    request: Request,
+    w: int = Query(PREVIEW_WIDTH, ge=16, le=RENDITION_MAX_WIDTH),
+    fmt: str = Query('jpg', pattern='^(jpg|png|png8|webp|avif|auto)$'),
+    q: int = Query(PREVIEW_QUALITY, ge=1, le=95),
+    preset: str = Query(PREVIEW_PRESET, pattern='^(fast|balanced|small)$')
+):
+    """
+    Render a stored SVG on demand at the requested width, format and quality
+    fmt=auto serves AVIF or WebP to clients whose Accept header allows it
+    """
+    if not svg_id.endswith('.svg') or not AssetStore.is_valid_id(svg_id):
+        raise HTTPException(404, detail="SVG not found")
+    
+    headers = {"Cache-Control": "public, max-age=31536000, immutable"}
+    if fmt == 'auto':
+        headers["Vary"] = "Accept"
+    fmt = negotiate_format(fmt, request.headers.get("accept", ""))
+    key = rendition_key(svg_id, w, fmt, q, preset)
+    etag = f'"{key}"'
+    headers["ETag"] = etag
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    
+    try:
+        data = await get_rendition(svg_id, w, fmt, q, preset)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error rendering {key}: {str(e)}")
+        raise HTTPException(500, detail="Render failed")
+    
+    return Response(content=data, media_type=ASSET_CONTENT_TYPES[fmt], headers=headers)
+
+@app.get("/render/{svg_id}/srcset")
+async def render_svg_srcset(
+    svg_id: str,
+    request: Request,
+    w: int = Query(SRCSET_BASE_WIDTH, ge=16, le=RENDITION_MAX_WIDTH),
+    fmt: str = Query('jpg', pattern='^(jpg|png|png8|webp|avif|auto)$'),
+    q: int = Query(PREVIEW_QUALITY, ge=1, le=95),
+    preset: str = Query(PREVIEW_PRESET, pattern='^(fast|balanced|small)$')
+):
+    """
+    Responsive set for a stored SVG: /render URLs for each SRCSET_SCALES
+    multiple of w, all rendered in one pass, and a blurred placeholder
+    """
+    if not svg_id.endswith('.svg') or not AssetStore.is_valid_id(svg_id):
+        raise HTTPException(404, detail="SVG not found")
+    
+    headers = {"Vary": "Accept"} if fmt == 'auto' else {}
+    try:
+        body = await build_srcset(request, svg_id, None, fmt, preset, w, q)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error rendering srcset for {svg_id}: {str(e)}")
+        raise HTTPException(500, detail="Render failed")
+    return JSONResponse(body, headers=headers)
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Prometheus metrics: per-stage latency histograms, in-flight gauges, SVG
+    and response sizes, and error counters
+    """
+    if prometheus_client is None:
+        raise HTTPException(503, detail="Metrics unavailable (prometheus_client not installed)")
+    return Response(content=prometheus_client.generate_latest(), media_type=prometheus_client.CONTENT_TYPE_LATEST)
+
 @app.get("/health")
 async def health_check():
     return {
@@ -556,12 +5103,51 @@ async def health_check():
         "endpoint": "/generate-svg active"
     }
 
+@app.get("/ready")
+async def readiness_check():
+    """
+    Readiness probe: 503 until startup warm-up has finished, unlike /health,
+    which only says the process is up
+    """
+    body = {
+        "status": "ready" if warmup_state["ready"] else "warming",
+        "warmup": warmup_state,
+        "render_pool": render_pool.started,
+    }
+    return JSONResponse(body, status_code=200 if warmup_state["ready"] else 503)
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {
+        **result_cache.snapshot(),
+        "single_flight": single_flight.snapshot(),
+        "llm": {**llm_backend.snapshot(), "policy": llm_policy.snapshot()},
+        "optimizer": dict(optimizer_stats),
+        "rasterizers": [rasterizer.snapshot() for rasterizer in rasterizers],
+        "sessions": session_store.snapshot(),
+        "admission": {
+            **admission.snapshot(),
+            "rate_limit": rate_limiter.stats if rate_limiter is not None else None,
+        },
+    }
+
 @app.get("/")
 async def root():
     return {
         "message": "Business Analyzer API",
         "version": "1.0.0",
         "react_native_endpoint": "POST /generate-svg",
+        "streaming_endpoint": "POST /generate-svg/stream (text/event-stream)",
+        "batch_endpoint": "POST /generate-svg/batch (images[], texts[], stream=true for text/event-stream)",
+        "jobs_endpoint": "POST /jobs, then GET /jobs/{id} (or callback_url)",
+        "refine_endpoint": "POST /sessions/{id}/refine (session=true on /generate-svg)",
+        "generation_modes": list(GENERATION_MODES),
+        "srcset_endpoint": "GET /render/{svg_id}/srcset (srcset=true on /generate-svg)",
+        "asset_endpoint": "GET /assets/{id} (with response_mode=urls)",
+        "render_endpoint": "GET /render/{id}?w=&fmt=jpg|png|png8|webp|avif|auto&q=&preset=fast|balanced|small",
+        "preview_formats": list(supported_preview_formats()),
+        "readiness_endpoint": "GET /ready (503 until startup warm-up finishes; /health is liveness only)",
+        "metrics_endpoint": "GET /metrics (Prometheus); stage timings in the Server-Timing header",
         "expected_response": {
             "svg": "string",
             "jpg": "base64 string",
@@ -572,7 +5158,7 @@ async def root():
 if __name__ == "__main__":
     logger.info("🚀 Starting Business Analyzer API for React Native")
     logger.info("📱 React Native endpoint: POST /generate-svg")
-    logger.info("🤖 Using Gemini model: gemini-1.5-pro")
+    logger.info(f"🤖 Using {llm_backend.name} model: {llm_backend.model}")
     
     uvicorn.run(
         app, 
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Render in-process so importing main does not depend on worker processes
+os.environ.setdefault("RENDER_PROCESSES", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,29 @@
+"""
+Layout-mode specs: malformed model output must surface as LayoutError
+"""
+import json
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import main
+
+def test_example_renders():
+    svg = main.layout_to_images(json.dumps(main.LAYOUT_EXAMPLE))['svg']
+    assert ET.fromstring(svg).tag == f"{{{main.SVG_NAMESPACE}}}svg"
+
+@pytest.mark.parametrize("text", [
+    "no json here",
+    '{"question": "not a list"}',
+    '{"question": [], "steps": {}}',
+    '{"question": [' + '[' * 5000 + ']' * 5000 + ']}',
+    '{"question": [{"text": ' + '[' * 50 + '"x"' + ']' * 50 + '}]}',
+    '{"question": [{"text": ' + '{"value": ' * 50 + '"x"' + '}' * 50 + '}]}',
+])
+def test_malformed_specs_raise_layout_error(text):
+    with pytest.raises(main.LayoutError):
+        main.layout_to_images(text)
+
+def test_nesting_depth_counts_levels():
+    assert main._nesting_depth("x") == 1
+    assert main._nesting_depth({"a": [1, {"b": 2}]}) == 4
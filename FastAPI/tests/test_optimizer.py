@@ -0,0 +1,88 @@
+"""
+SVGOptimizer rewrites: precision, colours, redundant and shared presentation
+attributes, unused definitions and whitespace
+"""
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import main
+
+SVG = '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" viewBox="0 0 10 10">'
+NS = {"svg": main.SVG_NAMESPACE}
+
+@pytest.fixture(autouse=True)
+def precision(monkeypatch):
+    monkeypatch.setattr(main, "SVG_OPTIMIZE_PRECISION", 2)
+
+def optimize(body: str) -> ET.Element:
+    return ET.fromstring(main.SVGOptimizer(SVG + body + '</svg>').optimize())
+
+def test_rounds_coordinates_to_precision():
+    rect = optimize('<rect x="1.23456" y="-0.00001" width="3.5" height="2.25000001" d="M0.125 1.999"/>')[0]
+    assert rect.get("x") == "1.23"
+    assert rect.get("y") == "0"
+    assert rect.get("width") == "3.5"
+    assert rect.get("height") == "2.25"
+
+def test_leaves_transforms_and_exponents_alone():
+    path = optimize('<path transform="matrix(1.123456  0 0 1 0 0)" d="M1.5e-3 2.123456"/>')[0]
+    assert path.get("transform") == "matrix(1.123456 0 0 1 0 0)"
+    assert path.get("d") == "M1.5e-3 2.12"
+
+def test_shortens_hex_colours():
+    rect = optimize('<rect fill="#FFAA00" stroke="#123456"/>')[0]
+    assert rect.get("fill") == "#fa0"
+    assert rect.get("stroke") == "#123456"
+
+def test_removes_attributes_repeating_the_inherited_value():
+    group = optimize('<g fill="red"><rect fill="red" width="1"/><circle fill="blue" r="1"/></g>')[0]
+    rect, circle = group
+    assert "fill" not in rect.attrib
+    assert circle.get("fill") == "blue"
+
+def test_keeps_relative_font_sizes():
+    group = optimize('<g font-size="120%"><text font-size="120%">a</text></g>')[0]
+    assert group[0].get("font-size") == "120%"
+
+def test_lifts_shared_attributes_onto_a_group():
+    root = optimize('<rect fill="red" width="1"/><rect fill="red" width="2"/><rect fill="red" width="3"/>')
+    assert len(root) == 1
+    group = root[0]
+    assert group.tag == f"{{{main.SVG_NAMESPACE}}}g" and group.get("fill") == "red"
+    assert [rect.get("fill") for rect in group] == [None] * 3
+
+def test_drops_unreferenced_definitions():
+    root = optimize(
+        '<defs><linearGradient id="used"/><linearGradient id="unused"/><marker id="m"/></defs>'
+        '<rect fill="url(#used)"/>'
+    )
+    assert root.find(".//*[@id='used']") is not None
+    assert root.find(".//*[@id='unused']") is None
+    assert root.find(".//*[@id='m']") is None
+
+def test_keeps_transitively_referenced_ids():
+    root = optimize(
+        '<defs><linearGradient id="base"/><linearGradient id="derived" xlink:href="#base"/></defs>'
+        '<use xlink:href="#sym"/><symbol id="sym"><circle id="inner" r="1" fill="url(#derived)"/></symbol>'
+    )
+    for ref in ("base", "derived", "sym", "inner"):
+        assert root.find(f".//*[@id='{ref}']") is not None
+
+def test_referenced_elements_keep_their_attributes():
+    root = optimize('<g fill="red"><rect id="r" fill="red"/></g><use xlink:href="#r"/>')
+    assert root.find(".//*[@id='r']").get("fill") == "red"
+
+def test_stylesheet_keeps_structure():
+    root = optimize('<style>#a{fill:red}</style><g fill="red"><rect id="a" fill="red"/><rect fill="red"/></g>')
+    rects = root.findall(".//svg:rect", NS)
+    assert [rect.get("fill") for rect in rects] == ["red", "red"]
+
+def test_strips_formatting_whitespace_but_not_text():
+    clean = main.SVGOptimizer(SVG + '<!-- note -->\n  <g>\n    <rect/>\n  </g>\n  <text>  keep  </text></svg>').optimize()
+    assert "note" not in clean
+    assert "\n" not in clean
+    assert "<text>  keep  </text>" in clean
+
+def test_optimize_svg_returns_input_it_cannot_parse():
+    assert main.optimize_svg("<svg><rect></svg>") == "<svg><rect></svg>"
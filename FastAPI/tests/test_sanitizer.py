@@ -0,0 +1,95 @@
+"""
+SVGSanitizer / validate_and_clean_svg over the benchmark corpus and the
+model-output quirks it exists for
+"""
+import os
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import main
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "svg_corpus")
+CHUNK_SIZES = (1, 7, 64, 1024)
+
+def load_corpus():
+    samples = {}
+    for name in sorted(os.listdir(CORPUS_DIR)):
+        with open(os.path.join(CORPUS_DIR, name), encoding="utf-8") as f:
+            samples[os.path.splitext(name)[0]] = f.read()
+    samples["prompt_example"] = main.PROMPT[main.PROMPT.index('<svg'):main.PROMPT.index('</svg>') + len('</svg>')]
+    return samples
+
+CORPUS = load_corpus()
+
+def parse(svg: str) -> ET.Element:
+    root = ET.fromstring(svg)
+    assert root.tag == f"{{{main.SVG_NAMESPACE}}}svg"
+    return root
+
+def sanitize_streamed(text: str, chunk_size: int) -> str:
+    sanitizer = main.SVGSanitizer()
+    parts = [sanitizer.feed(text[i:i + chunk_size]) for i in range(0, len(text), chunk_size)]
+    parts.append(sanitizer.close())
+    return ''.join(parts)
+
+@pytest.mark.parametrize("name", sorted(CORPUS))
+def test_corpus_is_well_formed(name):
+    parse(main.validate_and_clean_svg(CORPUS[name]))
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+@pytest.mark.parametrize("name", sorted(CORPUS))
+def test_corpus_streamed_matches_whole(name, chunk_size):
+    assert sanitize_streamed(CORPUS[name], chunk_size) == main.validate_and_clean_svg(CORPUS[name])
+
+def test_root_attributes():
+    root = parse(main.validate_and_clean_svg('<svg viewBox="0 0 10 10"><rect width="5" height="5"/></svg>'))
+    assert root.get("width") == "100%"
+    assert root.get("height") == "auto"
+    assert root.get("preserveAspectRatio") == "xMidYMid meet"
+    assert root.get("viewBox") == "0 0 10 10"
+
+def test_prose_and_fences_around_svg_are_dropped():
+    text = 'Here you go:\n```svg\n<svg viewBox="0 0 10 10"><rect width="5" height="5"/></svg>\n```\nHope that helps!'
+    clean = main.validate_and_clean_svg(text)
+    assert clean.startswith('<svg') and clean.endswith('</svg>')
+    assert "Here you go" not in clean and "Hope" not in clean and "```" not in clean
+    assert len(parse(clean)) == 1
+
+def test_sanitizer_completes_at_root_end_tag():
+    sanitizer = main.SVGSanitizer()
+    sanitizer.feed('<svg viewBox="0 0 10 10"><rect/>')
+    assert not sanitizer.complete
+    sanitizer.feed('</svg>\n```')
+    assert sanitizer.complete
+
+@pytest.mark.parametrize("text", [
+    '<svg viewBox="0 0 10 10"><g><rect x="1" y="2',
+    '<svg viewBox="0 0 10 10"><g><rect x="1" y',
+    '<svg viewBox="0 0 10 10"><g><text x="1">Hel',
+    '<svg viewBox="0 0 10 10"><g><re',
+])
+def test_truncated_output_is_closed(text):
+    root = parse(main.validate_and_clean_svg(text))
+    assert root[0].tag == f"{{{main.SVG_NAMESPACE}}}g"
+
+def test_text_without_svg_is_wrapped():
+    root = parse(main.validate_and_clean_svg("no svg here at all"))
+    assert root.text == "no svg here at all"
+
+def test_bound_namespace_prefixes_are_kept():
+    clean = main.validate_and_clean_svg(
+        '<svg viewBox="0 0 10 10" xmlns:xlink="http://www.w3.org/1999/xlink"><use xlink:href="#a"/></svg>'
+    )
+    use = parse(clean)[0]
+    assert use.get("{http://www.w3.org/1999/xlink}href") == "#a"
+
+def test_unbound_namespace_prefixes_are_dropped():
+    root = parse(main.validate_and_clean_svg('<svg viewBox="0 0 10 10"><foo:bar x="1"><rect/></foo:bar><rect foo:x="1"/></svg>'))
+    # The unbound element goes but its content stays
+    assert [child.tag for child in root] == [f"{{{main.SVG_NAMESPACE}}}rect"] * 2
+    assert root[1].attrib == {}
+
+def test_entities():
+    text = main.validate_and_clean_svg('<svg viewBox="0 0 10 10"><text>A & B &amp; C &lt; &#169; &nbsp;</text></svg>')
+    assert parse(text)[0].text == "A & B & C < © &nbsp;"